@@ -34,6 +34,7 @@
 #     - h5netcdf=1.1.0
 #     - h5py=3.7.0
 #     - netcdf4=1.6.2
+#     - numba=0.56.4
 #     - numpy=1.23.5
 #     - pandas=1.5.2
 #     - pyproj=3.4.1
@@ -75,6 +76,7 @@ conda install -c conda-forge \
   h5netcdf=1.1.0 \
   h5py=3.7.0 \
   netcdf4=1.6.2 \
+  numba=0.56.4 \
   numpy=1.23.5 \
   pandas=1.5.2 \
   pyproj=3.4.1 \
@@ -142,24 +144,24 @@ reproject_mod44b.sh
 download_cmip6.sh
 
 # Download ERA5 datasets using a set of python scripts wrapped in shell script.
-# Also run script to convert these ERA5 netcdf files from NetCDF3 to NetCDF4.
+# Each file is converted from NetCDF3 to NetCDF4 as soon as it is downloaded
+# (see wildfire_analysis/utils/convert_netcdf.py).
 python wildfire_analysis/utils/download_era5.py
-convert_era5_to_netcdf4.sh
 
 # -----------------------------------------------------------------------------
 # Organize datasets for processing:
+#   03_modify_ecoregion_shapefile.py
+#      Subset and reclass Ecoregions shapefile. Also use gdal to reproject 
+#      ecoregion to predetermined spatial reference system. Run first, as 
+#      01 and 02 read the ecoregions shapefile if 'CLIMATE: ecoregion_bbox' 
+#      is True in config.yaml.
 #   01_process_era5.py
 #      Organize ERA5 datasets to get dailiy summaries of desired variables and
 #      modify geographic extent and convert calendar to 'noleap'
 #   02_process_cmip6.py
 #      Organize all downloaded CMIP6 data by modifying geographic extent, 
 #      converting calendar, and converting units (e.g., K -> degC)
-#   03_modify_ecoregion_shapefile.py
-#      Subset and reclass Ecoregions shapefile. Also use gdal to reproject 
-#      ecoregion to predetermined spatial reference system.
 # -----------------------------------------------------------------------------
-01_process_era5.py --verbose
-02_process_cmip6.py --verbose
 03_modify_ecoregion_shapefile.py
 
 # Also, project ecroregion shapefile from geographic to projected reference 
@@ -169,6 +171,9 @@ ogr2ogr -f "ESRI Shapefile" \
   data/processed/ecoregions/ecos_reproj.shp \
   data/processed/ecoregions/ecos.shp
 
+01_process_era5.py --verbose
+02_process_cmip6.py --verbose
+
 # -----------------------------------------------------------------------------
 # Bias correct GCM data 
 #   This script uses a quantile delta mapping approach to 
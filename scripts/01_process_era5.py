@@ -4,10 +4,9 @@
 from pathlib import Path
 import sys
 
-from tqdm import tqdm
 import yaml
 
-from wildfire_analysis.data_processing.process_era5 import process_era5
+from wildfire_analysis.data_processing.process_era5 import process_era5_years
 from wildfire_analysis.utils import helpers as h
 
 #%% Import config file and read in parameters needed for data processing
@@ -20,13 +19,28 @@ with open(config_fn,'r') as config_file:
 
     raw_data_dir = root_dir / config_params['PATHS']['raw_data_dir']
     processed_data_dir = root_dir / config_params['PATHS']['processed_data_dir']
+    geog_lims = config_params['EXTENT']['geog_lims']
+    ecoregion_bbox = config_params['CLIMATE']['ecoregion_bbox']
     era5_yr = config_params['TIME']['era5_yr']
+    workers = config_params['ERA5']['workers']
+    memory_limit = config_params['ERA5']['memory_limit']
 
-#%% Read in verbose flag to print progress bar
+#%% Read in verbose flag to print progress of each year
 verbose = False
 if (sys.argv[-1] == "--verbose"):
     verbose = True
 
+#%% Geographic limits of data to read. If 'CLIMATE: ecoregion_bbox' is True in
+# config.yaml, only read data within the bounding box of the ecoregions 
+# shapefile (buffered by the grid resolution) instead of the full extent.
+geolims = geog_lims
+
+if ecoregion_bbox:
+    geolims = h.geolims_from_shp(
+        processed_data_dir / 'ecoregions/ecos.shp',
+        buffer=0.25,
+        geolims=geog_lims)
+
 #%% Set directories for reading and writing
 wdir = raw_data_dir / 'climate/era5'
 dest = processed_data_dir / 'climate/era5'
@@ -37,23 +51,20 @@ if not dest.exists():
 #%% Set range of years for processing
 yr_range = range(era5_yr[0],era5_yr[1]+1)
 
-with tqdm(total=len(yr_range),disable=not verbose) as pbar: # for progress bar
-
-    for yr in yr_range: # For each year ...
-
-        # Find file for given year
-        src = list(wdir.glob('%d*.nc' % yr))
-
-        # Process ERA5 datasets
-        ds = process_era5(src,dask_load=True)
-
-        # Export netcdf for each variable in a given year
-        for var in h.get_var_names(ds):
-
-            fn = dest / ('%s_era5_%d.nc' % (var,yr))
-            ds[var].to_netcdf(fn,engine='h5netcdf')
-
-        # Close datasets
-        ds.close()
-
-        pbar.update()
\ No newline at end of file
+#%% Process ERA5 datasets and export netcdf for each variable in a given year.
+# Years are processed in parallel by 'workers' processes, and years that are
+# already finished are skipped.
+records = process_era5_years(
+    wdir,
+    dest,
+    yr_range,
+    workers=workers,
+    memory_limit=memory_limit,
+    geolims=geolims,
+    verbose=verbose,
+    )
+
+failed = [r['year'] for r in records if r['status'].startswith('failed')]
+
+if len(failed) > 0:
+    raise Exception('ERA5 processing failed for years: %s' % failed)
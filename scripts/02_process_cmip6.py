@@ -7,7 +7,8 @@ import sys
 from tqdm import tqdm
 import yaml
 
-from wildfire_analysis.data_processing.process_cmip6 import process_cmip6
+from wildfire_analysis.data_processing.process_cmip6 import process_cmip6, \
+    export_cmip6
 from wildfire_analysis.utils import helpers as h
 
 #%% Import config file and read in parameters needed for data processing
@@ -21,6 +22,8 @@ with open(config_fn,'r') as config_file:
 
     raw_data_dir = root_dir / config_params['PATHS']['raw_data_dir']
     processed_data_dir = root_dir / config_params['PATHS']['processed_data_dir']
+    geog_lims = config_params['EXTENT']['geog_lims']
+    ecoregion_bbox = config_params['CLIMATE']['ecoregion_bbox']
     gcm_list = config_params['CLIMATE']['gcm_list']
     metvars = config_params['CLIMATE']['metvars']
     cmip6_yr = config_params['TIME']['cmip6_yr']
@@ -30,6 +33,17 @@ verbose = False
 if sys.argv[-1] == '--verbose':
     verbose = True
 
+#%% Geographic limits of data to read. If 'CLIMATE: ecoregion_bbox' is True in
+# config.yaml, only read data within the bounding box of the ecoregions 
+# shapefile (buffered by the grid resolution) instead of the full extent.
+geolims = geog_lims
+
+if ecoregion_bbox:
+    geolims = h.geolims_from_shp(
+        processed_data_dir / 'ecoregions/ecos.shp',
+        buffer=1.0,
+        geolims=geog_lims)
+
 #%% Convert yr limits to range
 cmip6_yr = range(cmip6_yr[0],cmip6_yr[1]+1)
 
@@ -57,15 +71,10 @@ with tqdm(total=N,disable=not verbose) as pbar: # for progress bar
 
                 src = list(wdir.glob('%s*nc' % var))
 
-            ds = process_cmip6(src)
-            # ds = ds.compute()
-
-            for yr in cmip6_yr:
-
-                fn = dest / ('%s_%s_%d.nc' % (var,gcm,yr))
-                ds_i = ds.sel(time=slice(str(yr),str(yr)))
+            ds = process_cmip6(src,geolims=geolims)
 
-                ds_i.to_netcdf(fn,engine='h5netcdf')
+            # Write all years in one pass through the source files
+            export_cmip6(ds,dest,var,gcm,years=cmip6_yr)
 
             pbar.update()
             
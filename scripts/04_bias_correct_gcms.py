@@ -4,6 +4,7 @@
 from pathlib import Path
 import sys
 
+import dask
 import numpy as np
 from tqdm import tqdm
 import yaml
@@ -25,11 +26,14 @@ with open(config_fn,'r') as config_file:
     processed_data_dir = root_dir / config_params['PATHS']['processed_data_dir']
     gcm_list = config_params['CLIMATE']['gcm_list']
     metvars = config_params['CLIMATE']['metvars']
+    float_dtype = config_params['CLIMATE']['dtype']
     hst_yr = config_params['TIME']['hst_yr']
     sim_periods = config_params['TIME']['sim_periods']
     oper = config_params['QDM']['oper']
     min_thresh = config_params['QDM']['min_thresh']
     quantile_vals = config_params['QDM']['quantile_vals']
+    qdm_engine = config_params['QDM']['engine']
+    qdm_workers = config_params['QDM']['workers']
 
 #%% If verbose=True then have progress bar document processing time
 verbose = False
@@ -41,11 +45,40 @@ if sys.argv[-1] == '--verbose':
 shpfile = processed_data_dir / 'ecoregions/ecos.shp'
 refdir = processed_data_dir / 'climate/era5'
 
+# Regridding weights from each GCM grid to the ERA5 grid are saved here and
+# reused for all variables and periods
+regrid_cache_dir = processed_data_dir / 'climate/regrid_weights'
+
 # Set list of quantile values as numpy array
 quantile_vals = np.array(quantile_vals)
 
+# Trained quantiles and adjustment factors for each GCM and variable are saved
+# here, and reused if this script is run again with the same inputs
+train_cache_dir = processed_data_dir / 'climate/qdm_trained'
+
+# Only grid cells inside the ecoregions (and with ERA5 values) are bias 
+# corrected, along a 1-D cell dimension. The index of these cells for each
+# variable is saved here, and results are put back on the ERA5 grid.
+cell_index_dir = processed_data_dir / 'climate/cell_index'
+
+# Write each year of a bias corrected data array to dest
+def export_years(da,first_yr,last_yr,dest,var,gcm):
+
+    with dask.config.set(h.process_scheduler(qdm_workers)):
+        da = h.add_time_coords(da.compute())
+
+    for yr in range(first_yr,last_yr+1):
+
+        fn = dest / ("%s_%s_%d.nc" % (var,gcm,yr))
+        export_ds = h.sel_years(da,yr)
+        export_ds = export_ds.drop_vars(['year','month','doy'])
+        export_ds = export_ds.astype(float_dtype)
+        export_ds.to_netcdf(fn,engine='h5netcdf')
+
+    return None
+
 # Needed for progress bar
-N = len(gcm_list)*len(metvars)*len(sim_periods)
+N = len(gcm_list)*len(metvars)
 with tqdm(total=N,disable=not verbose) as pbar: # for progress bar
 
     for gcm in gcm_list:
@@ -58,60 +91,44 @@ with tqdm(total=N,disable=not verbose) as pbar: # for progress bar
         
         for var in metvars:
 
-            for sim_yr in sim_periods:
-                
-                ref_src = [list(refdir.glob("%s*%d*" % (var,i)))[0] \
-                    for i in range(hst_yr[0],hst_yr[1]+1)]
-
-                hst_src = [list(wdir.glob("%s*%d*" % (var,i)))[0] \
-                    for i in range(hst_yr[0],hst_yr[1]+1)]
-
-                sim_src = [list(wdir.glob("%s*%d*" % (var,i)))[0] \
-                    for i in range(sim_yr[0],sim_yr[1]+1)]
-
-                if sim_yr == sim_periods[0]:
-                    hst_return_bool = True
-                else:
-                    hst_return_bool = False
-
-                qdm = quantile_delta_mapping(
-                    ref_src,hst_src,sim_src,
-                    dask_load=True,
-                    regrid='gcm2era',
-                    mask=shpfile,
-                    kind=oper[var],
-                    nquantiles=quantile_vals,
-                    group='time.month',
-                    min_thresh=min_thresh[var],
-                    return_hst=hst_return_bool,
-                    interp='linear',
-                    dask_return=True
-                    )
-
-                if hst_return_bool:
-
-                    hst_ba = qdm[0]
-                    hst_ba = hst_ba.compute()
-
-                    for yr in range(hst_yr[0],hst_yr[1]+1):
-
-                        fn = dest / ("%s_%s_%d.nc" % (var,gcm,yr))
-                        yr_slice = slice(str(yr),str(yr))
-                        export_ds = hst_ba.sel(time=yr_slice)
-                        export_ds = export_ds.astype('float32')
-                        export_ds.to_netcdf(fn,engine='h5netcdf')
-                    
-                    del hst_ba
-                
-                sim_ba = qdm[-1]
-                sim_ba = sim_ba.compute()
-
-                for yr in range(sim_yr[0],sim_yr[1]+1):
-
-                    fn = dest / ("%s_%s_%d.nc" % (var,gcm,yr))
-                    yr_slice = slice(str(yr),str(yr))
-                    export_ds = sim_ba.sel(time=yr_slice)
-                    export_ds = export_ds.astype('float32')
-                    export_ds.to_netcdf(fn,engine='h5netcdf')
-
-                pbar.update()
\ No newline at end of file
+            ref_src = [list(refdir.glob("%s*%d*" % (var,i)))[0] \
+                for i in range(hst_yr[0],hst_yr[1]+1)]
+
+            hst_src = [list(wdir.glob("%s*%d*" % (var,i)))[0] \
+                for i in range(hst_yr[0],hst_yr[1]+1)]
+
+            sim_src = [[list(wdir.glob("%s*%d*" % (var,i)))[0] \
+                for i in range(sim_yr[0],sim_yr[1]+1)] \
+                for sim_yr in sim_periods]
+
+            # Trains once on ref and hst, then bias corrects hst and each 
+            # simulation period
+            hst_ba, *sim_ba = quantile_delta_mapping(
+                ref_src,hst_src,sim_src,
+                dask_load=True,
+                regrid='gcm2era',
+                regrid_cache_dir=regrid_cache_dir,
+                mask=shpfile,
+                mask_cache_dir=processed_data_dir / 'ecoregions/masks',
+                train_cache_dir=train_cache_dir,
+                engine=qdm_engine,
+                workers=qdm_workers,
+                cells=True,
+                cell_index_fn=cell_index_dir / ('cells_%s.nc' % var),
+                kind=oper[var],
+                nquantiles=quantile_vals,
+                group='time.month',
+                min_thresh=min_thresh[var],
+                return_hst=True,
+                interp='linear',
+                dask_return=True,
+                dtype=float_dtype
+                )
+
+            export_years(hst_ba,hst_yr[0],hst_yr[1],dest,var,gcm)
+            del hst_ba
+
+            for sim_yr, da in zip(sim_periods,sim_ba):
+                export_years(da,sim_yr[0],sim_yr[1],dest,var,gcm)
+
+            pbar.update()
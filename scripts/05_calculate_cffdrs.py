@@ -4,8 +4,6 @@
 from pathlib import Path
 import sys
 
-from tqdm import tqdm
-import xarray as xr
 import yaml
 
 import wildfire_analysis.cffdrs as cffdrs
@@ -21,9 +19,13 @@ with open(config_fn,'r') as config_file:
 
     processed_data_dir = root_dir / config_params['PATHS']['processed_data_dir']
     gcm_list = config_params['CLIMATE']['gcm_list']
+    float_dtype = config_params['CLIMATE']['dtype']
     era5_yr = config_params['TIME']['era5_yr']
     hst_yr = config_params['TIME']['hst_yr']
     sim_periods = config_params['TIME']['sim_periods']
+    continuous_run = config_params['CFFDRS']['continuous_run']
+    workers = config_params['CFFDRS']['workers']
+    memory_limit = config_params['CFFDRS']['memory_limit']
 
 #%% If verbose=True then have progress bar document processing time
 verbose = False
@@ -44,124 +46,79 @@ for gcm in gcm_list:
     if cmip6_cffdrs_dir_i.exists() is False:
         cmip6_cffdrs_dir_i.mkdir(parents=True)
 
+#%% Directory for moisture code checkpoints at the end of each year
+state_dir = processed_data_dir / 'cffdrs/state'
+if state_dir.exists() is False:
+    state_dir.mkdir(parents=True)
+
+#%% Spatial chunk sizes for computing CFFDRS indices. Each chunk keeps the full
+# year of daily data and chunks are computed in parallel with dask
+spatial_chunks = {'lat': 60,'lon': 120}
+
+#%% CFFDRS indices written to file
+cffdrs_outputs = ['ffmc','dmc','dc','isi','bui','fwi']
+
 #%% Convert yrs to ranges. Start cmip6_yr at first yr of historical period
 # to provide years for historical reference (e.g. maximum anomaly relative to
 # 1980-2009)
 era5_yr = range(era5_yr[0],era5_yr[1]+1)
 cmip6_yr = range(hst_yr[0],sim_periods[-1][1]+1)
 
-#%% Process and calculate cffdrs for era5 data
+#%% Locations of the daily weather files and CFFDRS outputs for each data 
+# source (ERA5 or GCM), and the years of each source
+sources = {'era5': (era5_dir,era5_cffdrs_dir)}
+years = {'era5': era5_yr}
+
+for gcm in gcm_list:
+    sources[gcm] = (cmip6_dir / ('%s/bias_corrected' % gcm),
+                    processed_data_dir / ('cffdrs/cmip6/%s' % gcm))
+    years[gcm] = cmip6_yr
+
+#%% Bias corrected GCM data only have values in the cells of the ecoregions, 
+# so only these cells are computed for GCMs (index saved when bias correcting
+# GCMs in '04_bias_correct_gcms.py', and checked against the grid of the 
+# data). ERA5 indices are computed for the full grid.
+cell_index_fn = processed_data_dir / 'climate/cell_index/cells_tasmax.nc'
+cell_index = h.load_cell_index(cell_index_fn) if cell_index_fn.exists() \
+    else None
+
+#%% Process and calculate cffdrs for era5 and cmip6 data. Bias corrected GCM 
+# data are on the ERA5 grid with the same 'noleap' calendar, so all GCMs for a
+# year are computed together and written to a separate file for each GCM. If
+# continuous_run is True, moisture codes are carried from the end of the 
+# previous year, otherwise they are reset to their default values on January
+# 1st. Years that are already finished are skipped, which allows an 
+# interrupted run to be restarted.
 if verbose:
     print('\n\n-------------------------------------------------------------')
-    print('Processing and calculating CFFDRS indices for era5 data .....')
+    print('Processing and calculating CFFDRS indices for era5 and CMIP6 .....')
     print('-------------------------------------------------------------')
 
-with tqdm(total=len(era5_yr),disable=not verbose) as pbar: # for progress bar
-
-    for yr in era5_yr:
-
-        # Get file list of era5 variables for a single year ...
-        filelist = list(era5_dir.glob('*%d*nc' % yr))
-        metvars = xr.open_mfdataset(filelist,engine='h5netcdf')
-
-        # Transpose axes of data arrays to make sure they're in right order
-        metvars = metvars.transpose('time','lat','lon')
-
-        tas = metvars['tasmax'].values
-        pr = metvars['pr'].values
-        sfcWind = metvars['sfcWind'].values
-        hurs = metvars['hursmin'].values
-        mon = metvars['time'].dt.month.values
-
-        # Calculate CFFDRS indices
-        cffdrs_vals = cffdrs.cffdrs_calc(tas,pr,sfcWind,hurs,mon)
-
-        # Put CFFDRS results in xarray dataset
-        cffdrs_ds = xr.Dataset(
-            data_vars={
-                'ffmc': (['time','lat','lon'],cffdrs_vals['ffmc']),
-                'dmc': (['time','lat','lon'],cffdrs_vals['dmc']),
-                'dc': (['time','lat','lon'],cffdrs_vals['dc']),            
-                'isi': (['time','lat','lon'],cffdrs_vals['isi']),
-                'bui': (['time','lat','lon'],cffdrs_vals['bui']),
-                'fwi': (['time','lat','lon'],cffdrs_vals['fwi']),
-                },
-            coords={
-                'time': ('time',metvars['time'].values,
-                         metvars['time'].attrs),
-                'lat': ('lat',metvars['lat'].values,
-                        metvars['lat'].attrs),
-                'lon': ('lon',metvars['lon'].values,
-                        metvars['lon'].attrs),
-                })
-        
-        # Export/write CFFDRS results to netcdf file
-        cffdrs_ds = cffdrs_ds.astype('float32')
-        export_fn = era5_cffdrs_dir / ('cffdrs_era5_%d.nc' % yr)
-        cffdrs_ds.to_netcdf(export_fn,engine='h5netcdf')
-
-        pbar.update() # Update progress bar
-
-#%% Process and calculate cffdrs for cmip6 data
-if verbose:
-    print('\n\n--------------------------------------------------------------')
-    print('Processing and calculating CFFDRS indices for CMIP6 GCMs .....')
-    print('--------------------------------------------------------------')
-
-with tqdm(total=len(cmip6_yr)*len(gcm_list),disable=not verbose) as pbar:
-
-    for gcm in gcm_list:
-
-        cmip6_dir_i = cmip6_dir / ('%s/bias_corrected' % gcm)
-
-        for yr in cmip6_yr:
-
-            # Get file list of era5 variables for a single year ...
-            filelist = list(cmip6_dir_i.glob('*%d*nc' % yr))
-            metvars = xr.open_mfdataset(filelist,engine='h5netcdf')
-
-            # Transpose axes of data arrays to make sure they're in right 
-            # order. Time needs to be axis 0 for the CFFDRS calcs
-            metvars = metvars.transpose('time','lat','lon')
-
-            # Get metvars as numpy arrays
-            tas = metvars['tasmax'].values # Temperature
-            pr = metvars['pr'].values # Precip
-            sfcWind = metvars['sfcWind'].values # Wind speed
-            hurs = metvars['hursmin'].values # Relative humidity
-            mon = metvars['time'].dt.month.values # Months
-
-            # Calculate CFFDRS indices
-            cffdrs_vals = cffdrs.cffdrs_calc(tas,pr,sfcWind,hurs,mon)
-
-            # Put CFFDRS results in xarray dataset
-            cffdrs_ds = xr.Dataset(
-                data_vars={
-                    'ffmc': (['time','lat','lon'],cffdrs_vals['ffmc']),
-                    'dmc': (['time','lat','lon'],cffdrs_vals['dmc']),
-                    'dc': (['time','lat','lon'],cffdrs_vals['dc']),
-                    'isi': (['time','lat','lon'],cffdrs_vals['isi']),
-                    'bui': (['time','lat','lon'],cffdrs_vals['bui']),
-                    'fwi': (['time','lat','lon'],cffdrs_vals['fwi']),
-                    },
-                coords={
-                    'time': ('time',metvars['time'].values,
-                             metvars['time'].attrs),
-                    'lat': ('lat',metvars['lat'].values,
-                            metvars['lat'].attrs),
-                    'lon': ('lon',metvars['lon'].values,
-                            metvars['lon'].attrs),
-                    })
-            
-            # Export/write CFFDRS results to netcdf file
-            cffdrs_ds = cffdrs_ds.astype('float32')
-            export_fn = Path.joinpath(
-                processed_data_dir,
-                'cffdrs/cmip6/%s/cffdrs_%s_%d.nc' % (gcm,gcm,yr)
-                )
-            cffdrs_ds.to_netcdf(export_fn,engine='h5netcdf')
-
-            pbar.update() # Update progress bar
+archive_kwargs = dict(workers=workers,
+                      memory_limit=memory_limit,
+                      continuous=continuous_run,
+                      chunks=spatial_chunks,
+                      verbose=verbose,
+                      backend='numba',
+                      dtype=float_dtype,
+                      outputs=cffdrs_outputs)
+
+records = cffdrs.run_archive({'era5': sources['era5']},
+                             {'era5': years['era5']},
+                             state_dir,
+                             **archive_kwargs)
+
+records += cffdrs.run_archive({gcm: sources[gcm] for gcm in gcm_list},
+                              {gcm: years[gcm] for gcm in gcm_list},
+                              state_dir,
+                              cell_index=cell_index,
+                              **archive_kwargs)
+
+failed = [r for r in records if r['status'].startswith('failed')]
+if len(failed) > 0:
+    raise Exception('CFFDRS calculations failed for %d tasks: %s' % (
+        len(failed),'; '.join('%s %s %s' % (r['sources'],r['years'],
+                                            r['status']) for r in failed)))
 
 if verbose:
     print('\n\nFinished calculating CFFDRS!\n\n')
@@ -18,6 +18,7 @@ with open(config_fn,'r') as config_file:
 
     processed_data_dir = root_dir / config_params['PATHS']['processed_data_dir']
     gcm_list = config_params['CLIMATE']['gcm_list']
+    float_dtype = config_params['CLIMATE']['dtype']
     era5_yr = config_params['TIME']['era5_yr']
     hst_yr = config_params['TIME']['hst_yr']
     sim_periods = config_params['TIME']['sim_periods']
@@ -31,6 +32,13 @@ if sys.argv[-1] == '--verbose':
 era5_dir = processed_data_dir / 'cffdrs/era5'
 cmip6_dir = processed_data_dir / 'cffdrs/cmip6'
 
+#%% Bias corrected GCM data only have values in the cells of the ecoregions, 
+# so only these cells are used for CFFDRS statistics of GCMs (index saved when
+# bias correcting GCMs in '04_bias_correct_gcms.py')
+cell_index_fn = processed_data_dir / 'climate/cell_index/cells_tasmax.nc'
+cell_index = h.load_cell_index(cell_index_fn) if cell_index_fn.exists() \
+    else None
+
 #%% Create era5 and cmip6 destination directories (if they don't exist)
 dest = processed_data_dir / 'cffdrs/cffdrs_stats/'
 if dest.exists() is False:
@@ -50,7 +58,7 @@ if verbose:
 filelist = [list(era5_dir.glob("*%d*" % i))[0] for i in era5_yr]
 ds_cffdrs_stats = cffdrs_stats.calc_fireweather_stats(filelist)
 ds_cffdrs_stats = ds_cffdrs_stats[['isi','bui','fwi']]
-ds_cffdrs_stats = ds_cffdrs_stats.astype('float32')
+ds_cffdrs_stats = ds_cffdrs_stats.astype(float_dtype)
 ds_cffdrs_stats = ds_cffdrs_stats.compute()
 
 era5_fn = dest / ('cffdrs-stats_era5_%d-%d.nc' % (era5_yr[0],era5_yr[-1]))
@@ -72,9 +80,10 @@ for gcm in gcm_list:
 
     gcm_dir_i = cmip6_dir / ('%s' % gcm)
     filelist = [list(gcm_dir_i.glob("*%d*" % i))[0] for i in cmip6_yr]
-    ds_cffdrs_stats = cffdrs_stats.calc_fireweather_stats(filelist)
+    ds_cffdrs_stats = cffdrs_stats.calc_fireweather_stats(
+        filelist,cell_index=cell_index)
     ds_cffdrs_stats = ds_cffdrs_stats[['isi','bui','fwi']]
-    ds_cffdrs_stats = ds_cffdrs_stats.astype('float32')
+    ds_cffdrs_stats = ds_cffdrs_stats.astype(float_dtype)
 
     gcm_fn = dest / ('cffdrs-stats_%s_%d-%d.nc' % 
                      (gcm,cmip6_yr[0],cmip6_yr[-1]))
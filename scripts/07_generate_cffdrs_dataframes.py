@@ -5,7 +5,6 @@ import itertools
 from pathlib import Path
 
 import geopandas as gpd
-import numpy as np
 import pandas as pd
 import xarray as xr
 import yaml
@@ -33,6 +32,9 @@ ecos_fn = processed_data_dir / 'ecoregions/ecos.shp'
 ecos = gpd.read_file(ecos_fn)
 ecos_id = ecos['ECO_ID']
 
+#%% Directory to save/load ecoregion masks for each grid
+mask_cache_dir = processed_data_dir / 'ecoregions/masks'
+
 #%% Set directory for CFFDRS statistical summaries
 cffdrs_stats_dir = processed_data_dir / 'cffdrs/cffdrs_stats'
 
@@ -48,13 +50,12 @@ for src in src_to_process:
     fn = list(cffdrs_stats_dir.glob('*%s*' % src))[0]
     ds = xr.load_dataset(fn,engine='h5netcdf')
     ds = ds.transpose('stat','year','lat','lon')
-    arr_shape = ds['fwi'].shape
         
     for id in ecos_id:
 
-        mask = h.mask_from_shp(ecos.loc[ecos['ECO_ID']==id,:],ds)
-        mask_Nd = np.broadcast_to(mask,arr_shape)
-        ds_ecos_i = ds.where(mask_Nd)
+        mask = h.mask_from_shp(ecos.loc[ecos['ECO_ID']==id,:],ds,
+                               cache_dir=mask_cache_dir)
+        ds_ecos_i = h.apply_mask(ds,mask)
 
         fw_avgs = ds_ecos_i.mean(dim=['lat','lon'])
 
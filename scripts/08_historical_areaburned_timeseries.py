@@ -70,11 +70,11 @@ for id in eco_id:
     ecos_i = ecos.loc[ecos['ECO_ID']==id,:]
     ecos_i = ecos_i.to_crs(crs) # Reproject to Albers Equal Area projection
 
-    mask = h.mask_from_shp(ecos_i,coords)
-    mask_Nd = np.broadcast_to(mask,fire_stack.shape)
-    mask_Nd = mask_Nd.astype('int')
+    mask = h.mask_from_shp(ecos_i,coords,
+                           cache_dir=processed_data_dir / 'ecoregions/masks')
 
-    fire_stack_i = fire_stack * mask_Nd
+    # Cells outside the ecoregion are set to zero, mask is broadcast over years
+    fire_stack_i = h.apply_mask(fire_stack,mask,other=0)
 
     # sum all sparial values for each year
     fire_sums_i = np.sum(fire_stack_i,axis=(1,2)) 
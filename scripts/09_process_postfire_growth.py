@@ -1,7 +1,7 @@
 import subprocess
 
-import wildfire_analysis.data_processing.tree_cover_histories \
-    as tree_cover_histories
+from wildfire_analysis.data_processing.tree_cover_histories \
+    import tree_cover_histories
 
 # Calculate average tree cover for each fire perimeter and time-since-fire. 
 # This script takes several hours to complete
@@ -13,4 +13,4 @@ tree_cover_histories()
 rscript_call = 'Rscript --vanilla R/model_postfire_veg.R'
 rscript_call = rscript_call.split(" ")
 
-subprocess(rscript_call)
\ No newline at end of file
+subprocess.run(rscript_call,check=True)
\ No newline at end of file
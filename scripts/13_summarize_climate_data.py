@@ -16,10 +16,11 @@ root_dir = Path(h.get_root_dir())
 def get_monthly_averages(da,mask_grid=None):
    
     if mask_grid is not None:
-        x = da.where(mask_grid)
+        x = h.apply_mask(da,mask_grid)
     else:
         x = da
-    y = x.groupby('time.month').mean(dim=['lat','lon','time'])
+    x = h.add_time_coords(x) # Integer month coordinate for grouping
+    y = x.groupby('month').mean(dim=['lat','lon','time'])
 
     return y
 
@@ -56,6 +57,9 @@ cmip6_cffdrs_dir = \
 
 dirs = [era5_dir] + cmip6_dir + [era5_cffdrs_dir] + cmip6_cffdrs_dir
 
+# Ecoregion masks are computed once for each grid and saved here
+mask_cache_dir = root_dir / '../data/processed/ecoregions/masks'
+
 n = len(years) * len(ecos_id) * len(sources) * len(months)
 init_array = -9999.0 * np.ones((n,len(col_labels)))
 
@@ -106,10 +110,7 @@ with tqdm(total=niter) as pbar: # for progress bar
                 # Subset shapefile to current ecoregion
                 ecos_i = ecos.loc[ecos['ECO_ID'] == e]
 
-                mask_grd = h.mask_from_shp(ecos_i,ds)
-                mask_grd = np.repeat(mask_grd[np.newaxis,...],
-                                        ds['time'].size, 
-                                        axis = 0)
+                mask_grd = h.mask_from_shp(ecos_i,ds,cache_dir=mask_cache_dir)
 
                 x = get_monthly_averages(ds,mask_grid=mask_grd)
 
@@ -0,0 +1,5 @@
+"""
+Configuration of pytest for the tests in 'test/'. With this file in 'test/',
+pytest puts this directory on sys.path, so that the test modules can import
+the synthetic data shared by the tests from 'synthetic.py'.
+"""
@@ -0,0 +1,192 @@
+"""
+Synthetic data shared by the tests and benchmarks in 'test/'.
+
+    hourly_era5:      hourly ERA5 variables on a small grid
+    daily_grid:       daily values of one variable with a seasonal cycle
+    daily_cmip6:      daily CMIP6 tasmax or pr files on a small grid
+    daily_weather:    daily CFFDRS weather arrays
+    daily_weather_ds: daily CFFDRS weather as a Dataset
+
+'test/conftest.py' puts this directory on sys.path for pytest, and the
+benchmark scripts add it before importing this module.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+#%% Time
+def noleap_time(first_yr, nyears=1) -> pd.DatetimeIndex:
+
+    """
+    Daily time steps for nyears years of a 365-day calendar (February 29th
+    dropped).
+    """
+
+    time = pd.date_range('%d-01-01' % first_yr,
+                         '%d-12-31' % (first_yr+nyears-1))
+
+    return time[~((time.month == 2) & (time.day == 29))]
+
+def seasonal_cycle(doy) -> np.ndarray:
+
+    """
+    Seasonal cycle between -1 and 1 with the maximum in mid-July for day of
+    year doy.
+    """
+
+    return np.sin((np.asarray(doy) - 105) / 365 * 2 * np.pi)
+
+#%% ERA5
+def hourly_era5(first_day, last_day, t2m=270.0, dewpoint=5.0, tp=0.001,
+                seed=0) -> xr.Dataset:
+
+    """
+    Hourly ERA5 variables for whole days on a small grid, with latitude in
+    decreasing order as in ERA5 files. Temperature is t2m to t2m + 10 K,
+    dewpoint temperature is up to dewpoint K lower and hourly precipitation
+    has a mean of tp m.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    time = pd.date_range(first_day,'%s 23:00' % last_day,freq='H')
+    lat = np.arange(56.5,54.49,-0.25)
+    lon = np.arange(-150.5,-148.49,0.25)
+    shape = (time.size,lat.size,lon.size)
+
+    t2m = t2m + 10.0 * rng.random(shape)
+    variables = {
+        't2m': (t2m,'K'),
+        'd2m': (t2m - dewpoint * rng.random(shape),'K'),
+        'tp': (tp * rng.exponential(1.0,shape),'m'),
+        'u10': (rng.normal(0.0,4.0,shape),'m s**-1'),
+        'v10': (rng.normal(0.0,4.0,shape),'m s**-1'),
+        }
+
+    return xr.Dataset(
+        {k: (('time','latitude','longitude'),v.astype(np.float32),
+             {'units': u}) for k, (v, u) in variables.items()},
+        coords={'time': time,'latitude': lat,'longitude': lon})
+
+#%% Daily gridded data
+def daily_grid(first_yr, ny, nx, shift=0.0, scale=1.0, amplitude=5.0,
+               nyears=10, seed=0, ocean_frac=0.0, noise='gamma',
+               lats=(50.0,70.0), lons=(-160.0,-100.0), name='tasmax',
+               attrs=None) -> xr.DataArray:
+
+    """
+    Daily values for nyears years of a 365-day calendar on a ny by nx grid
+    between lats and lons: a seasonal cycle of amplitude around shift plus
+    noise times scale, where noise is 'gamma' (temperature-like) or
+    'exponential' (precipitation-like, with a larger mean in summer and
+    winter). Values are NaN over a fraction ocean_frac of grid cells (always
+    including the first cell if ocean_frac is larger than 0).
+    """
+
+    rng = np.random.default_rng(seed)
+
+    time = noleap_time(first_yr,nyears)
+    season = seasonal_cycle(time.dayofyear.values)[:,None,None]
+    shape = (time.size,ny,nx)
+
+    if noise == 'gamma':
+        noise = rng.gamma(2.0,2.0,shape)
+    else:
+        noise = rng.exponential(1.0 + season**2,shape)
+
+    vals = shift + amplitude * (1 + season) + scale * noise
+
+    if ocean_frac > 0:
+        ocean = rng.random((ny,nx)) < ocean_frac
+        ocean[0,0] = True
+        vals[:,ocean] = np.nan
+
+    return xr.DataArray(
+        vals.astype(np.float32),
+        dims=('time','lat','lon'),
+        coords={'time': time,
+                'lat': np.linspace(*lats,ny),
+                'lon': np.linspace(*lons,nx)},
+        name=name,
+        attrs={'units': 'degC'} if attrs is None else attrs)
+
+def daily_cmip6(var, first_yr, nyears=1, shift=0.0, seed=0) -> xr.Dataset:
+
+    """
+    Daily CMIP6 tasmax [K] or pr [kg m-2 s-1] of a 365-day calendar on a
+    small grid with longitudes from 0 to 360, with a seasonal cycle.
+    """
+
+    grid = dict(ny=5,nx=4,nyears=nyears,seed=seed,lats=(54.5,56.5),
+                lons=(209.5,211.0),name=var)
+
+    if var == 'tasmax':
+        da = daily_grid(first_yr,shift=268.0+shift,amplitude=12.0,
+                        attrs={'units': 'K',
+                               'standard_name': 'air_temperature'},**grid)
+    else:
+        da = daily_grid(first_yr,scale=2e-5,amplitude=0.0,
+                        noise='exponential',
+                        attrs={'units': 'kg m-2 s-1',
+                               'standard_name': 'precipitation_flux'},**grid)
+
+    return da.to_dataset()
+
+#%% Daily weather for CFFDRS
+def daily_weather(ndays, shape, seed=0, ocean_frac=0.0) -> dict:
+
+    """
+    Daily weather ('tas', 'pr', 'sfcWind', 'hurs' and 'mon' arguments of
+    'cffdrs_calc') of a 365-day calendar starting on January 1st for grid
+    cells of the given shape, with a seasonal cycle in temperature,
+    intermittent rain, and NaN values over a fraction ocean_frac of grid
+    cells (as for ocean cells in ERA5).
+    """
+
+    rng = np.random.default_rng(seed)
+    shape = (ndays,) + tuple(shape)
+
+    doy = np.arange(ndays) % 365
+    axes = (1,) * (len(shape) - 2)
+    lat = np.linspace(-1.0,1.0,shape[1]).reshape((-1,) + axes)
+
+    season = seasonal_cycle(doy).reshape((-1,1) + axes)
+    tas = 5.0 + 18.0*season - 6.0*lat + rng.normal(0.0,4.0,shape)
+
+    wet = rng.random(shape) < 0.35
+    pr = np.where(wet,rng.exponential(4.0,shape),0.0)
+
+    sfcWind = rng.gamma(2.0,7.0,shape)
+    hurs = np.clip(60.0 - 1.5*(tas-10.0) + rng.normal(0.0,15.0,shape),5,100)
+
+    ocean = rng.random(shape[1:]) < ocean_frac
+    for x in (tas,pr,sfcWind,hurs):
+        x[:,ocean] = np.nan
+
+    mon = noleap_time(2001).month.values[doy]
+
+    return {'tas': tas,'pr': pr,'sfcWind': sfcWind,'hurs': hurs,'mon': mon}
+
+def daily_weather_ds(yr=2001, ny=4, nx=5, lat0=55.0, calendar='noleap',
+                     seed=0) -> xr.Dataset:
+
+    """
+    Daily weather of daily_weather for the year yr of calendar, as the
+    'tasmax', 'pr', 'sfcWind' and 'hursmin' variables of a Dataset on a 0.25
+    degree grid starting at latitude lat0.
+    """
+
+    time = xr.cftime_range('%d-01-01' % yr,'%d-12-31' % yr,
+                           calendar=calendar)
+    weather = daily_weather(time.size,(ny,nx),seed=seed)
+    dims = ('time','lat','lon')
+
+    return xr.Dataset(
+        {'tasmax': (dims,weather['tas']),
+         'pr': (dims,weather['pr']),
+         'sfcWind': (dims,weather['sfcWind']),
+         'hursmin': (dims,weather['hurs'])},
+        coords={'time': time,
+                'lat': lat0 + 0.25 * np.arange(ny),
+                'lon': -150.0 + 0.25 * np.arange(nx)})
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the CFFDRS library in 'wildfire_analysis/cffdrs.py'.
+
+Times each sub-index function and 'cffdrs_calc' for each backend and dtype 
+on synthetic daily weather ('daily_weather' in 'test/synthetic.py', see
+'test_cffdrs_conformance.py' for the conformance tests) for several grid
+sizes, up to the full ERA5 grid for the study extent, and tracks peak memory
+of numpy allocations.
+
+Usage (from the root directory of the repository):
+    python test/test_cffdrs/benchmark_cffdrs.py [--sizes small medium full]
+        [--ndays 365] [--repeat 3]
+"""
+
+import argparse
+from importlib.util import find_spec
+from pathlib import Path
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import yaml
+
+test_dir = Path(__file__).parent
+sys.path.insert(0,str(test_dir.parent))
+
+from synthetic import daily_weather
+import wildfire_analysis.cffdrs as cffdrs
+
+root_dir = test_dir.parents[1] / 'wildfire_analysis'
+
+BACKENDS = ['numpy'] + (['numba'] if find_spec('numba') is not None else [])
+DTYPES = ['float64','float32']
+
+#%% Grid size
+def era5_grid_shape(resolution=0.25) -> tuple:
+
+    """
+    Size (lat, lon) of the ERA5 grid for the geographic extent of the study
+    in 'config.yaml'.
+    """
+
+    with open(root_dir / 'config.yaml','r') as config_file:
+        geog_lims = yaml.safe_load(config_file)['EXTENT']['geog_lims']
+
+    nlat = int(round((geog_lims[3] - geog_lims[1]) / resolution)) + 1
+    nlon = int(round((geog_lims[2] - geog_lims[0]) / resolution)) + 1
+
+    return (nlat,nlon)
+
+#%% Timing
+def timeit(func, repeat) -> tuple:
+
+    """
+    Minimum run time of func over repeat calls, and peak memory of numpy
+    allocations (in MB) in the first call.
+    """
+
+    tracemalloc.start()
+    out = func()
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    del out
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - t0)
+        del out
+
+    return (min(times),peak)
+
+def benchmark(weather: dict, repeat: int) -> list:
+
+    tas, pr = weather['tas'], weather['pr']
+    sfcWind, hurs, mon = weather['sfcWind'], weather['hurs'], weather['mon']
+    mon3d = np.broadcast_to(mon[:,None,None] - 1,tas.shape)
+
+    # Any values in the valid range can be used for timing sub-indices
+    ffmc = np.full(tas.shape,85.0)
+    dmc = np.full(tas.shape,20.0)
+    dc = np.full(tas.shape,200.0)
+    isi = np.full(tas.shape,5.0)
+    bui = np.full(tas.shape,30.0)
+    fwi = np.full(tas.shape,10.0)
+
+    funcs = {
+        'ffmc_calc': lambda: cffdrs.ffmc_calc(tas,pr,sfcWind,hurs),
+        'dmc_calc': lambda: cffdrs.dmc_calc(tas,pr,hurs,mon3d),
+        'dc_calc': lambda: cffdrs.dc_calc(tas,pr,mon3d),
+        'isi_calc': lambda: cffdrs.isi_calc(ffmc,sfcWind),
+        'bui_calc': lambda: cffdrs.bui_calc(dmc,dc),
+        'fwi_calc': lambda: cffdrs.fwi_calc(isi,bui),
+        'dsr_calc': lambda: cffdrs.dsr_calc(fwi),
+        }
+
+    for backend in BACKENDS:
+        for dtype in DTYPES:
+            # Compile numba functions for each dtype before timing
+            cffdrs.cffdrs_calc(**{k: v[:2] for k, v in weather.items()},
+                               backend=backend,dtype=dtype)
+            funcs['cffdrs_calc %s %s' % (backend,dtype)] = \
+                lambda b=backend, d=dtype: cffdrs.cffdrs_calc(
+                    **weather,backend=b,dtype=d)
+
+    results = []
+    for name, func in funcs.items():
+        seconds, peak = timeit(func,repeat)
+        results.append((name,seconds,peak))
+
+    return results
+
+#%% Run benchmark
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes',nargs='+',default=['small','medium'],
+                        choices=['small','medium','full'])
+    parser.add_argument('--ndays',type=int,default=365)
+    parser.add_argument('--repeat',type=int,default=3)
+    args = parser.parse_args()
+
+    grid_sizes = {
+        'small': (100,100),
+        'medium': (250,500),
+        'full': era5_grid_shape(),
+        }
+
+    for size in args.sizes:
+
+        ny, nx = grid_sizes[size]
+        weather = daily_weather(args.ndays,(ny,nx),ocean_frac=0.2)
+
+        print('\nTiming: %s grid (%d days x %d x %d)' % (
+            size,args.ndays,ny,nx))
+        print('-' * 56)
+        print('%-30s %10s %14s' % ('function','time [s]','peak mem [MB]'))
+
+        for name, seconds, peak in benchmark(weather,args.repeat):
+            print('%-30s %10.3f %14.1f' % (name,seconds,peak))
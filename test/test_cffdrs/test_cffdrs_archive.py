@@ -0,0 +1,54 @@
+"""
+Yearly CFFDRS archive runs ('run_archive' in 'wildfire_analysis/cffdrs.py'):
+sources computed together need to be on the same grid and 'noleap' calendar.
+
+Usage (from the root directory of the repository):
+    python -m pytest test/test_cffdrs
+"""
+
+import pytest
+
+pytest.importorskip('tqdm')
+
+from synthetic import daily_weather_ds
+import wildfire_analysis.cffdrs as cffdrs
+
+# Branches of numpy.where that are not used can divide by zero
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+#%% Synthetic data
+def write_sources(tmp_path, datasets: dict) -> dict:
+
+    sources = {}
+    for src, ds in datasets.items():
+        (tmp_path / src).mkdir()
+        (tmp_path / ('out_%s' % src)).mkdir()
+        ds.to_netcdf(tmp_path / src / 'weather_2001.nc',engine='h5netcdf')
+        sources[src] = (tmp_path / src,tmp_path / ('out_%s' % src))
+
+    (tmp_path / 'state').mkdir()
+
+    return sources
+
+#%% Tests
+def test_same_grid(tmp_path):
+
+    sources = write_sources(tmp_path,{'a': daily_weather_ds(seed=1),
+                                      'b': daily_weather_ds(seed=2)})
+    records = cffdrs.run_archive(sources,[2001],tmp_path / 'state')
+
+    assert [r['status'] for r in records] == ['done']
+    assert (tmp_path / 'out_b' / 'cffdrs_b_2001.nc').exists()
+
+@pytest.mark.parametrize('other',[
+    {'lat0': 60.0},
+    {'calendar': 'standard'},
+    ])
+def test_other_grid(tmp_path, other):
+
+    sources = write_sources(tmp_path,{'a': daily_weather_ds(seed=1),
+                                      'b': daily_weather_ds(seed=2,**other)})
+    records = cffdrs.run_archive(sources,[2001],tmp_path / 'state')
+
+    assert records[0]['status'].startswith('failed')
+    assert not (tmp_path / 'out_b' / 'cffdrs_b_2001.nc').exists()
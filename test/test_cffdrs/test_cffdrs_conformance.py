@@ -0,0 +1,114 @@
+"""
+Conformance of the CFFDRS library in 'wildfire_analysis/cffdrs.py'.
+
+Runs 'cffdrs_calc' for the 'test_fwi.csv' dataset from the 'cffdrs' CRAN
+package with each backend and dtype and checks the results against
+'cffdrs_from_py.csv' (which was checked against the R package, see
+'test_cffdrs.ipynb'). Also checks on small synthetic data that each backend
+and dtype, output selection, state continuation and the fire season mode give
+the same results as a full float64 calculation with the numpy backend. The
+numba backend is skipped if numba is not installed.
+
+Usage (from the root directory of the repository):
+    python -m pytest test/test_cffdrs
+"""
+
+from importlib.util import find_spec
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from synthetic import daily_weather
+import wildfire_analysis.cffdrs as cffdrs
+
+test_dir = Path(__file__).parent
+
+# Maximum absolute differences allowed relative to the reference values
+TOLERANCE = {'float64': 1e-8,'float32': 1e-3}
+
+# Branches of numpy.where that are not used can divide by zero
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+BACKENDS = ['numpy',pytest.param('numba',marks=pytest.mark.skipif(
+    find_spec('numba') is None,reason='numba is not installed'))]
+DTYPES = ['float64','float32']
+
+#%% Synthetic data
+def max_diff(x, y) -> float:
+
+    x, y = np.asarray(x,dtype=np.float64), np.asarray(y,dtype=np.float64)
+    np.testing.assert_array_equal(np.isnan(x),np.isnan(y))
+
+    return float(np.nanmax(np.abs(x - y))) if np.any(~np.isnan(x)) else 0.0
+
+# Large enough for several blocks of days in the numpy backend
+@pytest.fixture(scope='module')
+def weather():
+    return daily_weather(120,(20,30),ocean_frac=0.2)
+
+@pytest.fixture(scope='module')
+def reference(weather):
+    return cffdrs.cffdrs_calc(**weather)
+
+#%% Tests
+@pytest.mark.parametrize('dtype',DTYPES)
+@pytest.mark.parametrize('backend',BACKENDS)
+def test_reference(backend, dtype):
+
+    metdata = pd.read_csv(test_dir / 'test_fwi.csv',sep=';')
+    reference = pd.read_csv(test_dir / 'cffdrs_from_py.csv')
+
+    args = [metdata[k].values for k in ('temp','prec','ws','rh','mon')]
+    vals = cffdrs.cffdrs_calc(*args,backend=backend,dtype=dtype)
+
+    for k in vals:
+        assert max_diff(vals[k],reference[k]) < TOLERANCE[dtype], k
+
+@pytest.mark.parametrize('dtype',DTYPES)
+@pytest.mark.parametrize('backend',BACKENDS)
+def test_all_indices(weather, reference, backend, dtype):
+
+    vals = cffdrs.cffdrs_calc(**weather,backend=backend,dtype=dtype)
+
+    for k in reference:
+        assert max_diff(vals[k],reference[k]) < TOLERANCE[dtype], k
+
+@pytest.mark.parametrize('dtype',DTYPES)
+@pytest.mark.parametrize('backend',BACKENDS)
+def test_outputs(weather, reference, backend, dtype):
+
+    vals = cffdrs.cffdrs_calc(**weather,backend=backend,dtype=dtype,
+                              outputs=['fwi'])
+
+    assert list(vals) == ['fwi']
+    assert max_diff(vals['fwi'],reference['fwi']) < TOLERANCE[dtype]
+
+@pytest.mark.parametrize('dtype',DTYPES)
+@pytest.mark.parametrize('backend',BACKENDS)
+def test_state(weather, reference, backend, dtype):
+
+    split = weather['mon'].size // 2
+
+    def part(sl):
+        return {k: v[sl] for k, v in weather.items()}
+
+    _, state = cffdrs.cffdrs_calc(**part(slice(0,split)),backend=backend,
+                                  dtype=dtype,return_state=True)
+    vals = cffdrs.cffdrs_calc(**part(slice(split,None)),state=state,
+                              backend=backend,dtype=dtype)
+
+    assert max_diff(vals['fwi'],reference['fwi'][split:]) < TOLERANCE[dtype]
+
+@pytest.mark.parametrize('dtype',DTYPES)
+@pytest.mark.parametrize('backend',BACKENDS)
+def test_season_all_days(weather, reference, backend, dtype):
+
+    # A fire season that covers all days gives the same results as without
+    # the fire season
+    season = np.ones(weather['tas'].shape,dtype=bool)
+    vals = cffdrs.cffdrs_calc(**weather,backend=backend,dtype=dtype,
+                              season=season)
+
+    assert max_diff(vals['fwi'],reference['fwi']) < TOLERANCE[dtype]
@@ -0,0 +1,77 @@
+"""
+Fire season mode of 'cffdrs_calc' in 'wildfire_analysis/cffdrs.py': the DC
+is overwintered between fire seasons even if precipitation is missing on
+some days of the winter.
+
+Usage (from the root directory of the repository):
+    python -m pytest test/test_cffdrs
+"""
+
+import numpy as np
+import pytest
+
+from synthetic import daily_weather
+import wildfire_analysis.cffdrs as cffdrs
+
+#%% Synthetic data
+def season_weather(ncells=3, nyears=2) -> tuple:
+
+    """
+    Daily weather for nyears years of 365 days, with a fire season from May
+    to September in every grid cell.
+    """
+
+    weather = daily_weather(365*nyears,(ncells,))
+
+    doy = np.arange(365*nyears)[:,None] % 365
+    season = np.broadcast_to((doy >= 120) & (doy < 273),(doy.size,ncells))
+
+    return (*[weather[k] for k in ('tas','pr','sfcWind','hurs','mon')],
+            season)
+
+#%% Tests
+@pytest.mark.parametrize('backend',['numpy','numba'])
+def test_overwinter_missing_precip(backend):
+
+    if backend == 'numba':
+        pytest.importorskip('numba')
+
+    tas, pr, sfcWind, hurs, mon, season = season_weather()
+
+    # One missing precipitation day in the first winter of cell 0
+    pr_nan = pr.copy()
+    pr_nan[380,0] = np.nan
+
+    pr_zero = pr.copy()
+    pr_zero[380,0] = 0.0
+
+    kwargs = dict(backend=backend,outputs=['dc'],season=season,
+                  overwinter=True)
+    dc_nan = cffdrs.cffdrs_calc(tas,pr_nan,sfcWind,hurs,mon,**kwargs)['dc']
+    dc_zero = cffdrs.cffdrs_calc(tas,pr_zero,sfcWind,hurs,mon,**kwargs)['dc']
+    dc_carry = cffdrs.cffdrs_calc(tas,pr,sfcWind,hurs,mon,backend=backend,
+                                  outputs=['dc'],season=season)['dc']
+
+    # Start of the second fire season
+    t = 365 + 120
+
+    assert np.all(np.isfinite(dc_nan[t]))
+    np.testing.assert_allclose(dc_nan[season],dc_zero[season])
+    assert not np.allclose(dc_nan[t],dc_carry[t])
+
+@pytest.mark.parametrize('backend',['numpy','numba'])
+def test_no_overwinter_before_first_season(backend):
+
+    if backend == 'numba':
+        pytest.importorskip('numba')
+
+    tas, pr, sfcWind, hurs, mon, season = season_weather(nyears=1)
+
+    # Without a previous state, codes at the start of the first fire season
+    # are the start-up codes carried over the winter
+    kwargs = dict(backend=backend,outputs=['dc'],season=season)
+    dc_over = cffdrs.cffdrs_calc(tas,pr,sfcWind,hurs,mon,overwinter=True,
+                                 **kwargs)['dc']
+    dc_carry = cffdrs.cffdrs_calc(tas,pr,sfcWind,hurs,mon,**kwargs)['dc']
+
+    np.testing.assert_allclose(dc_over[season],dc_carry[season])
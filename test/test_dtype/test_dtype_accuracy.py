@@ -0,0 +1,132 @@
+"""
+Accuracy of the float32 dtype policy ('CLIMATE: dtype' in config.yaml)
+against float64 for each processing stage:
+
+    ERA5:   'process_era5' daily variables of hourly ERA5 data
+    CMIP6:  'process_cmip6' for daily tasmax and pr
+    QDM:    'quantile_delta_mapping' for daily tasmax, without grouping
+    CFFDRS: 'cffdrs_calc' on the ERA5 daily variables of both dtypes
+
+Each stage is run with dtype='float64' and dtype='float32' on the same small
+synthetic input files, and the maximum difference relative to the largest
+absolute value needs to be within TOLERANCE. Expected differences are ~1e-6
+for unit conversions and daily summaries, and larger for QDM and CFFDRS where
+differences near quantile or threshold values are propagated. QDM is only
+compared for a variable without a 'min_thresh', since random jitter of values
+under the threshold differs between runs. With monthly grouping, linear
+interpolation between quantiles and months depends on the triangulation of 
+the (quantile, month) grid, which differs between float32 and float64 
+quantiles (see 'qdm_numpy.triangle_diagonals'), so QDM is compared without
+grouping. Skipped if xclim is not installed.
+
+Usage (from the root directory of the repository):
+    python -m pytest test/test_dtype
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('xclim')
+
+from synthetic import daily_cmip6, hourly_era5
+import wildfire_analysis.cffdrs as cffdrs
+from wildfire_analysis.data_processing.process_era5 import process_era5
+from wildfire_analysis.data_processing.process_cmip6 import process_cmip6
+from wildfire_analysis.data_processing.quantile_delta_mapping \
+    import quantile_delta_mapping
+from wildfire_analysis.utils import helpers as h
+
+quantile_vals = np.array(h.get_config('QDM')['quantile_vals'])
+
+GEOLIMS = [-150.0,55.0,-149.0,56.0]
+DTYPES = ('float64','float32')
+
+# Maximum difference relative to the largest absolute value of each stage
+TOLERANCE = {'ERA5': 1e-5,'CMIP6': 1e-5,'QDM': 1e-3,'CFFDRS': 1e-3}
+
+pytestmark = pytest.mark.filterwarnings('ignore')
+
+#%% Synthetic data
+def rel_diff(x64, x32) -> float:
+
+    """
+    Maximum difference between float64 and float32 results relative to the
+    largest absolute value.
+    """
+
+    x64 = np.asarray(x64,dtype=np.float64)
+    x32 = np.asarray(x32,dtype=np.float64)
+
+    np.testing.assert_array_equal(np.isnan(x64),np.isnan(x32))
+
+    scale = np.nanmax(np.abs(x64))
+
+    return float(np.nanmax(np.abs(x64 - x32)) / scale) if scale > 0 else 0.0
+
+@pytest.fixture(scope='module')
+def era5_daily(tmp_path_factory) -> dict:
+
+    fn = tmp_path_factory.mktemp('era5') / 'era5_2001.nc'
+    hourly_era5('2001-06-01','2001-06-20',t2m=285.0,dewpoint=8.0,
+                tp=0.0005).to_netcdf(fn,engine='h5netcdf')
+
+    return {dtype: process_era5(fn,dask_load=True,geolims=GEOLIMS,
+                                dtype=dtype).load()
+            for dtype in DTYPES}
+
+#%% Tests
+def test_era5(era5_daily):
+
+    assert era5_daily['float32']['tasmax'].dtype == np.float32
+
+    for var in h.get_var_names(era5_daily['float64']):
+        assert rel_diff(era5_daily['float64'][var],
+                        era5_daily['float32'][var]) <= TOLERANCE['ERA5'], var
+
+@pytest.mark.parametrize('var',['tasmax','pr'])
+def test_cmip6(tmp_path, var):
+
+    fn = tmp_path / ('%s_day_2015.nc' % var)
+    daily_cmip6(var,2015).to_netcdf(fn,engine='h5netcdf')
+
+    ds = {dtype: process_cmip6([fn],geolims=GEOLIMS,dtype=dtype).load()
+          for dtype in DTYPES}
+
+    assert ds['float32'][var].dtype == np.float32
+    assert rel_diff(ds['float64'][var],ds['float32'][var]) \
+        <= TOLERANCE['CMIP6']
+
+def test_qdm(tmp_path):
+
+    src = {}
+    for name, first_yr, shift, seed in (('ref',1980,2.0,1),
+                                         ('hst',1980,0.0,2),
+                                         ('sim',2040,3.0,3)):
+        da = daily_cmip6('tasmax',first_yr,nyears=10,shift=shift,seed=seed)
+        da['tasmax'] = (da['tasmax'] - 273.15).assign_attrs(units='degC')
+        src[name] = [tmp_path / ('tasmax_%s.nc' % name)]
+        da.to_netcdf(src[name][0],engine='h5netcdf')
+
+    sim_ba = {dtype: quantile_delta_mapping(
+                  src['ref'],src['hst'],src['sim'],
+                  dask_load=True,
+                  kind='+',
+                  nquantiles=quantile_vals,
+                  group='time',
+                  interp='linear',
+                  dtype=dtype)[-1]
+              for dtype in DTYPES}
+
+    assert rel_diff(sim_ba['float64'],sim_ba['float32']) <= TOLERANCE['QDM']
+
+def test_cffdrs(era5_daily):
+
+    vals = {}
+    for dtype, ds in era5_daily.items():
+        vals[dtype] = cffdrs.cffdrs_calc(
+            ds['tasmax'].values,ds['pr'].values,ds['sfcWind'].values,
+            ds['hursmin'].values,ds['time'].dt.month.values,dtype=dtype)
+
+    for k in vals['float64']:
+        assert rel_diff(vals['float64'][k],vals['float32'][k]) \
+            <= TOLERANCE['CFFDRS'], k
@@ -0,0 +1,68 @@
+"""
+Tests of the daily summaries of hourly ERA5 data in
+'wildfire_analysis/data_processing/process_era5.py'.
+
+Synthetic hourly ERA5 files are read with 'process_era5'. The single-pass 
+daily reducer ('_calc_daily') needs to be used for whole days of hourly data,
+including leap years where February 29th is dropped when reading, and needs 
+to give the same results as the daily summaries of each variable with
+resample. Skipped if xclim is not installed.
+
+Usage (from the root directory of the repository):
+    python -m pytest test/test_era5
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('xclim')
+
+from synthetic import hourly_era5
+from wildfire_analysis.data_processing import process_era5 as pe
+from wildfire_analysis.utils import helpers as h
+
+GEOLIMS = [-150.0,55.0,-149.0,56.0]
+
+#%% Tests
+@pytest.mark.parametrize('yr',[2019,2020])
+def test_whole_days(yr):
+
+    ds = hourly_era5('%d-01-01' % yr,'%d-12-31' % yr)
+    ds = h.drop_leap_days(ds)
+
+    assert pe._is_whole_days(ds['time'])
+    assert not pe._is_whole_days(ds['time'].isel(time=slice(1,-23)))
+    assert not pe._is_whole_days(ds['time'].isel(time=slice(12,-12)))
+
+@pytest.mark.filterwarnings('ignore')
+@pytest.mark.parametrize('dask_load',[False,True])
+def test_daily_leap_year(tmp_path, monkeypatch, dask_load):
+
+    fn = tmp_path / 'era5_2020.nc'
+    hourly_era5('2020-02-26','2020-03-03').to_netcdf(fn,engine='h5netcdf')
+
+    calls = []
+    calc_daily = pe._calc_daily
+
+    def spy(*args,**kwargs):
+        calls.append(1)
+        return calc_daily(*args,**kwargs)
+
+    monkeypatch.setattr(pe,'_calc_daily',spy)
+    fused = pe.process_era5(fn,dask_load=dask_load,geolims=GEOLIMS,
+                            dtype='float64')
+
+    assert len(calls) == 1
+
+    # Daily summaries of each variable with resample
+    monkeypatch.setattr(pe,'_is_whole_days',lambda time: False)
+    resampled = pe.process_era5(fn,dask_load=dask_load,geolims=GEOLIMS,
+                                dtype='float64')
+
+    assert fused.sizes['time'] == 6
+    assert not ((fused['time'].dt.month == 2) & 
+                (fused['time'].dt.day == 29)).any()
+
+    for k in ('tasmax','pr','sfcWind','hursmin'):
+        np.testing.assert_allclose(fused[k].values,resampled[k].values,
+                                   rtol=1e-10)
@@ -0,0 +1,77 @@
+"""
+Tests of the index of active grid cells in 'wildfire_analysis/utils/helpers.py'
+('cell_index', 'stack_cells' and 'unstack_cells'). A saved index is only
+reused for the same mask and grid, and data on another grid cannot be
+stacked with it.
+
+Usage (from the root directory of the repository):
+    python -m pytest test/test_helpers
+"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from wildfire_analysis.utils import helpers as h
+
+#%% Synthetic data
+def grid_data(ny=4, nx=5, lat0=55.0) -> xr.DataArray:
+
+    lat = lat0 + 0.25 * np.arange(ny)
+    lon = -150.0 + 0.25 * np.arange(nx)
+
+    return xr.DataArray(
+        np.arange(3*ny*nx,dtype=np.float64).reshape(3,ny,nx),
+        dims=('time','lat','lon'),
+        coords={'time': np.arange(3),'lat': lat,'lon': lon})
+
+#%% Tests
+def test_round_trip():
+
+    da = grid_data()
+    mask = np.zeros((4,5),dtype=bool)
+    mask[1:3,2:4] = True
+
+    index = h.cell_index(mask,da)
+    cells = h.stack_cells(da,index)
+
+    assert cells.sizes['cell'] == 4
+
+    grid = h.unstack_cells(cells,index)
+
+    np.testing.assert_array_equal(grid.values[:,mask],da.values[:,mask])
+    assert np.isnan(grid.values[:,~mask]).all()
+
+def test_saved_index_rebuilt_for_new_mask(tmp_path):
+
+    da = grid_data()
+    index_fn = tmp_path / 'cells.nc'
+
+    mask = np.zeros((4,5),dtype=bool)
+    mask[0,:2] = True
+
+    assert h.cell_index(mask,da,index_fn=index_fn).sizes['cell'] == 2
+    assert h.cell_index(mask,da,index_fn=index_fn).sizes['cell'] == 2
+
+    full = np.ones((4,5),dtype=bool)
+
+    assert h.cell_index(full,da,index_fn=index_fn).sizes['cell'] == 20
+    assert h.load_cell_index(index_fn).sizes['cell'] == 20
+
+def test_saved_index_rebuilt_for_new_grid(tmp_path):
+
+    index_fn = tmp_path / 'cells.nc'
+    mask = np.ones((2,2),dtype=bool)
+
+    h.cell_index(mask,grid_data(2,2),index_fn=index_fn)
+    index = h.cell_index(mask,grid_data(2,2,lat0=60.0),index_fn=index_fn)
+
+    np.testing.assert_array_equal(index['lat'].values,[60.0,60.25])
+
+def test_stack_other_grid():
+
+    mask = np.ones((2,2),dtype=bool)
+    index = h.cell_index(mask,grid_data(2,2))
+
+    with pytest.raises(Exception,match='grid of the cell index'):
+        h.stack_cells(grid_data(2,2,lat0=60.0),index)
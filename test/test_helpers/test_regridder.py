@@ -0,0 +1,33 @@
+"""
+Tests of 'Regridder' in 'wildfire_analysis/utils/helpers.py': dask arrays
+chunked along lat or lon give the same results as numpy arrays.
+
+Usage (from the root directory of the repository):
+    python -m pytest test/test_helpers
+"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from wildfire_analysis.utils import helpers as h
+
+#%% Tests
+@pytest.mark.parametrize('method',['linear','conservative'])
+def test_chunked_grid(method):
+
+    rng = np.random.default_rng(0)
+
+    da = xr.DataArray(
+        rng.random((4,10,12)),
+        dims=('time','lat','lon'),
+        coords={'lat': np.linspace(50.0,60.0,10),
+                'lon': np.linspace(-150.0,-140.0,12)})
+
+    target = (np.linspace(-149.0,-141.0,7),np.linspace(51.0,59.0,6))
+    regridder = h.Regridder(da,target,method=method)
+
+    out = regridder(da.chunk({'time': 2,'lat': 5,'lon': 6}))
+
+    assert out.chunks is not None
+    np.testing.assert_allclose(out.values,regridder(da).values)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Timing of the numpy quantile delta mapping engine
+('wildfire_analysis/data_processing/qdm_numpy.py') and
+xclim.sdba.QuantileDeltaMapping.
+
+Both engines are trained and applied to the same synthetic daily data (30
+years of reference, historical and simulation data from 'daily_grid' in
+'test/synthetic.py', see 'test_qdm_engines.py' for the conformance tests) with monthly grouping, the quantile_vals from 
+config.yaml and linear interpolation, for additive ('+') and multiplicative
+('*') adjustment. The time of each engine and the maximum difference between
+engines relative to the largest absolute value of the results are reported.
+
+Usage (from the root directory of the repository):
+    python test/test_qdm/benchmark_qdm_engines.py [--ny 20] [--nx 30]
+        [--workers 1]
+"""
+
+import argparse
+from pathlib import Path
+import sys
+import time
+
+import dask
+import numpy as np
+from xclim.sdba import QuantileDeltaMapping
+
+sys.path.insert(0,str(Path(__file__).parents[1]))
+
+from synthetic import daily_grid
+from test_qdm_engines import run_engine
+from wildfire_analysis.data_processing.qdm_numpy import NumpyQDM
+from wildfire_analysis.utils import helpers as h
+
+#%% Timing
+def timed_engine(cls, ref, hst, sim, kind) -> tuple:
+
+    t0 = time.perf_counter()
+    out = run_engine(cls,ref,hst,sim,kind)
+
+    return (out,time.perf_counter() - t0)
+
+def benchmark(ny, nx, workers) -> None:
+
+    chunks = {'time': -1,'lat': max(ny // 2,1),'lon': max(nx // 2,1)}
+
+    for kind in ('+','*'):
+
+        ref = daily_grid(1980,ny,nx,2.0,1.0,nyears=30,seed=1,
+                         ocean_frac=0.2)
+        hst = daily_grid(1980,ny,nx,0.0,1.3,nyears=30,seed=2,
+                         ocean_frac=0.2)
+        sim = daily_grid(2040,ny,nx,1.0,1.5,nyears=30,seed=3,
+                         ocean_frac=0.2)
+
+        ref, hst, sim = [x.chunk(chunks) for x in (ref,hst,sim)]
+
+        with dask.config.set(h.process_scheduler(workers)):
+            out_xclim, t_xclim = timed_engine(QuantileDeltaMapping,ref,hst,
+                                              sim,kind)
+            out_numpy, t_numpy = timed_engine(NumpyQDM,ref,hst,sim,kind)
+
+        rel_diff = (np.nanmax(np.abs(out_xclim - out_numpy)) /
+                    np.nanmax(np.abs(out_xclim)))
+
+        print('  kind %s  time [s]  xclim %.1f  numpy %.1f  '
+              'relative diff %.2e' % (kind,t_xclim,t_numpy,rel_diff))
+
+#%% Run benchmark
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--ny',type=int,default=20)
+    parser.add_argument('--nx',type=int,default=30)
+    parser.add_argument('--workers',type=int,default=1)
+    args = parser.parse_args()
+
+    print('\nnumpy vs xclim quantile delta mapping')
+    print('-------------------------------------')
+
+    benchmark(args.ny,args.nx,args.workers)
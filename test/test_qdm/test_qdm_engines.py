@@ -0,0 +1,92 @@
+"""
+Conformance of the numpy quantile delta mapping engine
+('wildfire_analysis/data_processing/qdm_numpy.py') with
+xclim.sdba.QuantileDeltaMapping (version 0.40, see environment.yaml).
+
+Both engines are trained and applied to the same small synthetic daily data
+(reference, historical and simulation data with a seasonal cycle and NaN
+values over some grid cells) with the quantile_vals from config.yaml and
+linear interpolation. Results need to be the same to floating point
+precision of the data (float32). Skipped if xclim is not installed.
+
+Usage (from the root directory of the repository):
+    python -m pytest test/test_qdm
+"""
+
+import numpy as np
+import pytest
+
+sdba = pytest.importorskip('xclim.sdba')
+
+from synthetic import daily_grid
+from wildfire_analysis.data_processing.qdm_numpy import NumpyQDM
+from wildfire_analysis.utils import helpers as h
+
+quantile_vals = np.array(h.get_config('QDM')['quantile_vals'])
+
+# Maximum difference relative to the largest absolute value of the results
+TOLERANCE = 1e-5
+
+#%% Synthetic data
+def synthetic_inputs(ny=3, nx=4) -> tuple:
+
+    ref = daily_grid(1980,ny,nx,2.0,1.0,seed=1,ocean_frac=0.2)
+    hst = daily_grid(1980,ny,nx,0.0,1.3,seed=2,ocean_frac=0.2)
+    sim = daily_grid(2040,ny,nx,1.0,1.5,seed=3,ocean_frac=0.2)
+
+    return (ref,hst,sim)
+
+def run_engine(cls, ref, hst, sim, kind, group='time.month',
+               extrapolation='constant') -> np.ndarray:
+
+    QDM = cls.train(ref,hst,group=group,nquantiles=quantile_vals,kind=kind)
+    out = QDM.adjust(sim,interp='linear',extrapolation=extrapolation)
+
+    return out.transpose(*sim.dims).values
+
+def assert_same(ref, hst, sim, kind, **kwargs) -> None:
+
+    out_xclim = run_engine(sdba.QuantileDeltaMapping,ref,hst,sim,kind,
+                           **kwargs)
+    out_numpy = run_engine(NumpyQDM,ref,hst,sim,kind,**kwargs)
+
+    np.testing.assert_array_equal(np.isnan(out_xclim),np.isnan(out_numpy))
+
+    rel_diff = (np.nanmax(np.abs(out_xclim - out_numpy)) /
+                np.nanmax(np.abs(out_xclim)))
+
+    assert rel_diff <= TOLERANCE
+
+#%% Tests
+@pytest.mark.filterwarnings('ignore')
+@pytest.mark.parametrize('kind',['+','*'])
+@pytest.mark.parametrize('group',['time.month','time'])
+def test_engines_agree(kind, group):
+
+    assert_same(*synthetic_inputs(),kind,group=group)
+
+@pytest.mark.filterwarnings('ignore')
+def test_engines_agree_nan_extrapolation():
+
+    ref, hst, sim = synthetic_inputs()
+
+    # Simulation values outside the range of historical values
+    sim = (sim * 1.5).assign_attrs(sim.attrs)
+
+    assert_same(ref,hst,sim,'+',extrapolation='nan')
+
+@pytest.mark.filterwarnings('ignore')
+def test_engines_agree_nan_factors():
+
+    ref, hst, sim = synthetic_inputs()
+
+    # Zero values on 40% of days in one cell give NaN adjustment factors
+    # (0 / 0) for the lowest quantiles
+    zeros = np.random.default_rng(4).random(ref['time'].size) < 0.4
+    ref[zeros,1,1] = 0.0
+    hst[zeros,1,1] = 0.0
+
+    af = NumpyQDM.train(ref,hst,nquantiles=quantile_vals,kind='*').ds['af']
+    assert af[1,1].isnull().any() and not af[1,1].isnull().all()
+
+    assert_same(ref,hst,sim,'*')
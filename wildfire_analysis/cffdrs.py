@@ -21,16 +21,143 @@ Wang, X. et al. “cffdrs: An R package for the Canadian Forest Fire
 DangerRating System.” Ecological Processes, 6(1), 5. 
 https://ecologicalprocesses.springeropen.com/articles/10.1186/s13717-017-0070-z
 
+Two backends are available in 'cffdrs_calc'. The 'numpy' backend first 
+evaluates all terms that only depend on daily weather in vectorized passes, 
+then steps through time carrying forward only the FFMC, DMC and DC, and 
+finally computes ISI, BUI, FWI and DSR in vectorized passes. The 'numba' 
+backend compiles a single fused kernel that runs the full time recurrence for 
+each grid cell, in parallel over grid cells, and requires the optional numba
+package, which is only imported the first time the backend is used. Both 
+backends can restrict the calculations to the fire season of each grid cell 
+(see 'fire_season_mask'), carrying over or overwintering the moisture codes 
+in between fire seasons.
+
 """
 
-import numpy as np
+import os
+import pathlib
+import threading
 import warnings
 
+import numpy as np
+import xarray as xr
+
 warnings.filterwarnings('ignore')
 
+# Parameters for effective daylight hours (DMC) and day length adjustment 
+# factors (DC) for each month
+_Le = np.array([6.5, 7.5, 9.0, 12.8, 13.9, 13.9, 12.4, 10.9, 9.4, 8.0, 7.0, 6.0])
+_Lf = np.array([-1.6,-1.6,-1.6,0.9,3.8,5.8,6.4,5.0,2.4,0.4,-1.6,-1.6])
+
+# Functions of the compiled backend, plain python functions until
+# '_numba_compile' replaces them with numba-compiled versions. The loop over
+# blocks of grid cells in the parallel kernel uses numba.prange once compiled.
+_NUMBA_FUNCS = ('_pow','_ffmc_scalar','_dmc_scalar','_dc_scalar',
+                '_dc_overwinter_scalar','_isi_scalar','_bui_scalar',
+                '_fwi_scalar','_cffdrs_cells')
+_NUMBA_PARALLEL_FUNCS = ('_cffdrs_kernel',)
+_prange = range
+_numba_lock = threading.Lock()
+_numba_compiled = False
+
+# Number of grid cells processed together by each thread in the numba kernel
+_BLOCK_SIZE = 256
+
+# Approximate number of array elements (days x grid cells) evaluated together 
+# in each vectorized pass of the numpy backend
+_DAY_BLOCK_ELEMENTS = 2**15
+
+# Fraction of the fall moisture deficit carried over winter, and effectiveness
+# of winter precipitation in recharging moisture, used to overwinter the DC 
+# (Lawson and Armitage 2008)
+_OVERWINTER_A = 0.75
+_OVERWINTER_B = 0.75
+
+# CFFDRS indices in the order returned by 'cffdrs_calc', and the indices each 
+# one is calculated from
+_CFFDRS_VARS = ('ffmc','dmc','dc','isi','bui','fwi','dsr')
+_CFFDRS_DEPS = {
+    'ffmc': (),
+    'dmc': (),
+    'dc': (),
+    'isi': ('ffmc',),
+    'bui': ('dmc','dc'),
+    'fwi': ('isi','bui'),
+    'dsr': ('fwi',),
+    }
+
 # ----------------------------------------------------------------------------
 # Fine Fuel Moisture Code
 # ----------------------------------------------------------------------------
+# The moisture code calculations are split into two parts. The '_weather' 
+# functions compute every term that only depends on the current day's weather,
+# so they can be evaluated for many days at once. The '_step' functions then
+# carry the previous day's code forward using these precomputed terms.
+
+def _ffmc_weather(tas, pr, sfcWind, hurs) -> dict:
+
+    ro = np.asarray(pr)
+
+    rain = ro > 0.5
+    rf = np.where(rain,ro - 0.5,ro) # ................................... Eq. 2
+
+    # Rainfall terms of Eq. 3a and 3b that don't depend on mo
+    rf_a = 42.5 * rf * (1.0-np.exp(-6.93/rf))
+    rf_b = 0.0015 * np.sqrt(rf)
+
+    # Terms shared by Eq. 4-7, only computed once
+    e_hurs = np.exp((hurs-100.0)/10.0)
+    t_hurs = 0.18 * (21.1-tas) * (1.0 - 1.0/np.exp(hurs*0.115))
+    k_tas = 0.581 * np.exp(0.0365*tas)
+    ws_sqrt = np.sqrt(sfcWind)
+    h_d = hurs/100.0
+    h_w = (100.0-hurs) / 100.0
+
+    Ed = 0.942 * hurs**0.679 + 11.0*e_hurs + t_hurs # ................... Eq. 4
+    Ew = 0.618 * hurs**0.753 + 10.0*e_hurs + t_hurs # ................... Eq. 5
+
+    ko = 0.424 * (1.0 - h_d**1.7) \
+         + 0.0694 * ws_sqrt * (1.0 - np.square(np.square(np.square(h_d)))) 
+    kd = ko * k_tas # ....................................... Eq. 6a and Eq. 6b
+
+    k1 = 0.424 * (1.0 - h_w**1.7) \
+         + 0.0694 * ws_sqrt * (1.0 - np.square(np.square(np.square(h_w))))
+    kw = k1 * k_tas # ....................................... Eq. 7a and Eq. 7b
+
+    return {
+        'rain': rain,
+        'rf_a': rf_a,
+        'rf_b': rf_b,
+        'Ed': Ed,
+        'Ew': Ew,
+        'fd': 10**-kd,
+        'fw': 10**-kw,
+        }
+
+def _ffmc_step(ffmc0, rain, rf_a, rf_b, Ed, Ew, fd, fw) -> np.ndarray:
+
+    mo = 147.2 * (101.0-ffmc0) / (59.5+ffmc0) # ......................... Eq. 1
+
+    mr_rain = mo + rf_a * np.exp(-100.0/(251.0-mo)) # .................. Eq. 3a
+
+    mr = np.where(rain & (mo <= 150.0),mr_rain,mo)
+    mr = np.where(rain & (mo > 150.0),
+        mr_rain + rf_b * (mo-150.0)**2.0, # ............................ Eq. 3b
+        mr)
+
+    mr = np.where(mr > 250.0,250.0,mr) # mr can't be greater than 250
+
+    m = np.where(mr > Ed,Ed + (mr-Ed) * fd,mr) # ........................ Eq. 8
+    m = np.where(mr < Ew,Ew - (Ew-mr) * fw,m) # ......................... Eq. 9
+
+    ffmc = 59.5 * (250.0-m) / (147.2+m) # .............................. Eq. 10
+
+    # Constrain ffmc values to a max of 101.0. Could be theoretically higher 
+    # than this when moisture content (m) is less than 0.05.
+    ffmc = np.where(ffmc > 101.0,101.0,ffmc)
+
+    return ffmc
+
 def ffmc_calc(tas, pr, sfcWind, hurs, ffmc0: np.ndarray=85.0) -> np.ndarray:
 
     """
@@ -60,56 +187,48 @@ def ffmc_calc(tas, pr, sfcWind, hurs, ffmc0: np.ndarray=85.0) -> np.ndarray:
         A numpy.ndarray with fine fuel moisture code output
     """    
 
-    ro = np.copy(pr) # Copy precip data into new numpy array
+    ffmc = _ffmc_step(ffmc0,**_ffmc_weather(tas,pr,sfcWind,hurs))
 
-    mo = 147.2 * (101.0-ffmc0) / (59.5+ffmc0) # ......................... Eq. 1
-    
-    rf = np.copy(ro)
-    rf[ro > 0.5] = rf[ro > 0.5] - 0.5 # ................................. Eq. 2
-
-    mr = np.copy(mo)
-    mr = np.where(
-        (ro > 0.5) & (mo <= 150.0),
-        mo + 42.5 * rf * (np.exp(-100.0/(251.0-mo)))
-        * (1.0-np.exp(-6.93/rf)), # .................................... Eq. 3a
-        mr)
-    mr = np.where(
-        (ro > 0.5) & (mo > 150.0),
-        mo + 42.5 * rf * (np.exp(-100.0/(251.0-mo)))
-        * (1.0 - np.exp(-6.93/rf))
-        + 0.0015 * (mo-150.0)**2.0 * np.sqrt(rf), # .................... Eq. 3b
-        mr)
-    
-    mr[mr > 250.0] = 250.0 # mr can't be greater than 250
-    
-    Ed = 0.942 * hurs**0.679 + 11.0*np.exp((hurs-100.0)/10.0) \
-         + 0.18 * (21.1-tas) * (1.0 - 1.0/np.exp(hurs*0.115)) # ......... Eq. 4   
-    Ew = 0.618 * hurs**0.753 + 10.0*np.exp((hurs-100.0)/10.0) \
-         + 0.18 * (21.1-tas) * (1.0 - 1.0/np.exp(hurs*0.115)) # ......... Eq. 5
+    return ffmc[...]
 
-    ko = 0.424 * (1.0 - (hurs/100.0)**1.7) \
-         + 0.0694 * np.sqrt(sfcWind) * (1.0 - (hurs/100.0)**8.0) # ..... Eq. 6a
-    kd = ko * 0.581 * np.exp(0.0365*tas) # ............................. Eq. 6b
+# ----------------------------------------------------------------------------
+# Duff Moisture Code
+# ----------------------------------------------------------------------------
+def _dmc_weather(tas, pr, hurs, Le) -> dict:
 
-    k1 = 0.424*(1.0 - ((100.0-hurs) / 100.0)**1.7) + 0.0694 \
-         * np.sqrt(sfcWind) * (1.0 - ((100.0-hurs) / 100.0)**8) #....... Eq. 7a
-    kw = k1 * 0.581 * np.exp(0.0365*tas) # ............................. Eq. 7b
+    ro = np.asarray(pr)
+    tas = np.where(tas < -1.1,-1.1,tas) # tas values can't be < -1.1
 
-    m = np.copy(mr)
-    m = np.where(mr > Ed,Ed + (mr-Ed) * 10**-kd,m) # .................... Eq. 8
-    m = np.where(mr < Ew,Ew - (Ew-mr) * 10**-kw,m) # .................... Eq. 9
+    rain = ro > 1.5
+    re = np.where(rain,0.92*ro - 1.27,ro) # ............................ Eq. 11
 
-    ffmc = 59.5 * (250.0-m) / (147.2+m) # .............................. Eq. 10
+    K = 1.894 * (tas+1.1) * (100.0-hurs) * Le*1e-06 # .................. Eq. 16
 
-    # Constrain ffmc values to a max of 101.0. Could be theoretically higher 
-    # than this when moisture content (m) is less than 0.05.
-    ffmc = np.where(ffmc > 101.0,101.0,ffmc)
+    return {
+        'rain': rain,
+        're': re,
+        'K': K,
+        }
 
-    return ffmc[...]
+def _dmc_step(dmc0, rain, re, K) -> np.ndarray:
+
+    Po = np.asarray(dmc0)
+
+    Mo = 20.0 + np.exp(5.6348 - Po/43.43) # ............................ Eq. 12
+
+    b = 100.0 / (0.5 + 0.3*Po) # ...................................... Eq. 13a
+    b = np.where((Po > 33.0) & (Po <= 65.0),14 - 1.3*np.log(Po),b) #..  Eq. 13b
+    b = np.where(Po > 65.0,6.2*np.log(Po) - 17.2,b) # ................. Eq. 13c          
+
+    Mr = np.where(rain,Mo + 1000.0 * re/(48.77 + b*re),0.0) # .......... Eq. 14
+    Pr = np.where(rain,244.72 - 43.43 * np.log(Mr-20.0),Po) # .......... Eq. 15
+    
+    Pr = np.where(Pr < 0.0,0.0,Pr)
+
+    dmc = Pr + 100.0*K # ............................................... Eq. 17
+
+    return dmc
 
-# ----------------------------------------------------------------------------
-# Duff Moisture Code
-# ----------------------------------------------------------------------------
 def dmc_calc(tas, pr, hurs, mon, dmc0: np.ndarray=6.0) -> np.ndarray:
 
     """
@@ -137,36 +256,44 @@ def dmc_calc(tas, pr, hurs, mon, dmc0: np.ndarray=6.0) -> np.ndarray:
         A numpy.ndarray with fine duff moisture code output
     """      
 
-    # Initialize parameters
-    ro = np.copy(pr) # Re-name pr as ro
-    Po = np.copy(dmc0) # Re-name previous days DMC as Po
-    tas = np.where(tas < -1.1,-1.1,tas) # tas values can't be < -1.1
+    dmc = _dmc_step(dmc0,**_dmc_weather(tas,pr,hurs,_Le[mon]))
 
-    # Parameters for effective daylight hours
-    Le = np.array([
-        6.5, 7.5, 9.0, 12.8, 13.9, 13.9, 12.4, 10.9, 9.4, 8.0, 7.0, 6.0])
+    return dmc[...]
 
-    re = np.where(ro > 1.5,0.92*ro - 1.27,ro) # ........................ Eq. 11
-    Mo = 20.0 + np.exp(5.6348 - Po/43.43) # ............................ Eq. 12
+# ----------------------------------------------------------------------------
+# Drought Code
+# ----------------------------------------------------------------------------
+def _dc_weather(tas, pr, Lf) -> dict:
 
-    b = 100.0 / (0.5 + 0.3*Po) # ...................................... Eq. 13a
-    b = np.where((Po > 33.0) & (Po <= 65.0),14 - 1.3*np.log(Po),b) #..  Eq. 13b
-    b = np.where(Po > 65.0,6.2*np.log(Po) - 17.2,b) # ................. Eq. 13c          
+    ro = np.asarray(pr)
+    tas = np.where(tas < -2.8,-2.8,tas) # tas values can't be < -2.8
+
+    rd = np.where(ro > 2.8,0.83*ro - 1.27,0.0) # ....................... Eq. 18
 
-    Mr = np.where(ro > 1.5,Mo + 1000.0 * re/(48.77 + b*re),0.0) # ...... Eq. 14
-    Pr = np.where(ro > 1.5,244.72 - 43.43 * np.log(Mr-20.0),Po) # ...... Eq. 15
+    V = 0.36 * (tas+2.8) + Lf # ........................................ Eq. 22
+    V = np.where(V < 0.0,0.0,V)
+
+    return {
+        'dry': ro <= 2.8,
+        'rd': rd,
+        'V': V,
+        }
+
+def _dc_step(dc0, dry, rd, V) -> np.ndarray:
+
+    Do = np.asarray(dc0)
+
+    Qo = 800.0 * np.exp(-1 * Do/400.0) # ............................... Eq. 19
+    Qr = Qo + 3.937*rd # ............................................... Eq. 20
+    Dr = 400.0 * np.log(800.0/Qr) # .................................... Eq. 21
     
-    Pr[Pr < 0.0] = 0.0
-        
-    K = 1.894 * (tas+1.1) * (100.0-hurs) * Le[mon]*1e-06 # ............. Eq. 16
+    Dr = np.where(dry,Do,Dr)
+    Dr = np.where(Dr < 0.0,0.0,Dr)
 
-    dmc = Pr + 100.0*K # ............................................... Eq. 17
+    dc = Dr + V/2 # .................................................... Eq. 23
 
-    return dmc[...]
+    return dc
 
-# ----------------------------------------------------------------------------
-# Drought Code
-# ----------------------------------------------------------------------------
 def dc_calc(tas, pr, mon, dc0: np.ndarray=15.0) -> np.ndarray:
 
     """
@@ -192,28 +319,112 @@ def dc_calc(tas, pr, mon, dc0: np.ndarray=15.0) -> np.ndarray:
         A numpy.ndarray with fine drought code output
     """       
 
-    ro = np.copy(pr)
-    Do = np.copy(dc0)
+    dc = _dc_step(dc0,**_dc_weather(tas,pr,_Lf[mon]))
+    
+    return dc[...]
 
-    tas[tas < -2.8] = -2.8
+def dc_overwinter(dc_fall, rw, a: float=_OVERWINTER_A, 
+                  b: float=_OVERWINTER_B) -> np.ndarray:
 
-    Lf = np.array([-1.6,-1.6,-1.6,0.9,3.8,5.8,6.4,5.0,2.4,0.4,-1.6,-1.6])
+    """
+    Description
+    -----------
+    Computes the Drought Code at the start of the fire season from the last 
+    Drought Code of the previous fire season and precipitation over the 
+    winter (Lawson and Armitage 2008).
 
-    rd = np.where(ro > 2.8,0.83*ro - 1.27,0.0) # ....................... Eq. 18
+    Parameters
+    ----------
+    dc_fall: float or numpy.ndarray
+        Drought Code at the end of the previous fire season
+    rw: float or numpy.ndarray
+        Total precipitation between fire seasons in mm
+    a: float, optional
+        Fraction of the fall moisture deficit carried over winter. 
+        Default is 0.75.
+    b: float, optional
+        Effectiveness of winter precipitation in recharging moisture. 
+        Default is 0.75.
 
-    Qo = 800.0 * np.exp(-1 * Do/400.0) # ............................... Eq. 19
-    Qr = Qo + 3.937*rd # ............................................... Eq. 20
-    Dr = 400.0 * np.log(800.0/Qr) # .................................... Eq. 21
-    
-    Dr = np.where(ro <= 2.8,Do,Dr)
-    Dr[Dr < 0.0] = 0.0
+    Returns
+    -------
+    numpy.ndarray
+        Drought Code at the start of the fire season, at least 15.0
 
-    V = 0.36 * (tas+2.8) + Lf[mon] # ................................... Eq. 22
-    V = np.where(V < 0.0,0.0,V)
-    
-    dc = Dr + V/2 # .................................................... Eq. 23
-    
-    return dc[...]
+    References
+    ----------
+    Lawson, B.D. and O.B. Armitage. Weather guide for the Canadian Forest Fire
+    Danger Rating System. 2008. Natural Resources Canada, Canadian Forest 
+    Service, Northern Forestry Centre, Edmonton, AB. 84 p.
+    """
+
+    Qf = 800.0 * np.exp(-np.asarray(dc_fall)/400.0)
+    Qs = a*Qf + b*(3.94*np.asarray(rw))
+    DCs = 400.0 * np.log(800.0/Qs)
+
+    return np.where(DCs < 15.0,15.0,DCs)[...]
+
+# -----------------------------------------------------------------------------
+# Fire season
+# -----------------------------------------------------------------------------
+def fire_season_mask(tas, start_temp: float=12.0, stop_temp: float=5.0, 
+                     ndays: int=3, active0=False) -> np.ndarray:
+
+    """
+    Description
+    -----------
+    Determines which days are within the fire season for each grid cell 
+    using consecutive-day temperature criteria (Wotton and Flannigan 1993).
+    The fire season starts on the last of ndays consecutive days with 
+    maximum temperature above start_temp and ends on the last of ndays 
+    consecutive days with maximum temperature below stop_temp.
+
+    Parameters
+    ----------
+    tas: numpy.ndarray
+        Daily maximum near-surface air temperature in degrees Celsius, with 
+        time as the first axis
+    start_temp: float, optional
+        Temperature threshold for the start of the fire season. Default is 
+        12.0 degC.
+    stop_temp: float, optional
+        Temperature threshold for the end of the fire season. Default is 
+        5.0 degC.
+    ndays: int, optional
+        Number of consecutive days needed to start or end the fire season. 
+        Default is 3.
+    active0: bool or numpy.ndarray, optional
+        Whether each grid cell is in the fire season on the day before the 
+        first day. Default is False, i.e. the series starts in winter.
+
+    Returns
+    -------
+    numpy.ndarray(dtype=bool)
+        True on days within the fire season, same shape as tas
+
+    References
+    ----------
+    Wotton, B.M. and M.D. Flannigan. Length of the fire season in a changing
+    climate. 1993. The Forestry Chronicle, 69(2), 187-192.
+    """
+
+    tas = np.asarray(tas)
+
+    active = np.empty(tas.shape,dtype=bool)
+    active_t = np.broadcast_to(np.asarray(active0,dtype=bool),
+                               tas.shape[1:]).copy()
+    nwarm = np.zeros(tas.shape[1:],dtype=int)
+    ncold = np.zeros(tas.shape[1:],dtype=int)
+
+    for t in range(tas.shape[0]):
+
+        nwarm = np.where(tas[t] > start_temp,nwarm+1,0)
+        ncold = np.where(tas[t] < stop_temp,ncold+1,0)
+
+        active_t = np.where(active_t,ncold < ndays,nwarm >= ndays)
+        active[t] = active_t
+
+    return active
 
 # -----------------------------------------------------------------------------
 # Initial Spread Index
@@ -354,6 +565,530 @@ def dsr_calc(fwi) -> np.ndarray:
 
     return dsr[...]
 
+# -----------------------------------------------------------------------------
+# Compiled (numba) backend
+# -----------------------------------------------------------------------------
+# Scalar versions of the sub-index functions above. Each one follows the same
+# branch structure (and therefore the same NaN handling) as the numpy 
+# function it mirrors, so the two backends agree to floating point round-off.
+# Terms that are only used within a branch are only computed when needed.
+
+def _pow(x, a):
+
+    # Faster than x**a for non-integer exponents inside numba kernels. Same 
+    # result for x >= 0, including x == 0, and nan for x < 0.
+    return np.exp(a * np.log(x))
+
+def _ffmc_scalar(tas, ro, sfcWind, hurs, ffmc0):
+
+    mo = 147.2 * (101.0-ffmc0) / (59.5+ffmc0) # ......................... Eq. 1
+
+    rf = ro - 0.5 if ro > 0.5 else ro # ................................. Eq. 2
+
+    mr = mo
+    if (ro > 0.5) and (mo <= 150.0):
+        mr = mo + 42.5 * rf * np.exp(-100.0/(251.0-mo)) \
+             * (1.0-np.exp(-6.93/rf)) # ................................ Eq. 3a
+    elif (ro > 0.5) and (mo > 150.0):
+        mr = mo + 42.5 * rf * np.exp(-100.0/(251.0-mo)) \
+             * (1.0-np.exp(-6.93/rf)) \
+             + 0.0015 * (mo-150.0)**2 * np.sqrt(rf) # .................. Eq. 3b
+
+    if mr > 250.0:
+        mr = 250.0
+
+    # Terms shared by Eq. 4-7
+    e_hurs = np.exp((hurs-100.0)/10.0)
+    t_hurs = 0.18 * (21.1-tas) * (1.0 - np.exp(-hurs*0.115))
+    k_tas = 0.581 * np.exp(0.0365*tas)
+    ws_sqrt = np.sqrt(sfcWind)
+
+    Ed = 0.942 * _pow(hurs,0.679) + 11.0*e_hurs + t_hurs # ............. Eq. 4
+    Ew = 0.618 * _pow(hurs,0.753) + 10.0*e_hurs + t_hurs # ............. Eq. 5
+
+    m = mr
+
+    if mr > Ed:
+        h = hurs/100.0
+        ko = 0.424 * (1.0 - _pow(h,1.7)) \
+             + 0.0694 * ws_sqrt * (1.0 - ((h*h)**2)**2) # .............. Eq. 6a
+        kd = ko * k_tas # .............................................. Eq. 6b
+        m = Ed + (mr-Ed) * np.exp(-kd*np.log(10.0)) # ................... Eq. 8
+
+    if mr < Ew:
+        h = (100.0-hurs)/100.0
+        k1 = 0.424 * (1.0 - _pow(h,1.7)) \
+             + 0.0694 * ws_sqrt * (1.0 - ((h*h)**2)**2) # .............. Eq. 7a
+        kw = k1 * k_tas # .............................................. Eq. 7b
+        m = Ew - (Ew-mr) * np.exp(-kw*np.log(10.0)) # .................. Eq. 9
+
+    ffmc = 59.5 * (250.0-m) / (147.2+m) # .............................. Eq. 10
+
+    if ffmc > 101.0:
+        ffmc = 101.0
+
+    return ffmc
+
+def _dmc_scalar(tas, ro, hurs, Le, dmc0):
+
+    Po = dmc0
+
+    if tas < -1.1:
+        tas = -1.1
+
+    re = 0.92*ro - 1.27 if ro > 1.5 else ro # .......................... Eq. 11
+    Mo = 20.0 + np.exp(5.6348 - Po/43.43) # ............................ Eq. 12
+
+    b = 100.0 / (0.5 + 0.3*Po) # ...................................... Eq. 13a
+    if (Po > 33.0) and (Po <= 65.0):
+        b = 14 - 1.3*np.log(Po) # ..................................... Eq. 13b
+    if Po > 65.0:
+        b = 6.2*np.log(Po) - 17.2 # ................................... Eq. 13c
+
+    if ro > 1.5:
+        Mr = Mo + 1000.0 * re/(48.77 + b*re) # ......................... Eq. 14
+        Pr = 244.72 - 43.43 * np.log(Mr-20.0) # ........................ Eq. 15
+    else:
+        Pr = Po
+
+    if Pr < 0.0:
+        Pr = 0.0
+
+    K = 1.894 * (tas+1.1) * (100.0-hurs) * Le*1e-06 # .................. Eq. 16
+
+    return Pr + 100.0*K # .............................................. Eq. 17
+
+def _dc_scalar(tas, ro, Lf, dc0):
+
+    Do = dc0
+
+    if tas < -2.8:
+        tas = -2.8
+
+    if ro <= 2.8:
+        Dr = Do
+    else:
+        rd = 0.83*ro - 1.27 if ro > 2.8 else 0.0 # ..................... Eq. 18
+        Qo = 800.0 * np.exp(-1 * Do/400.0) # ........................... Eq. 19
+        Qr = Qo + 3.937*rd # ........................................... Eq. 20
+        Dr = 400.0 * np.log(800.0/Qr) # ................................ Eq. 21
+
+    if Dr < 0.0:
+        Dr = 0.0
+
+    V = 0.36 * (tas+2.8) + Lf # ........................................ Eq. 22
+    if V < 0.0:
+        V = 0.0
+
+    return Dr + V/2 # .................................................. Eq. 23
+
+def _dc_overwinter_scalar(dc_fall, rw):
+
+    Qf = 800.0 * np.exp(-dc_fall/400.0)
+    Qs = _OVERWINTER_A*Qf + _OVERWINTER_B*(3.94*rw)
+    DCs = 400.0 * np.log(800.0/Qs)
+
+    return 15.0 if DCs < 15.0 else DCs
+
+def _isi_scalar(ffmc, sfcWind):
+
+    m = 147.2 * (101.0-ffmc)/(59.5+ffmc) # .............................. Eq. 1
+
+    fW = np.exp(0.05039*sfcWind) # ..................................... Eq. 24
+    fF = 91.9 * np.exp(-0.1386*m) \
+         * (1.0 + _pow(m,5.31)/(4.93*1e7)) # ........................... Eq. 25
+
+    return 0.208*fW*fF # ............................................... Eq. 26
+
+def _bui_scalar(dmc, dc):
+
+    P = dmc
+    D = dc
+
+    if P < 0.001:
+        P = 0.0
+
+    if P <= 0.4 * D:
+        bui = 0.8 * P * D/(P + 0.4*D) # ............................... Eq. 27a
+    else:
+        bui = P - (1.0 - 0.8*D/(P + 0.4*D)) \
+              * (0.92 + _pow(0.0114*P,1.7)) # ......................... Eq. 27b
+
+    if (P == 0.0) and (D == 0.0):
+        bui = 0.0
+    if bui < 0.0:
+        bui = 0.0
+
+    return bui
+
+def _fwi_scalar(isi, bui):
+
+    R = isi
+    U = bui
+
+    if U <= 80.0:
+        fD = 0.626 * _pow(U,0.809) + 2.0 # ............................ Eq. 28a
+    else:
+        fD = 1000.0/(25.0 + 108.64*np.exp(-0.0203*U)) # ............... Eq. 28b
+
+    B = 0.1 * R * fD # ................................................. Eq. 29
+
+    if B > 1.0:
+        return np.exp(2.72 * _pow(0.434*np.log(B),0.647)) # ........... Eq. 30a
+
+    return B # ........................................................ Eq. 30b
+
+def _cffdrs_cells(c0, c1, tas, pr, sfcWind, hurs, mon, ffmc0, dmc0, dc0, need,
+                  idx, out, seasonal, season, active0, rw0, overwinter, fill):
+
+    # Inputs are 2D arrays of shape (ndays, ncells). The full time recurrence
+    # is run for grid cells c0 to c1 with the previous day's codes held in 
+    # small local arrays, so every read and write is contiguous along the cell
+    # axis. need[k] is True if index k (in the order of _CFFDRS_VARS) has to be 
+    # calculated, and idx[k] is its position in out, or -1 if it is not 
+    # returned. The codes of the last day are written back to ffmc0, dmc0 and 
+    # dc0. In seasonal mode, cell-days outside the fire season (season False) 
+    # are skipped and filled with fill, codes are carried over (or 
+    # overwintered) and active0 and rw0 track the season and winter 
+    # precipitation of each cell. rw0 is NaN only before the first fire 
+    # season, missing precipitation is not added to it.
+    ndays = tas.shape[0]
+
+    ffmc_b = ffmc0[c0:c1].astype(np.float64)
+    dmc_b = dmc0[c0:c1].astype(np.float64)
+    dc_b = dc0[c0:c1].astype(np.float64)
+
+    for t in range(ndays):
+
+        Le = _Le[mon[t]]
+        Lf = _Lf[mon[t]]
+
+        for j in range(c1 - c0):
+
+            c = c0 + j
+
+            if seasonal:
+                if not season[t,c]:
+                    active0[c] = False
+                    # Missing precipitation counts as no rain
+                    if not np.isnan(pr[t,c]):
+                        rw0[c] += pr[t,c]
+                    for k in range(out.shape[0]):
+                        out[k,t,c] = fill
+                    continue
+                if not active0[c]:
+                    # Start of fire season, NaN rw0 means there was no
+                    # previous fire season to overwinter from
+                    if overwinter and not np.isnan(rw0[c]):
+                        ffmc_b[j] = 85.0
+                        dmc_b[j] = 6.0
+                        dc_b[j] = _dc_overwinter_scalar(dc_b[j],rw0[c])
+                    active0[c] = True
+                    rw0[c] = 0.0
+
+            if need[0]:
+                ffmc_b[j] = _ffmc_scalar(
+                    tas[t,c],pr[t,c],sfcWind[t,c],hurs[t,c],ffmc_b[j])
+                if idx[0] >= 0:
+                    out[idx[0],t,c] = ffmc_b[j]
+            if need[1]:
+                dmc_b[j] = _dmc_scalar(
+                    tas[t,c],pr[t,c],hurs[t,c],Le,dmc_b[j])
+                if idx[1] >= 0:
+                    out[idx[1],t,c] = dmc_b[j]
+            if need[2]:
+                dc_b[j] = _dc_scalar(tas[t,c],pr[t,c],Lf,dc_b[j])
+                if idx[2] >= 0:
+                    out[idx[2],t,c] = dc_b[j]
+            if need[3]:
+                isi_j = _isi_scalar(ffmc_b[j],sfcWind[t,c])
+                if idx[3] >= 0:
+                    out[idx[3],t,c] = isi_j
+            if need[4]:
+                bui_j = _bui_scalar(dmc_b[j],dc_b[j])
+                if idx[4] >= 0:
+                    out[idx[4],t,c] = bui_j
+            if need[5]:
+                fwi_j = _fwi_scalar(isi_j,bui_j)
+                if idx[5] >= 0:
+                    out[idx[5],t,c] = fwi_j
+            if need[6]:
+                out[idx[6],t,c] = 0.0272 * _pow(fwi_j,1.77) # ......... Eq. 31
+
+    ffmc0[c0:c1] = ffmc_b
+    dmc0[c0:c1] = dmc_b
+    dc0[c0:c1] = dc_b
+
+def _cffdrs_kernel(tas, pr, sfcWind, hurs, mon, ffmc0, dmc0, dc0, need, idx, 
+                   out, seasonal, season, active0, rw0, overwinter, fill):
+
+    # Grid cells are split into blocks that are processed in parallel
+    ncells = tas.shape[1]
+    nblocks = (ncells + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+
+    for b in _prange(nblocks):
+
+        c0 = b * _BLOCK_SIZE
+        c1 = min(c0 + _BLOCK_SIZE, ncells)
+
+        _cffdrs_cells(c0,c1,tas,pr,sfcWind,hurs,mon,ffmc0,dmc0,dc0,need,idx,
+                      out,seasonal,season,active0,rw0,overwinter,fill)
+
+def _numba_compile() -> None:
+
+    """
+    Replace the functions of the compiled backend with numba-compiled versions
+    the first time backend='numba' is used, so that numba is only imported
+    when it is needed. Functions are only compiled the first time they are
+    called (or loaded from numba's cache). error_model='numpy' returns inf/nan
+    on division by zero, as numpy does, instead of raising an exception.
+    """
+
+    global _prange, _numba_compiled
+
+    with _numba_lock:
+
+        if _numba_compiled:
+            return
+
+        try:
+            import numba
+        except ImportError:
+            raise Exception("backend='numba' requires the numba package to be "
+                            "installed")
+
+        options = dict(cache=True,nogil=True,error_model='numpy')
+        funcs = globals()
+
+        for name in _NUMBA_FUNCS:
+            funcs[name] = numba.njit(**options)(funcs[name])
+        for name in _NUMBA_PARALLEL_FUNCS:
+            funcs[name] = numba.njit(parallel=True,**options)(funcs[name])
+
+        _prange = numba.prange
+        _numba_compiled = True
+
+def _cffdrs_calc_numba(tas, pr, sfcWind, hurs, mon, ffmc0, dmc0, dc0, 
+                       outputs, need, season, dtype) -> tuple:
+
+    """
+    Run the compiled CFFDRS kernel. Arrays are flattened to (ndays, ncells),
+    passed to the kernel and reshaped back to the original array shape. 
+    Returns the requested indices and the moisture codes of the last day.
+    """
+
+    _numba_compile()
+
+    arr_shape = np.shape(tas)
+    ndays = arr_shape[0]
+
+    # Inputs need to be C-contiguous arrays of the compute dtype
+    tas, pr, sfcWind, hurs = [
+        np.ascontiguousarray(x,dtype=dtype).reshape(ndays,-1) 
+        for x in (tas,pr,sfcWind,hurs)]
+    
+    ncells = tas.shape[1]
+
+    # Initial codes can be scalars or grids, broadcast them to each grid cell.
+    # These are copies as the kernel overwrites them with the last day's codes
+    ffmc0, dmc0, dc0 = [
+        np.array(np.broadcast_to(np.asarray(x,dtype=dtype),arr_shape[1:]),
+                 dtype=dtype).reshape(ncells) 
+        for x in (ffmc0,dmc0,dc0)]
+
+    # Month values as zero-based indices for day length lookup tables
+    mon = np.asarray(mon,dtype=np.int64).reshape(ndays) - 1
+
+    # Preallocate requested outputs, these are filled in place by the kernel
+    out = np.empty((len(outputs),ndays,ncells),dtype=dtype)
+    need_k = np.array([k in need for k in _CFFDRS_VARS])
+    idx_k = np.array([outputs.index(k) if k in outputs else -1 
+                      for k in _CFFDRS_VARS])
+
+    # Fire season mask and per-cell season state, these are small unused 
+    # placeholders if the fire season is not used
+    if season is not None:
+        active = np.ascontiguousarray(season['active'],dtype=bool)
+        active = active.reshape(ndays,ncells)
+        active0, rw0 = [
+            np.array(np.broadcast_to(season[k],arr_shape[1:]),
+                     dtype=t).reshape(ncells) 
+            for k, t in (('active0',bool),('rw0',np.float64))]
+    else:
+        active = np.ones((1,1),dtype=bool)
+        active0 = np.ones(1,dtype=bool)
+        rw0 = np.zeros(1)
+
+    kernel_args = (tas,pr,sfcWind,hurs,mon,ffmc0,dmc0,dc0,need_k,idx_k,out,
+                   season is not None,active,active0,rw0,
+                   season is not None and season['overwinter'],
+                   season['fill_value'] if season is not None else np.nan)
+
+    # The parallel kernel is only launched from the main thread. Calls from
+    # other threads (e.g., dask workers, which already run chunks in parallel)
+    # run all cells in the calling thread, since numba's threading layers can't
+    # safely be shared between threads.
+    if threading.current_thread() is threading.main_thread():
+        _cffdrs_kernel(*kernel_args)
+    else:
+        _cffdrs_cells(0,ncells,*kernel_args)
+
+    cffdrs_vals = {k: out[i].reshape(arr_shape) for i, k in enumerate(outputs)}
+    state = {k: v.reshape(arr_shape[1:]) 
+             for k, v in zip(('ffmc','dmc','dc'),(ffmc0,dmc0,dc0))}
+
+    if season is not None:
+        state['active'] = active0.reshape(arr_shape[1:])
+        state['rw'] = rw0.reshape(arr_shape[1:])
+
+    return (cffdrs_vals,state)
+
+def _cffdrs_calc_numpy(tas, pr, sfcWind, hurs, mon, ffmc0, dmc0, dc0, 
+                       outputs, need, season, dtype) -> tuple:
+
+    """
+    Compute CFFDRS indices with numpy in three phases: weather-only terms, 
+    time stepping of the moisture codes, then the remaining indices. Returns
+    the requested indices and the moisture codes of the last day.
+    """
+
+    tas = np.asarray(tas,dtype=dtype)
+    pr = np.asarray(pr,dtype=dtype)
+    sfcWind = np.asarray(sfcWind,dtype=dtype)
+    hurs = np.asarray(hurs,dtype=dtype)
+
+    # Create empty arrays to store requested cffdrs variables
+    arr_shape = tas.shape
+
+    out = {k: np.empty(arr_shape,dtype=dtype) for k in outputs}
+
+    mon = np.asarray(mon)
+    ndays = mon.size
+
+    # Day length values for each day, shaped to broadcast along the time axis
+    day_shape = (ndays,) + (1,)*(tas.ndim-1)
+    Le = _Le[mon-1].reshape(day_shape).astype(dtype)
+    Lf = _Lf[mon-1].reshape(day_shape).astype(dtype)
+
+    # Number of days evaluated together in each vectorized pass. For small 
+    # grids this is the full time series, for large grids the passes are 
+    # split into blocks of days so temporary arrays stay small enough to fit 
+    # in cache.
+    ncells = int(np.prod(arr_shape[1:]))
+    nblock = min(ndays,max(1,_DAY_BLOCK_ELEMENTS // max(ncells,1)))
+
+    # Moisture codes that are needed but not returned are only kept for the
+    # current block of days
+    codes = [k for k in ('ffmc','dmc','dc') if k in need]
+    buf = {k: np.empty((nblock,)+arr_shape[1:],dtype=dtype) 
+           for k in codes if k not in out}
+
+    codes0 = {'ffmc': ffmc0,'dmc': dmc0,'dc': dc0}
+
+    if season is not None:
+        active = np.asarray(season['active'],dtype=bool)
+        active0 = np.broadcast_to(season['active0'],arr_shape[1:]).copy()
+        rw0 = np.array(np.broadcast_to(season['rw0'],arr_shape[1:]),
+                       dtype=np.float64)
+
+    for d0 in range(0,ndays,nblock):
+
+        blk = slice(d0,min(d0+nblock,ndays))
+        nb = blk.stop - blk.start
+
+        # Blocks of days outside of the fire season for all grid cells are 
+        # skipped, codes are carried over and winter precipitation summed
+        if season is not None and not active[blk].any():
+            active0[...] = False
+            rw0 += np.nansum(pr[blk],axis=0)
+            for k in outputs:
+                out[k][blk] = season['fill_value']
+            continue
+
+        vals = {k: out[k][blk] if k in out else buf[k][:nb] for k in codes}
+
+        # Phase 1: Compute all terms that only depend on daily weather
+        terms = {}
+        if 'ffmc' in need:
+            terms['ffmc'] = _ffmc_weather(
+                tas[blk],pr[blk],sfcWind[blk],hurs[blk])
+        if 'dmc' in need:
+            terms['dmc'] = _dmc_weather(tas[blk],pr[blk],hurs[blk],Le[blk])
+        if 'dc' in need:
+            terms['dc'] = _dc_weather(tas[blk],pr[blk],Lf[blk])
+
+        step = {'ffmc': _ffmc_step,'dmc': _dmc_step,'dc': _dc_step}
+
+        # Phase 2: Step through time carrying forward the previous day's codes
+        for i in range(nb):
+
+            if season is not None:
+                active_i = active[d0+i]
+                # Start of fire season, NaN rw0 means there was no previous 
+                # fire season to overwinter from
+                start = active_i & ~active0 & ~np.isnan(rw0)
+                if season['overwinter'] and start.any():
+                    codes0['ffmc'] = np.where(start,85.0,codes0['ffmc'])
+                    codes0['dmc'] = np.where(start,6.0,codes0['dmc'])
+                    codes0['dc'] = np.where(start,dc_overwinter(
+                        codes0['dc'],np.where(start,rw0,0.0)),codes0['dc'])
+                # Missing precipitation counts as no rain, so NaN rw0 only
+                # marks cells without a previous fire season
+                rw0 = np.where(active_i,0.0,rw0 + np.where(
+                    np.isnan(pr[d0+i]),0.0,pr[d0+i]))
+                active0 = active_i.copy()
+
+            for k in codes:
+                code = step[k](codes0[k],**{n: v[i] for n,v in terms[k].items()})
+                if season is not None:
+                    code = np.where(active_i,code,codes0[k])
+                codes0[k] = code
+                vals[k][i,...] = codes0[k]
+
+        # Phase 3: None of the remaining indices feed back into the moisture
+        # codes so they are computed for all days in the block at once
+        if 'isi' in need:
+            vals['isi'] = isi_calc(vals['ffmc'],sfcWind[blk])
+        if 'bui' in need:
+            vals['bui'] = bui_calc(vals['dmc'],vals['dc'])
+        if 'fwi' in need:
+            vals['fwi'] = fwi_calc(vals['isi'],vals['bui'])
+        if 'dsr' in need:
+            vals['dsr'] = dsr_calc(vals['fwi'])
+
+        for k in outputs:
+            if k not in codes:
+                out[k][blk] = vals[k]
+            if season is not None:
+                out[k][blk][~active[blk]] = season['fill_value']
+
+    state = {k: np.array(codes0[k],dtype=dtype) for k in codes}
+
+    if season is not None:
+        state['active'] = np.array(active0,dtype=bool)
+        state['rw'] = rw0
+
+    return (out,state)
+
+def _check_outputs(outputs) -> list:
+
+    """
+    Check names of requested indices and put them in the order of 
+    _CFFDRS_VARS. Returns all indices if outputs is None.
+    """
+
+    if outputs is None:
+        return list(_CFFDRS_VARS)
+
+    if isinstance(outputs,str):
+        outputs = [outputs]
+
+    if any(k not in _CFFDRS_VARS for k in outputs):
+        raise Exception("'outputs' can only include %s" % 
+                        ', '.join(_CFFDRS_VARS))
+
+    return [k for k in _CFFDRS_VARS if k in outputs]
+
 def cffdrs_calc(
         tas: np.ndarray,
         pr: np.ndarray,
@@ -362,8 +1097,16 @@ def cffdrs_calc(
         mon,
         ffmc0: np.ndarray=85.0,
         dmc0: np.ndarray=6.0,
-        dc0: np.ndarray=15.0
-        ) -> dict:
+        dc0: np.ndarray=15.0,
+        state: dict=None,
+        backend: str='numpy',
+        dtype=np.float64,
+        return_state: bool=False,
+        outputs: list=None,
+        season: np.ndarray=None,
+        overwinter: bool=False,
+        fill_value: float=np.nan
+        ):
 
     """
     Description
@@ -396,11 +1139,54 @@ def cffdrs_calc(
         Drought Code for previous day. If not given assumed to be 
         15.0 for first day, and the rest of the calculations proceed through
         time using the previous days ffmc values as they are calculated
+    state: dict, optional
+        Moisture codes for the day before the first day, with keys 'ffmc', 
+        'dmc' and 'dc', e.g. as returned with return_state=True for the 
+        preceding time period. Overrides ffmc0, dmc0 and dc0 if given.
+    backend: str, optional
+        Either 'numpy' (default) or 'numba'. The 'numpy' backend works on
+        blocks of days (about _DAY_BLOCK_ELEMENTS days x grid cells each):
+        the terms that only depend on daily weather are evaluated for the
+        whole block at once, then only the FFMC, DMC and DC are stepped
+        through the days of the block, and ISI, BUI, FWI and DSR are again
+        computed for the whole block. The 'numba' backend runs a compiled
+        kernel that loops through time for each grid cell in parallel, and
+        requires the numba package.
+    dtype: numpy.dtype, optional
+        Floating point precision of the input and output arrays. Default is
+        numpy.float64. Using numpy.float32 halves memory use. With the 'numba'
+        backend intermediate values within each day are still computed in 
+        double precision.
+    return_state: bool, optional
+        If True, also return the moisture codes of the last day so the 
+        calculations can be continued from this point in a later call.
+    outputs: list of str, optional
+        Names of the indices to return, any of 'ffmc', 'dmc', 'dc', 'isi', 
+        'bui', 'fwi' and 'dsr'. Default is all seven. Indices that are not 
+        requested are only calculated if a requested index depends on them, 
+        and moisture codes that are not requested are only stored for a small
+        block of days, which reduces memory use.
+    season: numpy.ndarray(dtype=bool), optional
+        Fire season mask with the same shape as tas, e.g. from 
+        'fire_season_mask'. If given, indices are only calculated for days 
+        within the fire season in each grid cell. Moisture codes are carried 
+        over the days outside of the fire season, which are set to fill_value
+        in the output.
+    overwinter: bool, optional
+        Only used with season. If True, at the start of each fire season FFMC
+        and DMC are reset to their start-up values (85.0 and 6.0) and the DC 
+        is computed from the DC at the end of the previous fire season and 
+        precipitation in between with 'dc_overwinter'. Otherwise all codes are
+        carried over unchanged. Missing precipitation values between fire 
+        seasons count as no rain. Default is False.
+    fill_value: float, optional
+        Only used with season, output value on days outside of the fire 
+        season. Default is numpy.nan.
 
     Returns
     -------
-    dict
-        A dictionary with the following keys:
+    dict, or tuple of (dict, dict) if return_state=True
+        A dictionary with the following keys (or only those in outputs):
             ffmc: float or numpy array of floats
                 Fine fuel moisture code
             dmc: float or numpy array of floats
@@ -415,54 +1201,932 @@ def cffdrs_calc(
                 Fire weather index [unitless]
             dsr: float or numpy array of floats
                 Daily severity rating [unitless]
+        If return_state=True the second dictionary is the state, see 
+        'get_state'. With season the state also includes 'active', whether 
+        the last day was in the fire season, and 'rw', precipitation since the
+        end of the last fire season.
     
     Notes
     -----
     The first axis of any supplied numpy.ndarray is the time axis. For 
     example, in 3D arrays this means that axis 0 represent time and axes 1 and 
     2 represent the spatial dimensions (e.g., lat and lon).
+
+    With dtype=numpy.float64 the 'numba' backend matches the 'numpy' backend 
+    to within an absolute difference of 1e-8 for all indices. With 
+    dtype=numpy.float32 it matches the float64 results to within 1e-3.
+
+    The 'numba' backend skips each grid cell and day outside of the fire 
+    season, whereas the 'numpy' backend skips blocks of days when all grid 
+    cells are outside of the fire season.
     """
 
-    # Create empty arrays to store cffdrs variables
-    arr_shape = tas.shape
+    if state is not None:
+        ffmc0, dmc0, dc0 = state['ffmc'], state['dmc'], state['dc']
+
+    # Fire season state. Without a previous state, codes are not overwintered 
+    # until the end of the first fire season
+    if season is not None:
+        if state is None:
+            state = {}
+        season = {'active': season,
+                  'active0': state.get('active',False),
+                  'rw0': state.get('rw',np.nan),
+                  'overwinter': overwinter,
+                  'fill_value': fill_value}
+
+    outputs = _check_outputs(outputs)
+
+    # Indices that need to be calculated, including those the requested 
+    # indices depend on. All moisture codes are needed to return the state.
+    need = set(outputs)
+    if return_state:
+        need.update(('ffmc','dmc','dc'))
+    for k in reversed(_CFFDRS_VARS):
+        if k in need:
+            need.update(_CFFDRS_DEPS[k])
+
+    if backend == 'numpy':
+        cffdrs_vals, last_codes = _cffdrs_calc_numpy(
+            tas,pr,sfcWind,hurs,mon,ffmc0,dmc0,dc0,outputs,need,season,dtype)
+    elif backend == 'numba':
+        cffdrs_vals, last_codes = _cffdrs_calc_numba(
+            tas,pr,sfcWind,hurs,mon,ffmc0,dmc0,dc0,outputs,need,season,dtype)
+    else:
+        raise Exception("'backend' argument needs to be either 'numpy' or "
+                        "'numba'")
+
+    if return_state:
+        return (cffdrs_vals,last_codes)
+
+    return cffdrs_vals
+
+def cffdrs_calc_batch(
+        tas: np.ndarray,
+        pr: np.ndarray,
+        sfcWind: np.ndarray,
+        hurs: np.ndarray,
+        mon,
+        state: dict=None,
+        return_state: bool=False,
+        **kwargs
+        ):
 
-    ffmc = np.zeros(arr_shape)
-    dmc = np.zeros(arr_shape)
-    dc = np.zeros(arr_shape)
-    isi = np.zeros(arr_shape)
-    bui = np.zeros(arr_shape)
-    fwi = np.zeros(arr_shape)
-    dsr = np.zeros(arr_shape)
+    """
+    Description
+    -----------
+    Computes CFFDRS indices for several data sources (e.g., ERA5 and a set of
+    GCMs) on the same grid and days in a single call of 'cffdrs_calc'. With 
+    backend='numba' all sources are run through one kernel call.
 
-    ndays = mon.size
+    Parameters
+    ----------
+    tas, pr, sfcWind, hurs: numpy.ndarray
+        Daily weather as in 'cffdrs_calc', with an extra leading source axis,
+        i.e. arrays of shape (nsources, ndays, ...)
+    mon: int or numpy.ndarray(dtype=int)
+        Month values (1-12) for each day, shared by all sources
+    state: dict, optional
+        Moisture codes for the day before the first day with keys 'ffmc', 
+        'dmc' and 'dc', with arrays of shape (nsources, ...)
+    return_state: bool, optional
+        If True, also return the moisture codes of the last day for each 
+        source.
+    **kwargs
+        Passed to 'cffdrs_calc' (e.g., backend, dtype, outputs)
+
+    Returns
+    -------
+    dict, or tuple of (dict, dict) if return_state=True
+        Same as 'cffdrs_calc', with arrays of shape (nsources, ndays, ...) 
+        and state arrays of shape (nsources, ...)
+    """
+
+    # 'cffdrs_calc' treats the source axis like another spatial axis once time
+    # is moved to the front
+    tas, pr, sfcWind, hurs = [np.moveaxis(np.asarray(x),1,0) 
+                              for x in (tas,pr,sfcWind,hurs)]
+
+    if kwargs.get('season') is not None:
+        kwargs['season'] = np.moveaxis(np.asarray(kwargs['season']),1,0)
+
+    out = cffdrs_calc(tas,pr,sfcWind,hurs,mon,state=state,
+                      return_state=return_state,**kwargs)
+
+    if return_state:
+        cffdrs_vals, last_codes = out
+    else:
+        cffdrs_vals = out
+
+    cffdrs_vals = {k: np.moveaxis(v,0,1) for k, v in cffdrs_vals.items()}
+
+    if return_state:
+        return (cffdrs_vals,last_codes)
+
+    return cffdrs_vals
 
-    for i in range(ndays):
-
-        ffmc[i,...] = ffmc_calc(
-            tas[i,...],pr[i,...],sfcWind[i,...],hurs[i,...],ffmc0)
-        dmc[i,...] = dmc_calc(
-            tas[i,...],pr[i,...],hurs[i,...],mon[i]-1,dmc0)
-        dc[i,...] = dc_calc(
-            tas[i,...],pr[i,...],mon[i]-1,dc0)
-        isi[i,...] = isi_calc(
-            ffmc[i,...],sfcWind[i,...])
-        bui[i,...] = bui_calc(
-            dmc[i,...],dc[i,...])
-        fwi[i,...] = fwi_calc(
-            isi[i,...],bui[i,...])
-        dsr[i,...] = dsr_calc(
-            fwi[i,...])
-
-        ffmc0 = ffmc[i,...]
-        dmc0 = dmc[i,...]
-        dc0 = dc[i,...]
+# -----------------------------------------------------------------------------
+# Moisture code state
+# -----------------------------------------------------------------------------
+# The state holds the last day's FFMC, DMC and DC grids. Passing it to the next
+# call of 'cffdrs_calc' continues the calculations through time, so a long time
+# series can be run one year at a time. State checkpoints are saved for each 
+# data source and year so a run can be restarted from the last finished year.
+
+def default_state(shape: tuple=(), dtype=np.float64) -> dict:
+
+    """
+    Description
+    -----------
+    Standard start-up moisture codes (FFMC = 85, DMC = 6, DC = 15) used 
+    when no previous state is available, as arrays of the given shape.
+    """
 
     return {
-        'ffmc': ffmc,
-        'dmc': dmc,
-        'dc': dc,
-        'isi': isi,
-        'bui': bui,
-        'fwi': fwi,
-        'dsr': dsr,
-        }
\ No newline at end of file
+        'ffmc': np.full(shape,85.0,dtype=dtype),
+        'dmc': np.full(shape,6.0,dtype=dtype),
+        'dc': np.full(shape,15.0,dtype=dtype),
+        }
+
+def get_state(cffdrs_vals: dict) -> dict:
+
+    """
+    Description
+    -----------
+    Get moisture codes for the last day of a 'cffdrs_calc' result.
+
+    Parameters
+    ----------
+    cffdrs_vals: dict
+        Output of 'cffdrs_calc', with time as the first axis
+
+    Returns
+    -------
+    dict
+        Dictionary with keys 'ffmc', 'dmc', and 'dc'
+    """
+
+    return {k: np.array(cffdrs_vals[k][-1,...]) for k in ('ffmc','dmc','dc')}
+
+def state_filename(dest, source: str, yr: int) -> pathlib.Path:
+
+    """
+    Description
+    -----------
+    File name of the state checkpoint for the last day of a year for a given
+    data source (e.g., 'era5' or a GCM name).
+    """
+
+    return pathlib.Path(dest) / ('cffdrs-state_%s_%d.npz' % (source,yr))
+
+def save_state(state: dict, fn) -> None:
+
+    """
+    Description
+    -----------
+    Save moisture code state to a .npz file. The file is first written to a 
+    temporary file and then renamed, so an interrupted run never leaves a 
+    partially written checkpoint.
+
+    Parameters
+    ----------
+    state: dict
+        Dictionary with keys 'ffmc', 'dmc', and 'dc', and 'active' and 'rw' 
+        if the fire season is used (see 'cffdrs_calc')
+    fn: str or pathlib.Path
+        Location of checkpoint file
+    """
+
+    fn = pathlib.Path(fn)
+    tmp_fn = fn.with_name(fn.name + '.tmp')
+
+    with open(tmp_fn,'wb') as f:
+        np.savez(f,**{k: np.asarray(v) for k, v in state.items()})
+
+    os.replace(tmp_fn,fn)
+
+    return None
+
+def load_state(fn) -> dict:
+
+    """
+    Description
+    -----------
+    Load moisture code state saved with 'save_state'.
+    """
+
+    with np.load(fn) as npz:
+        state = {k: npz[k] for k in npz.files}
+
+    return state
+
+# -----------------------------------------------------------------------------
+# xarray interface
+# -----------------------------------------------------------------------------
+# Names and attributes of CFFDRS variables in the order returned by 
+# 'cffdrs_calc'
+_CFFDRS_ATTRS = {
+    'ffmc': {'long_name': 'Fine Fuel Moisture Code','units': '1'},
+    'dmc': {'long_name': 'Duff Moisture Code','units': '1'},
+    'dc': {'long_name': 'Drought Code','units': '1'},
+    'isi': {'long_name': 'Initial Spread Index','units': '1'},
+    'bui': {'long_name': 'Build Up Index','units': '1'},
+    'fwi': {'long_name': 'Fire Weather Index','units': '1'},
+    'dsr': {'long_name': 'Daily Severity Rating','units': '1'},
+    }
+
+# Default names of the input variables in processed ERA5 and CMIP6 datasets
+_CFFDRS_INPUTS = {
+    'tas': 'tasmax',
+    'pr': 'pr',
+    'sfcWind': 'sfcWind',
+    'hurs': 'hursmin',
+    }
+
+def _month(ds) -> np.ndarray:
+
+    """
+    Month of each time step, from an integer 'month' coordinate if present
+    (see 'helpers.add_time_coords'), which avoids per-element access of 
+    cftime objects.
+    """
+
+    if 'month' in ds.coords:
+        return ds['month'].values
+
+    from wildfire_analysis.utils.helpers import time_index
+
+    return time_index(ds['time'])['month']
+
+def _cffdrs_ufunc(tas, pr, sfcWind, hurs, ffmc0, dmc0, dc0, *season_args, 
+                  mon=None, outputs=None, **kwargs) -> tuple:
+
+    # xarray.apply_ufunc moves the core dimension (time) to the last axis, 
+    # whereas 'cffdrs_calc' needs time as the first axis.
+    tas, pr, sfcWind, hurs = [np.moveaxis(x,-1,0) 
+                              for x in (tas,pr,sfcWind,hurs)]
+
+    state = {'ffmc': ffmc0,'dmc': dmc0,'dc': dc0}
+    state_keys = ('ffmc','dmc','dc')
+
+    # Fire season mask and season state, if used
+    if len(season_args) > 0:
+        season, state['active'], state['rw'] = season_args
+        kwargs['season'] = np.moveaxis(season,-1,0)
+        state_keys += ('active','rw')
+
+    cffdrs_vals, state = cffdrs_calc(tas,pr,sfcWind,hurs,mon,state=state,
+                                     return_state=True,outputs=outputs,
+                                     **kwargs)
+
+    return tuple(np.moveaxis(cffdrs_vals[k],0,-1) for k in outputs) \
+        + tuple(state[k] for k in state_keys)
+
+def cffdrs_xr(ds: xr.Dataset,
+              var_names: dict=None,
+              chunks: dict=None,
+              state: dict=None,
+              backend: str='numpy',
+              dtype=np.float64,
+              return_state: bool=False,
+              outputs: list=None,
+              season: xr.DataArray=None,
+              overwinter: bool=False,
+              fill_value: float=np.nan):
+
+    """
+    Description
+    -----------
+    Computes CFFDRS indices from an xarray.Dataset of daily weather. If the
+    dataset is backed by dask arrays the result is lazy. Each spatial chunk 
+    is computed independently with the full time series, so chunks can be 
+    computed in parallel by the dask scheduler and written out with 
+    'to_netcdf' or 'to_zarr' without loading the full dataset into memory.
+
+    Dimensions other than 'time' are all treated as grid dimensions, so 
+    several data sources on the same grid can be stacked along an extra 
+    dimension (e.g., 'source') and computed together. Keeping that dimension
+    in a single chunk runs all sources through one call of 'cffdrs_calc'.
+    The grid dimensions can also be replaced by a 1-D 'cell' dimension of 
+    the active cells only (see 'helpers.stack_cells').
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+        Dataset with daily near-surface air temperature [degC], precipitation
+        [mm/day], 10-m wind speed [km/hour] and relative humidity [%] with a 
+        'time' dimension.
+    var_names: dict, optional
+        Mapping of the 'cffdrs_calc' arguments 'tas', 'pr', 'sfcWind', and
+        'hurs' to variable names in ds. Default is the names used in the
+        processed ERA5 and CMIP6 datasets: 'tasmax', 'pr', 'sfcWind' and 
+        'hursmin'.
+    chunks: dict, optional
+        Chunk sizes for the non-time dimensions, e.g. {'lat': 50, 'lon': 50}.
+        The time dimension is always kept in a single chunk. If not given,
+        existing spatial chunks of ds are used.
+    state: dict, optional
+        Moisture codes for the day before the first day with keys 'ffmc', 
+        'dmc' and 'dc'. Values are xarray.DataArrays or numpy.ndarrays with 
+        the spatial dimensions of ds, see 'cffdrs_calc'.
+    backend: str, optional
+        Passed to 'cffdrs_calc', either 'numpy' or 'numba'.
+    dtype: numpy.dtype, optional
+        Passed to 'cffdrs_calc', floating point precision of the output.
+    return_state: bool, optional
+        If True, also return the moisture codes of the last day.
+    outputs: list of str, optional
+        Names of the indices to calculate, see 'cffdrs_calc'. Default is all 
+        seven indices.
+    season: xarray.DataArray, optional
+        Boolean fire season mask with the same dimensions as the input 
+        variables, see 'cffdrs_calc'
+    overwinter: bool, optional
+        Passed to 'cffdrs_calc', used with season
+    fill_value: float, optional
+        Passed to 'cffdrs_calc', used with season
+
+    Returns
+    -------
+    xarray.Dataset, or tuple of (xarray.Dataset, dict) if return_state=True
+        Dataset with variables 'ffmc', 'dmc', 'dc', 'isi', 'bui', 'fwi' and 
+        'dsr' (or those in outputs) with the same dimensions, coordinates and 
+        global attributes as the input variables. The state is a dictionary
+        of xarray.DataArrays. For lazy results, compute the state together with the
+        output (e.g., using dask.compute with 'to_netcdf(..., compute=False)')
+        so the indices are only calculated once.
+    """
+
+    if var_names is None:
+        var_names = _CFFDRS_INPUTS
+
+    metvars = [ds[var_names[k]] for k in _CFFDRS_INPUTS]
+
+    # Time needs to be in a single chunk for the recursion through time
+    if chunks is not None:
+        metvars = [x.chunk({'time': -1,**chunks}) for x in metvars]
+    elif any(x.chunks is not None for x in metvars):
+        metvars = [x.chunk({'time': -1}) for x in metvars]
+
+    # Initial moisture codes, numpy arrays are given the spatial dimensions 
+    # and coordinates of the input dataset
+    if state is None:
+        state = {k: float(v) for k, v in default_state().items()}
+
+    spatial = metvars[0].isel(time=0,drop=True)
+
+    state_keys = ['ffmc','dmc','dc']
+    state_dtypes = [np.dtype(dtype)]*3
+    season_args = []
+
+    # Fire season mask with the same chunks as the input variables, and the 
+    # season state (see 'cffdrs_calc')
+    if season is not None:
+        season = season.transpose(*metvars[0].dims)
+        if metvars[0].chunks is not None:
+            season = season.chunk(dict(zip(metvars[0].dims,
+                                           metvars[0].chunks)))
+        state = {'active': False,'rw': np.nan,**state}
+        state_keys += ['active','rw']
+        state_dtypes += [np.dtype(bool),np.dtype(np.float64)]
+        season_args = [season]
+
+    codes0 = [state[k] if isinstance(state[k],(xr.DataArray,bool,float)) 
+              else spatial.copy(data=np.asarray(state[k]))
+              for k in state_keys]
+
+    mon = _month(ds)
+
+    outputs = _check_outputs(outputs)
+    n = len(outputs)
+
+    ufunc_kwargs = {'mon': mon,'outputs': outputs,'backend': backend,
+                    'dtype': dtype}
+    if season is not None:
+        ufunc_kwargs.update({'overwinter': overwinter,
+                             'fill_value': fill_value})
+
+    # Season state values are passed after the season mask
+    inputs = metvars + codes0[:3] + season_args + codes0[3:]
+
+    cffdrs_vals = xr.apply_ufunc(
+        _cffdrs_ufunc,
+        *inputs,
+        input_core_dims=[['time']]*len(metvars) + [[]]*3 \
+            + [['time']]*len(season_args) + [[]]*(len(state_keys)-3),
+        output_core_dims=[['time']]*n + [[]]*len(state_keys),
+        kwargs=ufunc_kwargs,
+        dask='parallelized',
+        output_dtypes=[np.dtype(dtype)]*n + state_dtypes,
+        )
+
+    dims = metvars[0].dims
+
+    cffdrs_ds = xr.Dataset({
+        k: v.transpose(*dims).assign_attrs(_CFFDRS_ATTRS[k]) 
+        for k, v in zip(outputs,cffdrs_vals[:n])})
+    
+    cffdrs_ds.attrs = ds.attrs
+
+    if return_state:
+        state = {k: v.rename(k) for k, v in zip(state_keys,cffdrs_vals[n:])}
+        return (cffdrs_ds,state)
+
+    return cffdrs_ds
+
+@xr.register_dataset_accessor('cffdrs')
+class CFFDRSAccessor:
+
+    """
+    Accessor to compute CFFDRS indices from an xarray.Dataset of daily weather,
+    e.g. ds.cffdrs.indices(backend='numba'). See 'cffdrs_xr'.
+    """
+
+    def __init__(self, ds: xr.Dataset):
+        self._ds = ds
+
+    def indices(self, **kwargs) -> xr.Dataset:
+        return cffdrs_xr(self._ds,**kwargs)
+
+# -----------------------------------------------------------------------------
+# Streaming interface
+# -----------------------------------------------------------------------------
+# Blocks of days are read, computed and written one at a time, carrying the 
+# moisture code state from one block to the next. Memory use is proportional 
+# to the size of a block rather than the full time series, and new days (e.g.,
+# daily ERA5 updates) can be appended to an existing file without recomputing
+# earlier days.
+
+def iter_cffdrs(weather,
+                ndays: int=1,
+                var_names: dict=None,
+                state: dict=None,
+                return_state: bool=False,
+                **kwargs):
+
+    """
+    Description
+    -----------
+    Generator that computes CFFDRS indices one block of days at a time.
+
+    Parameters
+    ----------
+    weather: xarray.Dataset or iterable of xarray.Dataset
+        Daily weather as in 'cffdrs_xr'. A single dataset (typically lazily 
+        loaded from file) is split into blocks of ndays along the time 
+        dimension. An iterable of datasets (e.g., one file per day) is used
+        block by block as given.
+    ndays: int, optional
+        Number of days in each block when weather is a single dataset. 
+        Default is 1.
+    var_names: dict, optional
+        Mapping of input variable names, see 'cffdrs_xr'
+    state: dict, optional
+        Moisture codes for the day before the first day, see 'cffdrs_calc'
+    return_state: bool, optional
+        If True, also yield the moisture codes of the last day of each block.
+    **kwargs
+        Passed to 'cffdrs_calc' (e.g., backend, dtype, outputs)
+
+    Yields
+    ------
+    xarray.Dataset, or tuple of (xarray.Dataset, dict) if return_state=True
+        Indices for the block of days with the coordinates and global 
+        attributes of the input block, and the state after the block.
+    """
+
+    if var_names is None:
+        var_names = _CFFDRS_INPUTS
+
+    if isinstance(weather,xr.Dataset):
+        blocks = (weather.isel(time=slice(t0,t0+ndays)) 
+                  for t0 in range(0,weather.sizes['time'],ndays))
+    else:
+        blocks = weather
+
+    for block in blocks:
+
+        # Only the current block is loaded into memory, with time first
+        metvars = [block[var_names[k]] for k in _CFFDRS_INPUTS]
+        dims = ('time',) + tuple(d for d in metvars[0].dims if d != 'time')
+        metvars = [x.transpose(*dims) for x in metvars]
+
+        cffdrs_vals, state = cffdrs_calc(*[x.values for x in metvars],
+                                         _month(block),
+                                         state=state,return_state=True,
+                                         **kwargs)
+
+        cffdrs_ds = xr.Dataset(
+            {k: metvars[0].copy(data=v).assign_attrs(_CFFDRS_ATTRS[k]) 
+             for k, v in cffdrs_vals.items()},
+            attrs=block.attrs)
+
+        if return_state:
+            yield (cffdrs_ds,state)
+        else:
+            yield cffdrs_ds
+
+class CFFDRSWriter:
+
+    """
+    Description
+    -----------
+    Writes CFFDRS indices to a netcdf (HDF5) file with an unlimited time 
+    dimension, appending one block of days at a time. The file layout (grid 
+    coordinates, variables and global attributes) is set by the first block 
+    written to a new file. Can be used as a context manager.
+
+    Parameters
+    ----------
+    fn: str or pathlib.Path
+        Location of output file
+    mode: str, optional
+        'w' (default) creates a new file, 'a' appends to an existing file 
+        written by CFFDRSWriter.
+    dtype: numpy.dtype, optional
+        Data type of the index variables in a new file. Default is float32.
+    """
+
+    def __init__(self, fn, mode: str='w', dtype=np.float32):
+
+        import h5netcdf
+
+        if mode not in ('w','a'):
+            raise Exception("'mode' argument needs to be either 'w' or 'a'")
+
+        self.fn = pathlib.Path(fn)
+        self.dtype = dtype
+        self._f = h5netcdf.File(self.fn,mode)
+
+    def _create(self, cffdrs_ds: xr.Dataset) -> None:
+
+        # Set up dimensions, coordinates and variables using the first block
+        dims = next(iter(cffdrs_ds.data_vars.values())).dims
+
+        self._f.dimensions = {
+            d: (None if d == 'time' else cffdrs_ds.sizes[d]) for d in dims}
+
+        for d in dims[1:]:
+            var = self._f.create_variable(d,(d,),data=cffdrs_ds[d].values)
+            var.attrs.update(cffdrs_ds[d].attrs)
+
+        self._f.create_variable('time',('time',),dtype=np.float64)
+
+        for k, v in cffdrs_ds.data_vars.items():
+            var = self._f.create_variable(k,dims,dtype=self.dtype)
+            var.attrs.update(v.attrs)
+
+        self._f.attrs.update(cffdrs_ds.attrs)
+
+        return None
+
+    def write(self, cffdrs_ds: xr.Dataset) -> None:
+
+        """
+        Append a block of days, e.g. as yielded by 'iter_cffdrs', to the file.
+        """
+
+        if 'time' not in self._f.dimensions:
+            self._create(cffdrs_ds)
+
+        time_var = self._f.variables['time']
+
+        # Units and calendar of the time axis are set by the first block
+        num, units, calendar = xr.coding.times.encode_cf_datetime(
+            cffdrs_ds['time'].values,
+            units=time_var.attrs.get('units'),
+            calendar=time_var.attrs.get('calendar'))
+
+        if 'units' not in time_var.attrs:
+            time_var.attrs.update({'units': units,'calendar': calendar})
+
+        t0 = self._f.dimensions['time'].size
+        t1 = t0 + cffdrs_ds.sizes['time']
+
+        self._f.resize_dimension('time',t1)
+        time_var[t0:t1] = num
+
+        for k, var in self._f.variables.items():
+            if k in cffdrs_ds.data_vars:
+                var[t0:t1,...] = cffdrs_ds[k].transpose(*var.dimensions).values
+
+        return None
+
+    def close(self) -> None:
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def cffdrs_to_netcdf(weather, fn, 
+                     ndays: int=30,
+                     state: dict=None,
+                     mode: str='w',
+                     dtype=np.float32,
+                     return_state: bool=False,
+                     **kwargs):
+
+    """
+    Description
+    -----------
+    Computes CFFDRS indices block by block with 'iter_cffdrs' and appends 
+    each block to a netcdf file with 'CFFDRSWriter'. Only one block of daily 
+    weather and indices is held in memory at a time.
+
+    Parameters
+    ----------
+    weather: xarray.Dataset or iterable of xarray.Dataset
+        Daily weather, see 'iter_cffdrs'
+    fn: str or pathlib.Path
+        Location of output file
+    ndays: int, optional
+        Number of days in each block. Default is 30.
+    state: dict, optional
+        Moisture codes for the day before the first day. When appending new 
+        days to an existing file (mode='a') this is the state returned for 
+        the last day in the file.
+    mode: str, optional
+        'w' (default) to create a new file or 'a' to append to a file
+    dtype: numpy.dtype, optional
+        Floating point precision of the calculations and the output file. 
+        Default is float32.
+    return_state: bool, optional
+        If True, return the moisture codes of the last day written.
+    **kwargs
+        Passed to 'iter_cffdrs' and 'cffdrs_calc' (e.g., var_names, backend, 
+        outputs)
+
+    Returns
+    -------
+    None, or dict if return_state=True
+    """
+
+    blocks = iter_cffdrs(weather,ndays=ndays,state=state,return_state=True,
+                         dtype=dtype,**kwargs)
+
+    with CFFDRSWriter(fn,mode=mode,dtype=dtype) as writer:
+        for cffdrs_ds, state in blocks:
+            writer.write(cffdrs_ds)
+
+    if return_state:
+        return state
+
+    return None
+
+# -----------------------------------------------------------------------------
+# Archive processing
+# -----------------------------------------------------------------------------
+# Driver for computing yearly CFFDRS files for several data sources. Each 
+# source has a directory of daily weather files (one or more files per year 
+# with the year in the file name) and an output directory for files named 
+# 'cffdrs_<source>_<year>.nc'. Tasks are run in a pool of worker processes.
+
+def _archive_fn(output_dir, source: str, yr: int) -> pathlib.Path:
+    return pathlib.Path(output_dir) / ('cffdrs_%s_%d.nc' % (source,yr))
+
+def _check_same_grid(metvars: list, names: list) -> None:
+
+    """
+    Raise an Exception if the datasets of several sources are not on the same
+    grid (lat/lon coordinates) and time steps of the 'noleap' calendar, as 
+    they are stacked with the coordinates of the first source.
+    """
+
+    from wildfire_analysis.utils import helpers as h
+
+    axes = h.get_geoaxes(metvars[0])
+    coords = [axes['Y'],axes['X'],'time']
+
+    for ds, name in zip(metvars,names):
+
+        calendar = ds['time'].dt.calendar
+        if calendar != 'noleap':
+            raise Exception("%s: time needs to be on the 'noleap' calendar, "
+                            "not '%s'" % (name,calendar))
+
+        for k in coords:
+            if (k not in ds.coords) or not np.array_equal(
+                    ds[k].values,metvars[0][k].values):
+                raise Exception("%s: '%s' coordinates differ from %s, sources "
+                                "need to be on the same grid" % (
+                                    name,k,names[0]))
+
+    return None
+
+def _archive_year(sources: dict, yr: int, state_dir, first_yr: dict, 
+                  continuous: bool, chunks: dict, cell_index, 
+                  cffdrs_kwargs: dict) -> list:
+
+    """
+    Compute CFFDRS indices for one year for all given sources at once, with
+    sources stacked along a 'source' dimension. Returns names of the sources
+    that were computed, sources with an existing output file and state 
+    checkpoint are skipped. If cell_index is given only its cells are 
+    computed, and outputs and states are put back on the grid.
+    """
+
+    import dask
+
+    from wildfire_analysis.utils import helpers as h
+
+    sources = {src: v for src, v in sources.items() if not (
+        _archive_fn(v[1],src,yr).exists() and 
+        state_filename(state_dir,src,yr).exists())}
+
+    if len(sources) == 0:
+        return []
+
+    metvars = [xr.open_mfdataset(sorted(pathlib.Path(v[0]).glob('*%d*nc' % yr)),
+                                 engine='h5netcdf') 
+               for v in sources.values()]
+
+    # Stack sources, using the grid and time coordinates of the first source.
+    # Sources need to be on the same grid with the same calendar.
+    _check_same_grid(metvars,list(sources))
+
+    metvars_all = xr.concat(metvars,dim='source',join='override',
+                            coords='minimal',compat='override',
+                            combine_attrs='drop')
+
+    chunks = {} if chunks is None else chunks
+
+    # Keep only the active cells, with spatial chunks of about the same number
+    # of cells. States are saved on the grid, so they are indexed to the cells.
+    iy, ix = (slice(None),slice(None))
+    if cell_index is not None:
+
+        if not isinstance(cell_index,xr.Dataset):
+            cell_index = h.load_cell_index(cell_index)
+
+        iy, ix = cell_index['iy'].values, cell_index['ix'].values
+        metvars_all = h.stack_cells(metvars_all,cell_index)
+
+        grid_dims = (cell_index.attrs['y_dim'],cell_index.attrs['x_dim'])
+        if any(d in chunks for d in grid_dims):
+            ncells = [cell_index.sizes[d] if chunks.get(d,-1) in (None,-1) 
+                      else chunks[d] for d in grid_dims]
+            chunks = {d: n for d, n in chunks.items() if d not in grid_dims}
+            chunks['cell'] = int(np.prod(ncells))
+
+    state = None
+    if continuous:
+        grid_shape = metvars_all[_CFFDRS_INPUTS['tas']].isel(time=0).shape
+        states = [default_state(grid_shape[1:]) if yr == first_yr[src] else
+                  {k: v[...,iy,ix] for k, v in load_state(
+                      state_filename(state_dir,src,yr-1)).items()}
+                  for src in sources]
+        state = {k: np.stack([x[k] for x in states]) 
+                 for k in ('ffmc','dmc','dc')}
+
+    cffdrs_ds, state = cffdrs_xr(metvars_all,chunks={'source': -1,**chunks},
+                                 state=state,return_state=True,
+                                 **cffdrs_kwargs)
+
+    # Outputs and states of the active cells are put back on the grid
+    if cell_index is not None:
+        cffdrs_ds = h.unstack_cells(cffdrs_ds,cell_index)
+        state = {k: h.unstack_cells(v,cell_index) for k, v in state.items()}
+
+    # Each source is written to a temporary file that is renamed once it is
+    # complete, and the state is computed in the same pass
+    write_jobs = []
+    for i, src in enumerate(sources):
+        fn = _archive_fn(sources[src][1],src,yr)
+        cffdrs_i = cffdrs_ds.isel(source=i).assign_coords(time=metvars[i].time)
+        cffdrs_i.attrs = metvars[i].attrs
+        write_jobs.append(cffdrs_i.to_netcdf(fn.with_name(fn.name + '.tmp'),
+                                             engine='h5netcdf',compute=False))
+
+    _, state = dask.compute(write_jobs,state)
+
+    for ds in metvars:
+        ds.close()
+
+    for i, src in enumerate(sources):
+        fn = _archive_fn(sources[src][1],src,yr)
+        os.replace(fn.with_name(fn.name + '.tmp'),fn)
+        save_state({k: v[i].values for k, v in state.items()},
+                   state_filename(state_dir,src,yr))
+
+    return list(sources)
+
+def _archive_years(sources: dict, years: list, state_dir, first_yr: dict,
+                   continuous: bool, chunks: dict, cell_index, 
+                   cffdrs_kwargs: dict) -> list:
+
+    """
+    Run one archive task, i.e. a list of years that are computed in order 
+    for a set of sources, and return the (source, year) pairs computed.
+    """
+
+    computed = []
+
+    for yr in years:
+        computed += [(src,yr) for src in _archive_year(
+            sources,yr,state_dir,first_yr,continuous,chunks,cell_index,
+            cffdrs_kwargs)]
+
+    return computed
+
+def run_archive(sources: dict,
+                years,
+                state_dir,
+                workers: int=1,
+                memory_limit: int=None,
+                continuous: bool=False,
+                chunks: dict=None,
+                cell_index=None,
+                verbose: bool=False,
+                **kwargs) -> list:
+
+    """
+    Description
+    -----------
+    Computes yearly CFFDRS files for several data sources (e.g., ERA5 and 
+    GCMs), with tasks run in parallel in a pool of worker processes. Years 
+    with an existing output file and state checkpoint are skipped, so an 
+    interrupted run can be restarted. Output files are first written to a 
+    temporary file and renamed once complete.
+
+    If continuous is False each year is independent and one task computes a 
+    single year for all sources with data for that year, stacked along a 
+    'source' dimension as in 'cffdrs_calc_batch'. If continuous is True the 
+    moisture codes are carried from one year to the next, so one task 
+    computes all years of a single source in order.
+
+    Parameters
+    ----------
+    sources: dict
+        Maps each source name to a tuple of (input directory, output 
+        directory). Input files for a year are found with the pattern 
+        '*<year>*nc' and outputs are written to 'cffdrs_<source>_<year>.nc'.
+        Sources computed together need to be on the same grid and calendar.
+    years: iterable of int, or dict
+        Years to compute, or a dictionary of years for each source
+    state_dir: str or pathlib.Path
+        Directory for state checkpoints, see 'state_filename'
+    workers: int, optional
+        Number of worker processes. Default is 1, which runs all tasks in 
+        the current process.
+    memory_limit: int, optional
+        Maximum address space of each worker process in bytes. Tasks that 
+        exceed it fail and are reported in the returned records. If a worker 
+        process is terminated, tasks that have not finished also fail, and can
+        be rerun as finished years are skipped. Only used with workers > 1.
+    continuous: bool, optional
+        If True, carry moisture codes across years. Default is False.
+    chunks: dict, optional
+        Spatial chunk sizes passed to 'cffdrs_xr', e.g. {'lat': 60,'lon': 120}
+    cell_index: xarray.Dataset or str or pathlib.Path, optional
+        Index of active cells (see 'helpers.cell_index'), or file it is saved
+        in. If given, only these cells are computed, along a 1-D 'cell' 
+        dimension with chunks of about the number of cells in the spatial 
+        chunks. Output files and state checkpoints are on the grid, with NaN 
+        outside the active cells.
+    verbose: bool, optional
+        If True, show a progress bar with the timing of each task.
+    **kwargs
+        Passed to 'cffdrs_xr' (e.g., backend, dtype, outputs)
+
+    Returns
+    -------
+    list of dict
+        Record for each task (see 'helpers.run_tasks') with the sources and
+        years of the task, the (source, year) pairs that were computed 
+        ('outputs'), the task status ('done', 'skipped', or 
+        'failed: <error>') and the elapsed time in seconds.
+    """
+
+    from wildfire_analysis.utils import helpers as h
+
+    if not isinstance(years,dict):
+        years = {src: years for src in sources}
+
+    years = {src: sorted(years[src]) for src in sources}
+    first_yr = {src: yrs[0] for src, yrs in years.items()}
+
+    # Tasks as (sources, years) pairs
+    if continuous:
+        tasks = [({src: sources[src]},years[src]) for src in sources]
+    else:
+        all_yr = sorted(set().union(*years.values()))
+        tasks = [({src: sources[src] for src in sources if yr in years[src]},
+                  [yr]) for yr in all_yr]
+
+    task_args = (state_dir,first_yr,continuous,chunks,cell_index,kwargs)
+    tasks = [({'sources': list(task_sources),'years': list(task_years)},
+              (task_sources,task_years,*task_args))
+             for task_sources, task_years in tasks]
+
+    # Split the cores between worker processes for the numba kernel
+    nthreads = max(1,(os.cpu_count() or 1) // workers)
+
+    return h.run_tasks(_archive_years,tasks,
+                       workers=workers,
+                       memory_limit=memory_limit,
+                       nthreads=nthreads,
+                       desc='CFFDRS',
+                       verbose=verbose)
@@ -25,6 +25,8 @@ https://doi.org/10.1038/ncomms8537
 import warnings
 import xarray as xr
 
+from wildfire_analysis.utils import helpers as h
+
 # Filter out warning on all-nan slice operations, expected
 warnings.filterwarnings('ignore',
     message='All-NaN slice encountered')
@@ -35,8 +37,9 @@ def _max_calc(ds: xr.Dataset,hst_yr=(1980,2009)) -> xr.Dataset:
     # Get slice for historial reference years
     yr_slice = slice(hst_yr[0],hst_yr[1])
 
-    # Find annual maximum
-    ds_annual_max = ds.groupby('time.year').max(dim='time')
+    # Find annual maximum, grouped by integer year coordinate
+    ds = h.add_time_coords(ds)
+    ds_annual_max = ds.groupby('year').max(dim='time')
 
     # Find 30-yr average annual maximum
     ds_max_hst_avg = ds_annual_max.sel(year=yr_slice).mean(dim="year")
@@ -52,18 +55,18 @@ def _max_calc(ds: xr.Dataset,hst_yr=(1980,2009)) -> xr.Dataset:
 # Number of days in a given year that exceed the historical 95th percentile
 def _ndays_gt_95th(ds: xr.Dataset,hst_yr: tuple=(1980,2009)) -> xr.Dataset:
 
-    # Get slice for historial reference years
-    yr_slice = slice('%d-01-01' % hst_yr[0],'%d-12-31' % hst_yr[1])
+    ds = h.add_time_coords(ds)
 
     # Get historical 95th percentile value for refernce period
-    ds_95pct_hst = ds.sel(time=yr_slice).quantile(0.95,dim='time')
+    ds_95pct_hst = h.sel_years(ds,hst_yr[0],hst_yr[1]).quantile(0.95,
+                                                                dim='time')
     
     # Classify whether each grid cell and day is greater than this historical
     # 95th percentile (True=1) or below it (False=0). This is now of bool 
     # dtype and we can sum the number of days greater than historical value
     # for each year. 
     ds_95pct_rel = ds > ds_95pct_hst
-    ds_95d = ds_95pct_rel.groupby('time.year').sum(dim='time')
+    ds_95d = ds_95pct_rel.groupby('year').sum(dim='time')
     ds_95d = ds_95d.reset_coords("quantile",drop=True)
 
     # Assign a new coordinate to specific the statistical summary, here '95d'
@@ -75,8 +78,10 @@ def _ndays_gt_95th(ds: xr.Dataset,hst_yr: tuple=(1980,2009)) -> xr.Dataset:
 # given year
 def _fs(ds: xr.Dataset) -> xr.Dataset:
 
+    ds = h.add_time_coords(ds)
+
     ds_fs = ds.rolling(time=90,center=True).mean()
-    ds_fs = ds_fs.groupby('time.year').max()
+    ds_fs = ds_fs.groupby('year').max()
 
     # Assign a new coordinate to specific the statistical summary, here 'fs'
     ds_fs = ds_fs.assign_coords(coords={'stat': 'fs'})
@@ -86,30 +91,54 @@ def _fs(ds: xr.Dataset) -> xr.Dataset:
 # Fire weather season length following method from Jolly et al. 2015
 def _fwsl(ds: xr.Dataset,hst_yr: tuple=(1980,2009)) -> xr.Dataset:
 
-    yr_slice = slice('%d-01-01' % hst_yr[0],'%d-12-31' % hst_yr[1])
+    ds = h.add_time_coords(ds)
+    ds_hst = h.sel_years(ds,hst_yr[0],hst_yr[1])
 
-    ds_min = ds.sel(time=yr_slice).min(dim='time')
-    ds_max = ds.sel(time=yr_slice).max(dim='time')
+    ds_min = ds_hst.min(dim='time')
+    ds_max = ds_hst.max(dim='time')
 
     ds_norm = 100.0 * ((ds - ds_min) / (ds_max - ds_min))
     
     ds_fwsl = xr.where(ds_norm > 50.0,1.0,0.0)
-    ds_fwsl = ds_fwsl.groupby('time.year').sum()
+    ds_fwsl = ds_fwsl.groupby('year').sum()
 
     # Assign a new coordinate to specific the statistical summary, here 'fwsl'
     ds_fwsl = ds_fwsl.assign_coords(coords={'stat': 'fwsl'})
 
     return ds_fwsl
 
+# Spatial chunks are chosen by helpers.plan_chunks for the number of workers
+# (default is the number of CPUs) and memory budget of each worker (bytes), 
+# with the full time series in each chunk. If cell_index is given (see 
+# helpers.cell_index, or the file it is saved in) only its active cells are
+# computed along a 1-D 'cell' dimension, and results are put back on the grid
+# with NaN for other cells (the day counts of '95d' and 'fwsl' are 0 for these
+# cells when the full grid is used).
 def calc_fireweather_stats(
         src_list: list,
         hst_yr: tuple=(1980,2009),
-        parallel=True) -> xr.Dataset:    
+        parallel=True,
+        workers: int=None,
+        memory_budget: int=None,
+        cell_index=None) -> xr.Dataset:    
 
     ds = xr.open_mfdataset(src_list,parallel=parallel,engine='h5netcdf')
 
+    if cell_index is not None:
+        if not isinstance(cell_index,xr.Dataset):
+            cell_index = h.load_cell_index(cell_index)
+        ds = h.stack_cells(ds,cell_index)
+
     if parallel:
-        ds = ds.chunk(chunks={'time':-1,'lat': 20,'lon': 60})
+        var = h.get_var_names(ds)[0]
+        chunks = h.plan_chunks(ds[var].sizes,ds[var].dtype,
+                               whole_dims=('time',),workers=workers,
+                               memory_budget=memory_budget)
+        ds = ds.chunk(chunks=chunks)
+
+    # Integer year/month/doy coordinates for grouping by year, added after 
+    # chunking so they stay numpy arrays
+    ds = h.add_time_coords(ds)
 
     ds_max = _max_calc(ds,hst_yr=hst_yr)
     ds_95d = _ndays_gt_95th(ds,hst_yr=hst_yr)
@@ -118,6 +147,9 @@ def calc_fireweather_stats(
 
     ds_to_export = xr.combine_nested([ds_max,ds_95d,ds_fs,ds_fwsl],
                                      concat_dim='stat')
+
+    if cell_index is not None:
+        ds_to_export = h.unstack_cells(ds_to_export,cell_index)
     
     return ds_to_export
 
@@ -6,48 +6,48 @@ conversions on, and export GCM data needed for analysis.
 from pathlib import Path
 
 import dask
+import numpy as np
 import xarray as xr
 import xclim as xc # For unit conversions
-import yaml
 from numpy import square, sqrt # For calculating wind speed from u, v vectors
 
 from wildfire_analysis.utils import helpers as h
 
-# Get global values from configuration file
-config_fn = Path(h.get_root_dir()) / 'config.yaml'
-
-with open(config_fn,'r') as config_file:
-
-    config_params = yaml.safe_load(config_file)
-    
-    geo_lims = config_params['EXTENT']['geog_lims']
-
 # Suppress dask warnings on chunk size
 dask.config.set({"array.slicing.split_large_chunks": False})
 
-# General processing of CMIP6 data
-def _organize_cmip(ds):
+# Variable/coordinates not needed and can drop
+def _drop_bounds(ds):
 
-    # Variable/coordinates not needed and can drop
     vars_to_drop = ['height','time_bnds','lat_bnds','lon_bnds','time_bounds',
                     'lat_bounds','lon_bounds']
 
     vars_in_ds = h.get_var_names(ds) + list(ds.coords)
 
-    # Step 1: drop unnecessary variables
     ds = ds.drop_vars(list(set(vars_in_ds) & set(vars_to_drop)))
 
-    # Step 2: reorganize lon to -180 thru 180
-    lon_attrs = ds['lon'].attrs
-    ds = ds.assign_coords(
-        {'lon': ('lon',(((ds['lon'].values+180.0) % 360.0)-180.0))})
-    ds = ds.sortby('lon')
-    ds['lon'].attrs = lon_attrs
+    return ds
+
+# Subset each file when it is opened, so only data within the geographic 
+# limits and on days of the 'noleap' calendar are read from disk. Longitudes
+# are reorganized to -180 thru 180 as part of the subsetting.
+def _subset_cmip(ds,geolims=None):
+
+    if geolims is None:
+        geolims = h.get_config('EXTENT')['geog_lims']
 
-    # Step 3: clip geo limits
-    ds = h.trim_geolims(ds,geo_lims)
+    ds = _drop_bounds(ds)
+    ds = h.subset_geolims(ds,geolims,wrap_lon=True)
+    ds = h.drop_leap_days(ds)
 
-    # Step 4: Convert calendar to 'noleap'
+    return ds
+
+# General processing of CMIP6 data. Bounds are dropped, longitudes converted
+# to -180 thru 180 and the data clipped to the geographic limits when each 
+# file is read (see _subset_cmip).
+def _organize_cmip(ds):
+
+    # Convert calendar to 'noleap'
     ds = ds.convert_calendar('noleap')
 
     return ds
@@ -95,8 +95,19 @@ def _process_hursmin(da):
 
     return da
 
-# Process CMIP6 Dataset
-def process_cmip6(src):
+# Process CMIP6 Dataset. Data are subset to geolims (default is 'EXTENT: 
+# geog_lims' in config.yaml, or e.g. from helpers.geolims_from_shp) and 
+# leap days are dropped as each file is read. Values are cast to dtype 
+# (default is 'CLIMATE: dtype' in config.yaml) before unit conversions. Data 
+# are chunked by year, with spatial chunks from helpers.plan_chunks for the
+# number of workers and the memory budget of each worker (bytes).
+def process_cmip6(src,geolims=None,dtype=None,workers=None,memory_budget=None):
+
+    if geolims is None:
+        geolims = h.get_config('EXTENT')['geog_lims']
+
+    if dtype is None:
+        dtype = h.get_config('CLIMATE')['dtype']
 
     da = xr.open_mfdataset(
         src,
@@ -104,19 +115,19 @@ def process_cmip6(src):
         engine='h5netcdf',
         combine_attrs='drop_conflicts',
         mask_and_scale=True,
+        preprocess=lambda x: _subset_cmip(x,geolims),
         )
 
     attrs = da.attrs
 
-    n,p = (da['lat'].size,da['lon'].size)
+    sizes = {'time': 365,'lat': da['lat'].size,'lon': da['lon'].size}
+    chunks = h.plan_chunks(sizes,dtype,whole_dims=('time',),workers=workers,
+                           memory_budget=memory_budget,copies=4)
 
-    da = da.chunk(chunks={
-        'time': 365,
-        'lat': round(n/2),
-        'lon': round(p/2),
-        })
+    da = da.chunk(chunks=chunks)
 
     da = _organize_cmip(da)
+    da = h.set_float_dtype(da,dtype)
 
     standard_name = da[h.get_var_names(da)[0]].standard_name
 
@@ -138,10 +149,72 @@ def process_cmip6(src):
         da = _process_hursmin(da['hursmin'])
 
     ds = da.to_dataset()
+    ds = h.set_float_dtype(ds,dtype)
     ds.attrs = attrs
 
     return ds
 
+# Export processed CMIP6 data to one file for each year
+def export_cmip6(ds,dest,var,gcm,years=None,persist=None,
+                 memory_frac=0.5):
+
+    """
+    Description
+    -----------
+    Write a processed CMIP6 dataset (from process_cmip6) to one netcdf file
+    for each year, named '<var>_<gcm>_<year>.nc'. All files are written with
+    xarray.save_mfdataset, so reading, subsetting and unit conversion of the
+    source files are computed once for all years instead of once per file.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+        Processed CMIP6 dataset
+    dest: str, pathlib.Path
+        Directory to write files to
+    var: str
+        Variable name used in file names
+    gcm: str
+        GCM name used in file names
+    years: Iterable
+        Years to export. Defaults to all years in ds.
+    persist: bool
+        If True, compute ds into memory before writing. If None, ds is 
+        persisted if it is smaller than memory_frac of the available memory.
+    memory_frac: float
+        Fraction of available memory that ds can use if persist is None
+
+    Returns
+    -------
+    list
+        File names of exported datasets
+    """
+
+    dest = Path(dest)
+
+    year = h.time_index(ds['time'])['year']
+
+    if years is None:
+        years = np.unique(year)
+
+    years = [yr for yr in years if np.any(year == yr)]
+
+    if persist is None:
+        available = h.available_memory()
+        persist = (available is not None) and \
+                  (ds.nbytes < memory_frac * available)
+
+    if persist and dask.is_dask_collection(ds):
+        ds = ds.persist()
+
+    datasets = [ds.isel(time=np.flatnonzero(year == yr)) for yr in years]
+    paths = [dest / ('%s_%s_%d.nc' % (var,gcm,yr)) for yr in years]
+
+    if len(datasets) > 0:
+        xr.save_mfdataset(datasets,paths,engine='h5netcdf')
+
+    return paths
+
 if __name__ == '__main__':    
 
     None
@@ -7,25 +7,18 @@ This module provides a set of functions to:
 """
 
 # Import required libraries
+import os
 from pathlib import Path
+import warnings
 
 import dask
+import dask.array as dsa
 import numpy as np
 import xclim as xc
 import xarray as xr
-import yaml
 
 from wildfire_analysis.utils import helpers as h
 
-# Get global values from configuration file
-config_fn = Path(h.get_root_dir()) / 'config.yaml'
-
-with open(config_fn,'r') as config_file:
-
-    config_params = yaml.safe_load(config_file)
-    
-    geo_lims = config_params['EXTENT']['geog_lims']
-
 # Suppress dask warnings on chunk size
 dask.config.set({"array.slicing.split_large_chunks": False})
 
@@ -118,6 +111,141 @@ def _calc_hursmin(ds: xr.Dataset,dask_compute=False) -> xr.DataArray:
 
     return hursmin
 
+# Check if hourly data are whole days, i.e. each block of 24 time steps is the
+# 24 hours of one day starting at 00:00, so days can be formed by reshaping the
+# time axis. Whole days can be missing, e.g. February 29th, which is dropped 
+# when reading (see _subset_era5).
+def _is_whole_days(time: xr.DataArray) -> bool:
+
+    t = time.values
+
+    if (len(t) == 0) or (len(t) % 24 != 0) or \
+       (not np.issubdtype(t.dtype,np.datetime64)):
+        return False
+
+    days = t.reshape(-1,24)
+    first_hour = days[:,0]
+
+    return bool(
+        np.all(np.diff(days,axis=1) == np.timedelta64(1,'h')) and
+        np.all(first_hour == first_hour.astype('datetime64[D]')) and
+        np.all(np.diff(first_hour) > np.timedelta64(0,'h')))
+
+# Daily summaries of a block of whole days of hourly data. All inputs are
+# numpy arrays with time as the first axis and are reshaped to 
+# (day, 24, ...), so each hourly value is only read once. Temperatures are 
+# converted to degC for relative humidity using t_offset. Returns the daily 
+# values stacked along a new first axis in the order of 'outputs'.
+def _daily_block(*arrays, varnames=None, outputs=None, t_offset=0.0):
+
+    hourly = {}
+    for k, x in zip(varnames,arrays):
+        hourly[k] = x.reshape((x.shape[0] // 24,24) + x.shape[1:])
+
+    daily = {}
+
+    # Skip missing values as in xarray's resample(...).max(), etc.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',category=RuntimeWarning)
+
+        if 'tasmax' in outputs:
+            daily['tasmax'] = np.nanmax(hourly['t2m'],axis=1)
+
+        if 'pr' in outputs:
+            daily['pr'] = np.nansum(hourly['tp'],axis=1)
+
+        if 'sfcWind' in outputs:
+            u10 = np.nanmean(hourly['u10'],axis=1)
+            v10 = np.nanmean(hourly['v10'],axis=1)
+            daily['sfcWind'] = np.sqrt(u10**2 + v10**2)
+
+        if 'hursmin' in outputs:
+            T = hourly['t2m'] - t_offset
+            Td = hourly['d2m'] - t_offset
+            hurs = 100 * np.exp((17.62*Td) / (243.12+Td) - \
+                                (17.62*T) / (243.12+T)) # [%]
+            daily['hursmin'] = np.nanmin(hurs,axis=1)
+
+    return np.stack([daily[k] for k in outputs])
+
+# Calculate all daily variables in a single pass through the hourly data. Each
+# chunk of hourly data is read once and all daily summaries are calculated 
+# from it, instead of a separate resample (and read) for each variable. The 
+# time axis needs to contain whole days (see '_is_whole_days').
+def _calc_daily(ds: xr.Dataset, outputs: list, dask_compute=False) -> dict:
+
+    input_vars = {
+        'tasmax': ['t2m'],
+        'pr': ['tp'],
+        'sfcWind': ['u10','v10'],
+        'hursmin': ['t2m','d2m'],
+        }
+
+    varnames = sorted(set(v for k in outputs for v in input_vars[k]))
+    hourly = [ds[k].transpose('time',...) for k in varnames]
+
+    t_offset = 0.0
+    if 'hursmin' in outputs:
+        if xc.units.str2pint(ds['t2m'].units).units == 'kelvin':
+            t_offset = 273.15
+
+    kwargs = {'varnames': varnames,'outputs': outputs,'t_offset': t_offset}
+
+    if dask.is_dask_collection(hourly[0]):
+        # Chunks along time are rounded to whole days
+        time_chunk = max(24,(hourly[0].chunks[0][0] // 24) * 24)
+        data = [x.data.rechunk({0: time_chunk}) for x in hourly]
+        data = dsa.map_blocks(
+            _daily_block,
+            *data,
+            new_axis=0,
+            chunks=((len(outputs),),
+                    tuple(c // 24 for c in data[0].chunks[0]),
+                    *data[0].chunks[1:]),
+            dtype=np.result_type(*data),
+            **kwargs)
+    else:
+        data = _daily_block(*[x.values for x in hourly],**kwargs)
+
+    # Daily coordinates are the first hour of each day, as in resample
+    daily_coords = hourly[0].isel(time=slice(None,None,24)).coords
+    dims = hourly[0].dims
+
+    daily = {k: xr.DataArray(data[i],coords=daily_coords,dims=dims,name=k) 
+             for i, k in enumerate(outputs)}
+
+    # Units and attributes as in the separate functions for each variable
+    if 'tasmax' in daily:
+        daily['tasmax'].attrs = {
+            'units': ds['t2m'].units,
+            'long_name': 'Daily maximum 2 metre temperature'}
+        daily['tasmax'] = xc.units.convert_units_to(daily['tasmax'],'degC')
+
+    if 'pr' in daily:
+        daily['pr'].attrs = {'units': ds['tp'].units}
+        daily['pr'] = xc.units.convert_units_to(daily['pr'],'mm')
+        daily['pr'] = daily['pr'].assign_attrs({'units': 'mm/day'})
+
+    if 'sfcWind' in daily:
+        daily['sfcWind'].attrs = {'units': ds['u10'].units,
+            'long_name': 'Average 10 metre horizontal wind speed'}
+        daily['sfcWind'] = xc.units.convert_units_to(daily['sfcWind'],
+                                                     'km/hour')
+
+    if 'hursmin' in daily:
+        daily['hursmin'] = daily['hursmin'].clip(min=0.0,max=100.0)
+        daily['hursmin'].attrs = {'units': '%',
+            'long_name': '2 metre minimum relative humidity'}
+
+    for k in daily:
+        daily[k].name = k
+
+    # Compute all daily variables together so hourly data are read once
+    if dask_compute and dask.is_dask_collection(data):
+        daily = dict(zip(daily,dask.compute(*daily.values())))
+
+    return daily
+
 # Organize ERA5 dataset
 def _organize_era5(ds: xr.Dataset) -> xr.Dataset:
 
@@ -131,8 +259,7 @@ def _organize_era5(ds: xr.Dataset) -> xr.Dataset:
         'latitude': 'lat',
         })
 
-    # Clip geographic limits
-    ds = h.trim_geolims(ds,geo_lims)
+    # Geographic limits are applied when reading, see _subset_era5
 
     # Convert calendar to 365 day years or 'noleap'
     ds = ds.convert_calendar('noleap')
@@ -155,7 +282,52 @@ def _organize_era5(ds: xr.Dataset) -> xr.Dataset:
 
     return ds
 
-def process_era5(src: str,dask_load=False) -> xr.Dataset:
+# Subset each file when it is opened, so only hourly data within the 
+# geographic limits and on days of the 'noleap' calendar are read from disk
+def _subset_era5(ds: xr.Dataset,geolims=None) -> xr.Dataset:
+
+    if geolims is None:
+        geolims = h.get_config('EXTENT')['geog_lims']
+
+    ds = h.subset_geolims(ds,geolims)
+    ds = h.drop_leap_days(ds)
+
+    return ds
+
+def process_era5(src: str,dask_load=False,geolims=None,
+                 dtype=None) -> xr.Dataset:
+
+    """
+    Description
+    -----------
+    Read hourly ERA5 data and calculate daily tasmax, pr, sfcWind and hursmin
+    for the variables present in src.
+
+    Parameters
+    ----------
+    src: str, pathlib.Path, list
+        ERA5 netcdf file(s) to read
+    dask_load: bool
+        If True, open files in parallel and compute the daily variables
+    geolims: Iterable
+        Geographic limits (left, bottom, right, top) to read, e.g. from 
+        helpers.geolims_from_shp. Defaults to 'EXTENT: geog_lims' in 
+        config.yaml.
+    dtype: str
+        Floating point type used for calculations and returned variables.
+        Defaults to 'CLIMATE: dtype' in config.yaml.
+
+    Returns
+    -------
+    xarray.Dataset
+        Daily ERA5 variables
+    """
+
+    if geolims is None:
+        geolims = h.get_config('EXTENT')['geog_lims']
+
+    if dtype is None:
+        dtype = h.get_config('CLIMATE')['dtype']
 
     # Use parallel=True, too large to load everything into memory at once
     ds = xr.open_mfdataset(
@@ -163,8 +335,12 @@ def process_era5(src: str,dask_load=False) -> xr.Dataset:
         parallel=dask_load,
         engine='h5netcdf',
         mask_and_scale=True,
+        preprocess=lambda x: _subset_era5(x,geolims),
         )
     
+    # Unpacked hourly values are cast to dtype before any calculations
+    ds = h.set_float_dtype(ds,dtype)
+
     # Get variable names for given dataset
     varnames = h.get_var_names(ds)
 
@@ -190,30 +366,154 @@ def process_era5(src: str,dask_load=False) -> xr.Dataset:
 
     export_dict = {}
 
+    outputs = [k for k, v in zip(['tasmax','pr','sfcWind','hursmin'],
+        [tasmax_bool,pr_bool,sfcWind_bool,hursmin_bool]) if v]
+
+    # If the hourly data are whole days, compute all daily variables in a 
+    # single pass. Otherwise, use resample for each variable separately.
+    if (len(outputs) > 0) and _is_whole_days(ds['time']):
+        export_dict = _calc_daily(ds,outputs,dask_compute=dask_load)
+        outputs = []
+
     # Create xarray dataset object, easier to do these daily summaries using 
     # groupby.
-    if tasmax_bool:
+    if tasmax_bool and ('tasmax' in outputs):
         tasmax = _calc_tasmax(ds['t2m'],dask_compute=dask_load)
         export_dict.update({'tasmax': tasmax})
 
-    if pr_bool:
+    if pr_bool and ('pr' in outputs):
         pr = _calc_pr(ds['tp'],dask_compute=dask_load)
         export_dict.update({'pr': pr})    
 
-    if sfcWind_bool:
+    if sfcWind_bool and ('sfcWind' in outputs):
         sfcWind = _calc_sfcWind(ds[['u10','v10']],dask_compute=dask_load)
         export_dict.update({'sfcWind': sfcWind})
 
-    if hursmin_bool:
+    if hursmin_bool and ('hursmin' in outputs):
         hursmin = _calc_hursmin(ds[['t2m','d2m']],dask_compute=dask_load)
         export_dict.update({'hursmin': hursmin})
 
     daily_ds = xr.merge([export_dict]) # Put dict in brackets to make iterable
+    daily_ds = h.set_float_dtype(daily_ds,dtype)
 
-    daily_ds = _organize_era5(daily_ds) # Final re-arrangement of coords
+    daily_ds = _organize_era5(daily_ds) # Final re-arrangement
 
     return daily_ds
 
+# Output file for a daily ERA5 variable in a given year
+def _era5_fn(dest,var: str,yr: int) -> Path:
+
+    return Path(dest) / ('%s_era5_%d.nc' % (var,yr))
+
+# Check that an output file exists, can be read, and has a full year of the
+# given variable
+def _valid_era5_file(fn: Path,var: str,ndays=365) -> bool:
+
+    if not fn.exists():
+        return False
+
+    try:
+        with xr.open_dataset(fn,engine='h5netcdf') as ds:
+            return (var in ds) and (ds[var].sizes['time'] == ndays)
+    except Exception:
+        return False
+
+# Process a single year of ERA5 data and write each daily variable. All 
+# variables are computed together and written to temporary files that are 
+# renamed once complete. Returns the variables that were written.
+def _era5_year(src_dir,dest,yr: int,variables: list,geolims,
+               overwrite: bool) -> list:
+
+    if not overwrite and all(_valid_era5_file(_era5_fn(dest,var,yr),var)
+                             for var in variables):
+        return []
+
+    src = sorted(Path(src_dir).glob('%d*.nc' % yr))
+
+    if len(src) == 0:
+        raise Exception('No ERA5 files found for %d in %s' % (yr,src_dir))
+
+    ds = process_era5(src,dask_load=True,geolims=geolims)
+
+    written = []
+    for var in h.get_var_names(ds):
+
+        if var not in variables:
+            continue
+
+        fn = _era5_fn(dest,var,yr)
+        ds[var].to_netcdf(fn.with_name(fn.name + '.tmp'),engine='h5netcdf')
+        os.replace(fn.with_name(fn.name + '.tmp'),fn)
+        written.append(var)
+
+    ds.close()
+
+    return written
+
+def process_era5_years(src_dir,
+                       dest,
+                       years,
+                       workers: int=1,
+                       memory_limit: int=None,
+                       geolims=None,
+                       variables=None,
+                       overwrite: bool=False,
+                       verbose: bool=False) -> list:
+
+    """
+    Description
+    -----------
+    Process hourly ERA5 files into daily variables for several years, with
+    years run in parallel in a pool of worker processes. For each year, all
+    daily variables are computed in one pass through the hourly data and 
+    written to '<var>_era5_<year>.nc' in dest. Years where all outputs exist
+    and are complete are skipped, so an interrupted run can be restarted.
+
+    Parameters
+    ----------
+    src_dir: str, pathlib.Path
+        Directory of hourly ERA5 files. Files for a year are found with the 
+        pattern '<year>*.nc'.
+    dest: str, pathlib.Path
+        Directory to write daily files to
+    years: Iterable
+        Years to process
+    workers: int
+        Number of worker processes. Default is 1, which processes all years
+        in the current process.
+    memory_limit: int
+        Maximum address space of each worker process in bytes. Years that 
+        exceed it fail and are reported in the returned records. Only used 
+        with workers > 1.
+    geolims: Iterable
+        Geographic limits to read, see process_era5
+    variables: list
+        Daily variables to write. Default is tasmax, pr, sfcWind and hursmin.
+    overwrite: bool
+        If True, process years even if outputs already exist
+    verbose: bool
+        If True, show a progress bar with the timing of each year
+
+    Returns
+    -------
+    list of dict
+        Record for each year (see 'helpers.run_tasks') with the year, the 
+        variables written ('outputs'), the status ('done', 'skipped', or 
+        'failed: <error>') and the elapsed time in seconds.
+    """
+
+    if variables is None:
+        variables = ['tasmax','pr','sfcWind','hursmin']
+
+    tasks = [({'year': yr},(src_dir,dest,yr,variables,geolims,overwrite))
+             for yr in years]
+
+    return h.run_tasks(_era5_year,tasks,
+                       workers=workers,
+                       memory_limit=memory_limit,
+                       desc='ERA5',
+                       verbose=verbose)
+
 if __name__ == '__main__':
 
     None
@@ -0,0 +1,519 @@
+"""
+Description
+-----------
+Quantile delta mapping (QDM) computed with numpy over blocks of grid cells, as
+an alternative to xclim.sdba.QuantileDeltaMapping (see the 'engine' argument
+of 'quantile_delta_mapping'). Values of each cell and group (e.g., month) are
+sorted once, the quantiles are taken from the sorted values in bulk, and
+adjustment factors are interpolated for all values of a block at once. Blocks
+are the spatial dask chunks of the data, so they can be computed in parallel
+by worker processes (see helpers.process_scheduler).
+
+The method follows xclim (version 0.40):
+
+    train: quantiles of ref and hst for each group (linear interpolation
+           between order statistics, as numpy.nanquantile), and adjustment
+           factors af = ref_q - hst_q (kind='+') or ref_q / hst_q (kind='*')
+    adjust: percentile rank of each sim value within its group (average rank
+            of ties divided by the number of values), adjustment factor
+            interpolated at the rank, and sim + af or sim * af
+
+For group='time.month', adjustment factors are also interpolated linearly
+between months, using the day of the month, with December and January
+wrapped around. As in xclim, this is linear interpolation on the Delaunay
+triangulation of the (quantile, month) points (scipy.spatial.Delaunay, as used
+by scipy.interpolate.griddata). The triangulation is the same for all cells,
+and splits each rectangle between two quantiles and two months into two
+triangles, so it is computed once and each value is interpolated in its
+triangle in bulk. Cells where some of the adjustment factors are NaN are 
+interpolated one at a time with griddata, as in xclim. Quantiles are computed
+in the floating point type of the data, as in xclim, so results match xclim 
+to floating point precision (see test/test_qdm/test_qdm_engines.py).
+"""
+
+import numpy as np
+import xarray as xr
+from scipy.interpolate import griddata
+from scipy.spatial import Delaunay
+
+# Supported groupings, and the number of groups of each
+GROUPS = {'time': 1,'time.month': 12}
+
+def equally_spaced_nodes(n: int) -> np.ndarray:
+
+    """
+    Description
+    -----------
+    n quantiles at the center of n equally sized intervals of [0,1], as used
+    by xclim when nquantiles is an integer.
+
+    Parameters
+    ----------
+    n: int
+        Number of quantiles
+
+    Returns
+    -------
+    numpy.ndarray
+        Quantile values
+    """
+
+    dq = 1 / n / 2
+
+    return np.linspace(dq,1 - dq,n)
+
+def group_index(time: xr.DataArray,group: str='time.month') -> tuple:
+
+    """
+    Description
+    -----------
+    Group of each time step, and position of each time step between the
+    groups for interpolation of adjustment factors between months.
+
+    Parameters
+    ----------
+    time: xarray.DataArray
+        Time coordinate
+    group: str
+        'time.month' or 'time' (no grouping)
+
+    Returns
+    -------
+    tuple(numpy.ndarray,numpy.ndarray)
+        Group (0-based) of each time step and its position between groups.
+        Position is month - 0.5 + day / days in month, or None if there is
+        only one group.
+    """
+
+    if group not in GROUPS:
+        raise Exception("group needs to be one of %s" % list(GROUPS))
+
+    if group == 'time':
+        return (np.zeros(time.size,dtype=int),None)
+
+    month = time.dt.month.values
+    pos = month - 0.5 + time.dt.day.values / time.dt.days_in_month.values
+
+    return (month - 1,pos)
+
+def _sorted_quantiles(x: np.ndarray,quantiles: np.ndarray) -> np.ndarray:
+
+    # Quantiles along the last axis of x (cell, time), excluding NaN values, by
+    # linear interpolation between order statistics. Returns (cell, quantile).
+    x = np.sort(x,axis=-1)
+    n = np.sum(~np.isnan(x),axis=-1)
+
+    pos = quantiles[None,:] * np.maximum(n - 1,0)[:,None]
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1,np.maximum(n - 1,0)[:,None])
+    t = pos - lo
+
+    x_lo = np.take_along_axis(x,lo,axis=-1)
+    x_hi = np.take_along_axis(x,hi,axis=-1)
+
+    out = x_lo + t * (x_hi - x_lo)
+    out[n == 0,:] = np.nan
+
+    return out
+
+def _pct_rank(x: np.ndarray) -> np.ndarray:
+
+    # Percentile rank along the last axis of x (cell, time), with ties given
+    # the average of their ranks, divided by the number of non-NaN values.
+    # NaN values have NaN ranks.
+    n = x.shape[-1]
+    order = np.argsort(x,axis=-1,kind='stable')
+    xs = np.take_along_axis(x,order,axis=-1)
+
+    idx = np.broadcast_to(np.arange(n),xs.shape)
+    ties = xs[:,1:] == xs[:,:-1]
+
+    if np.any(ties):
+
+        # First and last position of each run of equal values
+        start = np.ones(xs.shape,dtype=bool)
+        start[:,1:] = ~ties
+        end = np.ones(xs.shape,dtype=bool)
+        end[:,:-1] = ~ties
+
+        first = np.maximum.accumulate(np.where(start,idx,0),axis=-1)
+        last = np.minimum.accumulate(np.where(end,idx,n)[:,::-1],
+                                     axis=-1)[:,::-1]
+
+        rank_sorted = (first + last) / 2 + 1
+
+    else:
+
+        rank_sorted = idx + 1.0
+
+    count = np.sum(~np.isnan(x),axis=-1,keepdims=True)
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        rank_sorted = rank_sorted / count
+
+    rank = np.empty(x.shape)
+    np.put_along_axis(rank,order,rank_sorted,axis=-1)
+    rank[np.isnan(x)] = np.nan
+
+    return rank
+
+def _train_block(ref: np.ndarray,
+                 hst: np.ndarray,
+                 ref_group: np.ndarray,
+                 hst_group: np.ndarray,
+                 ngroups: int,
+                 quantiles: np.ndarray,
+                 kind: str) -> tuple:
+
+    # Adjustment factors and hst quantiles of a block (..., time). Returns
+    # arrays of shape (..., quantile, group) in the floating point type of 
+    # ref, as xclim.
+    shape, dtype = ref.shape[:-1], ref.dtype
+    ref = ref.reshape(-1,ref.shape[-1]).astype(np.float64)
+    hst = hst.reshape(-1,hst.shape[-1]).astype(np.float64)
+
+    ref_q = np.empty((ref.shape[0],quantiles.size,ngroups))
+    hst_q = np.empty((hst.shape[0],quantiles.size,ngroups))
+
+    for k in range(ngroups):
+        ref_q[:,:,k] = _sorted_quantiles(ref[:,ref_group == k],quantiles)
+        hst_q[:,:,k] = _sorted_quantiles(hst[:,hst_group == k],quantiles)
+
+    ref_q, hst_q = ref_q.astype(dtype), hst_q.astype(dtype)
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        if kind == '+':
+            af = ref_q - hst_q
+        elif kind == '*':
+            af = ref_q / hst_q
+
+    shape = shape + (quantiles.size,ngroups)
+
+    return (af.reshape(shape),hst_q.reshape(shape))
+
+def _grid_points(quantiles: np.ndarray,ngroups: int) -> tuple:
+
+    # (quantile, month) points of the adjustment factors with December added
+    # before January (0) and January after December (13), in the order used
+    # by xclim.sdba.utils.interp_on_quantiles (month, quantile).
+    months = np.arange(ngroups + 2)
+    x = np.broadcast_to(quantiles[None,:],(months.size,quantiles.size))
+    g = np.broadcast_to(months[:,None],(months.size,quantiles.size))
+
+    return (x.astype(np.float64),g.astype(np.float64))
+
+def triangle_diagonals(quantiles: np.ndarray,ngroups: int=12) -> np.ndarray:
+
+    """
+    Description
+    -----------
+    Diagonals of the Delaunay triangulation of the (quantile, month) points of
+    the adjustment factors, which scipy.interpolate.griddata (used by xclim)
+    interpolates on linearly. Each rectangle between two quantiles and two
+    months is split into two triangles by one of its diagonals.
+
+    Parameters
+    ----------
+    quantiles: numpy.ndarray
+        Quantile values
+    ngroups: int
+        Number of months
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean array (quantile, month) of rectangles, True if the diagonal 
+        joins the lower quantile of the first month to the upper quantile of 
+        the second month, False if it joins the upper quantile of the first
+        month to the lower quantile of the second month
+    """
+
+    x, g = _grid_points(quantiles,ngroups)
+    nq = quantiles.size
+
+    tri = Delaunay(np.column_stack([x.ravel(),g.ravel()]))
+
+    # Rectangle and missing corner of each triangle
+    iq, ig = tri.simplices % nq, tri.simplices // nq
+    iq0, ig0 = iq.min(axis=1), ig.min(axis=1)
+
+    if np.any(iq.max(axis=1) - iq0 != 1) or np.any(ig.max(axis=1) - ig0 != 1):
+        raise Exception('Triangulation of quantiles and months is not split '
+                        'into rectangles')
+
+    corners = (iq - iq0[:,None]) + 2 * (ig - ig0[:,None])
+    missing = 6 - corners.sum(axis=1)
+
+    diagonals = np.zeros((nq - 1,ngroups + 1),dtype=bool)
+    diagonals[iq0,ig0] = (missing == 1) | (missing == 2)
+
+    return diagonals
+
+def _interp_griddata(rank: np.ndarray,
+                     pos: np.ndarray,
+                     af: np.ndarray,
+                     quantiles: np.ndarray,
+                     extrapolation: str) -> np.ndarray:
+
+    # Adjustment factors of one cell at (rank, pos) with af (quantile, month
+    # 0-13) that has NaN values, with scipy.interpolate.griddata on the 
+    # non-NaN points, as xclim.sdba.utils._interp_on_quantiles_2D
+    x, g = _grid_points(quantiles,af.shape[-1] - 2)
+    af = af.T
+
+    out = np.full(rank.shape,np.nan)
+    valid = ~np.isnan(af)
+    new = ~np.isnan(rank)
+
+    if not np.any(valid) or not np.any(new):
+        return out
+
+    out[new] = griddata((x[valid],g[valid]),af[valid],(rank[new],pos[new]),
+                        method='linear')
+
+    # First and last non-NaN adjustment factors of each month
+    first = np.argmax(valid,axis=-1)
+    last = af.shape[-1] - 1 - np.argmax(valid[:,::-1],axis=-1)
+    months = np.arange(af.shape[0])
+
+    low = rank < quantiles[0]
+    high = rank > quantiles[-1]
+
+    if extrapolation == 'constant':
+        out[low] = np.interp(pos[low],months,af[months,first])
+        out[high] = np.interp(pos[high],months,af[months,last])
+    else:
+        out[low | high] = np.nan
+
+    return out
+
+def _adjust_block(sim: np.ndarray,
+                  af: np.ndarray,
+                  sim_group: np.ndarray,
+                  sim_pos: np.ndarray,
+                  quantiles: np.ndarray,
+                  diagonals: np.ndarray,
+                  kind: str,
+                  extrapolation: str) -> np.ndarray:
+
+    # Adjust a block of sim (..., time) with af (..., quantile, group)
+    shape, dtype = sim.shape, sim.dtype
+    sim = sim.reshape(-1,shape[-1]).astype(np.float64)
+    af = af.reshape((sim.shape[0],) + af.shape[-2:]).astype(np.float64)
+    ngroups = af.shape[-1]
+    quantiles = quantiles.astype(np.float64)
+
+    # Rank of each value within its group
+    rank = np.full(sim.shape,np.nan)
+    for k in range(ngroups):
+        sel = sim_group == k
+        rank[:,sel] = _pct_rank(sim[:,sel])
+
+    # Position of ranks between quantiles. Ranks outside the range of
+    # quantiles use the first or last adjustment factor ('constant').
+    outside = (rank < quantiles[0]) | (rank > quantiles[-1])
+    rank_in = np.clip(np.nan_to_num(rank,nan=quantiles[0]),
+                      quantiles[0],quantiles[-1])
+
+    i = np.searchsorted(quantiles,rank_in,side='right') - 1
+    i = np.clip(i,0,quantiles.size - 2)
+    u = (rank_in - quantiles[i]) / (quantiles[i+1] - quantiles[i])
+
+    def af_at(af,iq,g):
+        # Adjustment factors at quantile iq of group g, indexing the 
+        # flattened (quantile, group) axes of each cell
+        ng = af.shape[-1]
+        k = iq * ng + g[None,:]
+        return np.take_along_axis(af.reshape(af.shape[0],-1),k,axis=-1)
+
+    if sim_pos is None:
+
+        af_sim = (1 - u) * af_at(af,i,sim_group) + u * af_at(af,i+1,sim_group)
+
+    else:
+
+        # Add December before January and January after December. Each value
+        # is in the rectangle between quantiles i, i+1 and months g, g+1, and
+        # is interpolated linearly in the triangle of the rectangle it is in.
+        af = np.concatenate([af[...,-1:],af,af[...,:1]],axis=-1)
+        g = np.clip(np.floor(sim_pos).astype(int),0,ngroups)
+        v = np.broadcast_to((sim_pos - g)[None,:],u.shape)
+
+        f00, f10 = af_at(af,i,g), af_at(af,i+1,g)
+        f01, f11 = af_at(af,i,g+1), af_at(af,i+1,g+1)
+
+        rising = diagonals[i,g[None,:]]
+
+        af_sim = np.where(
+            rising,
+            np.where(u >= v,
+                     f00 + u * (f10 - f00) + v * (f11 - f10),
+                     f00 + v * (f01 - f00) + u * (f11 - f01)),
+            np.where(u + v <= 1,
+                     f00 + u * (f10 - f00) + v * (f01 - f00),
+                     f11 + (1 - u) * (f01 - f11) + (1 - v) * (f10 - f11)))
+
+        # Cells with some NaN adjustment factors are interpolated on their 
+        # non-NaN points only
+        nan_af = np.isnan(af).reshape(af.shape[0],-1)
+        partial = np.flatnonzero(nan_af.any(axis=-1) & ~nan_af.all(axis=-1))
+        for c in partial:
+            af_sim[c] = _interp_griddata(rank[c],sim_pos,af[c],quantiles,
+                                         extrapolation)
+
+    if extrapolation == 'nan':
+        af_sim[outside] = np.nan
+
+    if kind == '+':
+        out = sim + af_sim
+    elif kind == '*':
+        out = sim * af_sim
+
+    return out.reshape(shape).astype(dtype,copy=False)
+
+class NumpyQDM:
+
+    """
+    Description
+    -----------
+    Quantile delta mapping with numpy, with the interface of
+    xclim.sdba.QuantileDeltaMapping used in 'quantile_delta_mapping' (train,
+    adjust, from_dataset, and the trained dataset in ds). Input data arrays
+    can be numpy or dask arrays. Dask arrays need a single chunk along time,
+    and each spatial chunk is computed separately.
+    """
+
+    def __init__(self,ds: xr.Dataset):
+
+        self.ds = ds
+
+    @classmethod
+    def train(cls,
+              ref: xr.DataArray,
+              hst: xr.DataArray,
+              group: str='time.month',
+              nquantiles=20,
+              kind: str='+'):
+
+        """
+        Description
+        -----------
+        Quantiles of hst and adjustment factors from ref to hst for each group.
+
+        Parameters
+        ----------
+        ref: xarray.DataArray
+            Reference dataset
+        hst: xarray.DataArray
+            Historical GCM output
+        group: str
+            'time.month' or 'time' (no grouping)
+        nquantiles: int or numpy.ndarray
+            Number of equally spaced quantiles, or quantile values
+        kind: str
+            '+' (additive) or '*' (multiplicative)
+
+        Returns
+        -------
+        NumpyQDM
+            Trained object, with adjustment factors (af) and hst quantiles
+            (hist_q) in ds
+        """
+
+        if kind not in ('+','*'):
+            raise Exception("kind needs to be either '+' or '*'")
+
+        # Quantiles in the floating point type of the data, as xclim
+        if np.isscalar(nquantiles):
+            quantiles = equally_spaced_nodes(nquantiles).astype(ref.dtype)
+        else:
+            quantiles = np.asarray(nquantiles).astype(ref.dtype)
+
+        ref_group, _ = group_index(ref['time'],group)
+        hst_group, _ = group_index(hst['time'],group)
+        ngroups = GROUPS[group]
+
+        af, hist_q = xr.apply_ufunc(
+            _train_block,ref,hst,
+            input_core_dims=[['time'],['time']],
+            output_core_dims=[['quantiles','group'],['quantiles','group']],
+            exclude_dims={'time'},
+            dask='parallelized',
+            output_dtypes=[ref.dtype,ref.dtype],
+            dask_gufunc_kwargs={'output_sizes': {'quantiles': quantiles.size,
+                                                 'group': ngroups}},
+            kwargs={'ref_group': ref_group,
+                    'hst_group': hst_group,
+                    'ngroups': ngroups,
+                    'quantiles': quantiles,
+                    'kind': kind})
+
+        ds = xr.Dataset({'af': af,'hist_q': hist_q})
+        ds = ds.assign_coords(quantiles=quantiles,
+                              group=np.arange(1,ngroups+1))
+        ds = ds.assign_attrs(group=group,kind=kind)
+
+        return cls(ds)
+
+    @classmethod
+    def from_dataset(cls,ds: xr.Dataset):
+
+        """
+        Trained object from a dataset saved from ds.
+        """
+
+        return cls(ds)
+
+    def adjust(self,
+               sim: xr.DataArray,
+               interp: str='linear',
+               extrapolation: str='constant') -> xr.DataArray:
+
+        """
+        Description
+        -----------
+        Bias correct sim with the trained adjustment factors.
+
+        Parameters
+        ----------
+        sim: xarray.DataArray
+            GCM output to bias correct
+        interp: str
+            Interpolation between quantiles, only 'linear' is available
+        extrapolation: str
+            'constant' to use the adjustment factors of the first and last
+            quantiles for ranks outside the range of quantiles, or 'nan'
+
+        Returns
+        -------
+        xarray.DataArray
+            Bias corrected sim
+        """
+
+        if interp != 'linear':
+            raise Exception("Only interp='linear' is available")
+
+        if extrapolation not in ('constant','nan'):
+            raise Exception("extrapolation needs to be 'constant' or 'nan'")
+
+        sim_group, sim_pos = group_index(sim['time'],self.ds.attrs['group'])
+
+        quantiles = self.ds['quantiles'].values
+        ngroups = GROUPS[self.ds.attrs['group']]
+        diagonals = triangle_diagonals(quantiles,ngroups) if ngroups > 1 \
+            else None
+
+        out = xr.apply_ufunc(
+            _adjust_block,sim,self.ds['af'],
+            input_core_dims=[['time'],['quantiles','group']],
+            output_core_dims=[['time']],
+            dask='parallelized',
+            output_dtypes=[sim.dtype],
+            kwargs={'sim_group': sim_group,
+                    'sim_pos': sim_pos,
+                    'quantiles': quantiles,
+                    'diagonals': diagonals,
+                    'kind': self.ds.attrs['kind'],
+                    'extrapolation': extrapolation})
+
+        return out.transpose(*sim.dims)
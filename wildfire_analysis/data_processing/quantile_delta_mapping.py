@@ -1,3 +1,6 @@
+import hashlib
+import json
+import os
 import pathlib
 
 import dask
@@ -7,6 +10,7 @@ from xclim.core.units import str2pint
 from xclim.sdba import QuantileDeltaMapping
 from xclim.sdba.processing import jitter_under_thresh
 
+from wildfire_analysis.data_processing.qdm_numpy import NumpyQDM
 from wildfire_analysis.utils import helpers as h
 
 import warnings
@@ -17,6 +21,9 @@ warnings.filterwarnings('ignore',
 # Suppress dask warnings on chunk size
 dask.config.set({"array.slicing.split_large_chunks": False})    
 
+# Classes that train and adjust quantile delta mapping for each engine
+ENGINES = {'xclim': QuantileDeltaMapping,'numpy': NumpyQDM}
+
 def same_vals(x) -> bool:
 
     """
@@ -55,8 +62,10 @@ def same_units(*args):
 
 def dimcheck_and_regrid(ref: xr.DataArray,
                         hst: xr.DataArray,
-                        sim: xr.DataArray,
-                        regrid: str='era2gcm') -> tuple:
+                        *sim: xr.DataArray,
+                        regrid: str='era2gcm',
+                        regrid_method: str='linear',
+                        regrid_cache_dir=None) -> tuple:
 
     """
     Description
@@ -70,23 +79,28 @@ def dimcheck_and_regrid(ref: xr.DataArray,
         Reference dataset
     hst: xarray.DataArray
         Historical GCM output
-    sim: xarray.DataArray
-        Projected GCM Output
+    *sim: xarray.DataArray
+        Projected GCM Output, one or more periods
     regrid: str
         Which direction to do regridding/linear interpolation. Options are
         'era2gcm' which will regrid ERA5 data to scale of GCM. Other option is
         'gcm2era' which will regrid GCM to scale of ERA5.
+    regrid_method: str
+        Method passed to helpers.regrid_geodata ('linear' or 'conservative')
+    regrid_cache_dir: str or pathlib.Path
+        Directory to save/load regridding weights. Weights are computed once
+        for each pair of grids and reused for hst and sim.
 
     Returns
     -------
-    tuple of xarray.DatasArrays for ref, hst, and sim
+    tuple of xarray.DatasArrays for ref, hst, and each sim
     """
   
     ref_shape = ref.shape    
     hst_shape = hst.shape
-    sim_shape = sim.shape
+    sim_shape = [x.shape for x in sim]
 
-    shape_check_1 = same_vals([ref_shape,hst_shape,sim_shape])
+    shape_check_1 = same_vals([ref_shape,hst_shape] + sim_shape)
 
     # If datasets are not the same size then regridding needs to be done   
     if not shape_check_1: # If datasets are not the same size ...
@@ -95,32 +109,36 @@ def dimcheck_and_regrid(ref: xr.DataArray,
             raise Exception("Array shapes not equal, need to do regridding and \
                 'regrid' argument needs to be either 'era2gcm' or 'gcm2era'")
 
+        regrid_kwargs = {'method': regrid_method,
+                         'cache_dir': regrid_cache_dir}
+
         if regrid == 'era2gcm':
             
-            ref = h.regrid_geodata(ref,hst)
+            ref = h.regrid_geodata(ref,hst,**regrid_kwargs)
 
         elif regrid == 'gcm2era':
             
-            hst = h.regrid_geodata(hst,ref)
-            sim = h.regrid_geodata(sim,ref)
+            hst = h.regrid_geodata(hst,ref,**regrid_kwargs)
+            sim = [h.regrid_geodata(x,ref,**regrid_kwargs) for x in sim]
 
         ref_shape = ref.shape
-        hst_shape = ref.shape    
-        sim_shape = sim.shape
+        hst_shape = hst.shape    
+        sim_shape = [x.shape for x in sim]
 
         # Check to make sure regridding worked and also double checks to make 
         # sure time dims are the same size across datasets
         
-        if not same_vals([ref_shape,hst_shape,sim_shape]):
+        if not same_vals([ref_shape,hst_shape] + sim_shape):
             raise Exception("ref,hst,sim array shapes are not equal! \
                 Double check input. Time dimensions need to be same as well.")
 
-    return (ref,hst,sim)                 
+    return (ref,hst,*sim)                 
 
 def mask_arrays(ref: xr.DataArray,
                 hst: xr.DataArray,
-                sim: xr.DataArray,
-                mask=None) -> tuple:
+                *sim: xr.DataArray,
+                mask=None,
+                mask_cache_dir=None) -> tuple:
 
     """
     Description
@@ -134,15 +152,18 @@ def mask_arrays(ref: xr.DataArray,
         Reference dataset
     hst: xarray.DataArray
         Historical GCM output
-    sim: xarray.DataArray
-        Projected GCM Output
+    *sim: xarray.DataArray
+        Projected GCM Output, one or more periods
     mask: None or str or pathlib.Path
         If a spatial mask is to be applied, provide path to ESRI shapefile
         that defines the mask
+    mask_cache_dir: None or str or pathlib.Path
+        Directory to save/load the mask from the shapefile (see 
+        helpers.mask_from_shp)
 
     Returns
     -------
-    tuple of xarray.DatasArrays for ref, hst, and sim
+    tuple of xarray.DatasArrays for ref, hst, and each sim
     """
 
     if mask is not None:
@@ -154,48 +175,228 @@ def mask_arrays(ref: xr.DataArray,
 
         elif isinstance(mask,pathlib.PosixPath) or isinstance(mask,str):
 
-            mask_grd = h.mask_from_shp(mask,ref)
+            mask_grd = h.mask_from_shp(mask,ref,cache_dir=mask_cache_dir)
+
+        # 2-D mask broadcast against time lazily
+        mask_grd = h.mask_to_dataarray(mask_grd,ref)
+
+        ref = h.apply_mask(ref,mask_grd)
+        hst = h.apply_mask(hst,mask_grd)
+        sim = [h.apply_mask(x,mask_grd) for x in sim]
+
+    return (ref,hst,*sim)
+
+def chunk_data_arrays(ref,hst,*sim,workers=None,memory_budget=None,
+                      frac=None):
+
+    """
+    Partition datasets into dask chunks for parallel processing. Chunk sizes
+    are chosen by helpers.plan_chunks so that each worker stays within 
+    memory_budget (bytes, default is part of the available memory). Time 
+    dimension cannot be broken up for doing quantile mapping.
+
+    frac is deprecated, use memory_budget instead. It is converted to the
+    memory_budget of chunks that are frac the size of each spatial dimension.
+    """
+
+    # Chunks of ref, hst and sim, and float64 copies and temporary arrays of
+    # the quantile mapping
+    copies = 16
+
+    if frac is not None:
+        warnings.warn("'frac' is deprecated, use 'memory_budget' instead",
+                      DeprecationWarning,stacklevel=2)
+        if memory_budget is None:
+            memory_budget = copies * ref.dtype.itemsize * int(np.prod(
+                [n if d == 'time' else max(1,round(n * frac)) 
+                 for d, n in ref.sizes.items()]))
+
+    chunks = h.plan_chunks(ref.sizes,ref.dtype,whole_dims=('time',),
+                           workers=workers,memory_budget=memory_budget,
+                           copies=copies)
+    chunks['time'] = -1
+
+    ref = ref.chunk(chunks=chunks)
+    hst = hst.chunk(chunks=chunks)
+    sim = [x.chunk(chunks=chunks) for x in sim]
     
-        mask_3d = np.broadcast_to(mask_grd,ref.shape)
+    return (ref,hst,*sim)
+
+def _src_hash(sha,src) -> None:
+
+    # Add files (name, size and modification time), arrays, or other values to
+    # a hash of the QDM inputs
+    if isinstance(src,(list,tuple)):
+        sha.update(b'[')
+        for x in src:
+            _src_hash(sha,x)
+        sha.update(b']')
 
-        ref = ref.where(mask_3d)
-        hst = hst.where(mask_3d)
-        sim = sim.where(mask_3d)
+    elif isinstance(src,(str,pathlib.Path)) and pathlib.Path(src).exists():
+        fn = pathlib.Path(src).resolve()
+        stat = fn.stat()
+        sha.update(('%s %d %d;' % (fn,stat.st_size,stat.st_mtime_ns)).encode())
 
-    return (ref,hst,sim)
+    elif isinstance(src,np.ndarray):
+        sha.update(json.dumps(src.tolist()).encode())
 
-def chunk_data_arrays(ref,hst,sim,frac=0.2):
+    else:
+        sha.update(json.dumps(src,default=str).encode())
+
+def qdm_cache_key(ref_src: list,
+                  hst_src: list,
+                  min_thresh: float=None,
+                  dtype=None,
+                  **kwargs) -> str:
 
     """
-    Partition dataset into dask chunks for parallel processing if set to True.
-    Currently set to 20% the size of each dimension, can modify this later to 
-    make it more dynamic. Time dimension cannot be broken up for doing quantile
-    mapping.
+    Description
+    -----------
+    Key identifying a trained quantile delta mapping. Hash of the reference 
+    and historical files (name, size and modification time) and of the 
+    parameters that change the training: kind, nquantiles, group, min_thresh,
+    dtype, regridding, mask, engine and cells.
+
+    Parameters
+    ----------
+    ref_src: list
+        List of paths to files of reference datasets
+    hst_src: list
+        List of paths to files of historical datasets
+    min_thresh: float
+        Minimum threshold below which all values are assumed equal to zero
+    dtype: str
+        Floating point type of the data
+    **kwargs: keyword arguments passed to quantile_delta_mapping
+
+    Returns
+    -------
+    str
+        Hash of inputs and parameters
     """
 
-    axes = h.get_geoaxes(ref)
+    sha = hashlib.sha1()
 
-    n, m = (ref[axes['X'][0]].size, ref[axes['X'][0]].size)
+    _src_hash(sha,ref_src)
+    _src_hash(sha,hst_src)
+    _src_hash(sha,min_thresh)
+    _src_hash(sha,dtype)
 
-    ref = ref.chunk(chunks={
-        'time':-1,
-        'lat': round(n * frac),
-        'lon': round(m * frac)
-        })
+    for k in ('kind','nquantiles','group','regrid','regrid_method','mask',
+              'engine','cells'):
+        sha.update(k.encode())
+        v = kwargs.get(k)
+        _src_hash(sha,np.asarray(v) if k == 'nquantiles' else v)
 
-    hst = hst.chunk(chunks={
-        'time':-1,
-        'lat': round(n * frac),
-        'lon': round(m * frac)
-        })
+    return sha.hexdigest()[:16]
 
-    sim = sim.chunk(chunks={
-        'time':-1,
-        'lat': round(n * frac),
-        'lon': round(m * frac)
-        })
-    
-    return (ref,hst,sim)
+def train_qdm(ref: xr.DataArray,
+              hst: xr.DataArray,
+              cache_fn=None,
+              engine: str='xclim',
+              **kwargs):
+
+    """
+    Description
+    -----------
+    Training step of quantile delta mapping. The trained quantiles and 
+    adjustment factors (for each group, e.g. month) are loaded into memory so 
+    they are computed only once for all periods adjusted with them. If 
+    cache_fn is supplied they are saved to that file, or read from it if it 
+    already exists, in which case ref and hst are not read.
+
+    Parameters
+    ----------
+    ref: xarray.DataArray
+        Reference dataset
+    hst: xarray.DataArray
+        Historical GCM output
+    cache_fn: str or pathlib.Path
+        Netcdf file to save/load the trained dataset (see qdm_cache_key)
+    engine: str
+        'xclim' to use xclim.sdba.QuantileDeltaMapping or 'numpy' to use 
+        qdm_numpy.NumpyQDM
+    **kwargs: keyword arguments passed to the train method (group, 
+        nquantiles, kind)
+
+    Returns
+    -------
+    xclim.sdba.QuantileDeltaMapping or qdm_numpy.NumpyQDM
+        Trained object
+    """
+
+    if engine not in ENGINES:
+        raise Exception("engine needs to be one of %s" % list(ENGINES))
+
+    if (cache_fn is not None) and pathlib.Path(cache_fn).exists():
+
+        with xr.open_dataset(cache_fn,engine='h5netcdf') as trained:
+            return ENGINES[engine].from_dataset(trained.load())
+
+    QDM = ENGINES[engine].train(ref,hst,
+        **h.get_kwargs(('group','nquantiles','kind'),kwargs))
+
+    QDM.ds.load()
+
+    if cache_fn is not None:
+
+        cache_fn = pathlib.Path(cache_fn)
+        cache_fn.parent.mkdir(parents=True,exist_ok=True)
+
+        tmp_fn = cache_fn.with_name(cache_fn.name + '.tmp')
+        QDM.ds.to_netcdf(tmp_fn,engine='h5netcdf')
+        os.replace(tmp_fn,cache_fn)
+
+    return QDM
+
+def adjust_qdm(QDM,
+               x: xr.DataArray,
+               min_thresh: float=None,
+               dtype=None,
+               **kwargs) -> xr.DataArray:
+
+    """
+    Description
+    -----------
+    Bias correct x with a trained quantile delta mapping. Jittered values 
+    under min_thresh are set back to 0, and the name and attributes of x are
+    kept.
+
+    Parameters
+    ----------
+    QDM: xclim.sdba.QuantileDeltaMapping or qdm_numpy.NumpyQDM
+        Trained object (see train_qdm)
+    x: xarray.DataArray
+        GCM output to bias correct
+    min_thresh: float
+        Minimum threshold below which all values are assumed equal to zero
+    dtype: str
+        Floating point type of the results
+    **kwargs: keyword arguments passed to QDM.adjust (interp, extrapolation)
+
+    Returns
+    -------
+    xarray.DataArray
+        Bias corrected x
+    """
+
+    x_ba = QDM.adjust(x,**h.get_kwargs(('interp','extrapolation'),kwargs))
+
+    # Set all jittered values back to 0
+    if min_thresh is not None:
+
+        x_ba = xr.where(x_ba > min_thresh,x_ba,0.0)
+
+    if dtype is not None:
+        x_ba = h.set_float_dtype(x_ba,dtype)
+
+    # The xclim function renames the variable, this is just setting it back to
+    # the original name, and makes sure the proper attributes remain with the
+    # data array.
+    x_ba = x_ba.rename(x.name)
+    x_ba = x_ba.assign_attrs(x.attrs)
+
+    return x_ba
 
 def quantile_delta_mapping(
         ref_src: list,
@@ -205,12 +406,22 @@ def quantile_delta_mapping(
         return_hst=False,
         dask_load=False,
         dask_return=False,
+        dtype=None,
+        train_cache_dir=None,
+        engine: str='xclim',
+        workers: int=1,
+        cells: bool=False,
+        cell_index_fn=None,
+        return_cells: bool=False,
         **kwargs) -> tuple:
     
     """
     Description
     -----------
-    Perform quantile delta mapping usin xclim package
+    Perform quantile delta mapping usin xclim package, or the numpy engine in
+    qdm_numpy. The reference and historical data are read once and trained 
+    once, and the trained object adjusts the historical data and each 
+    simulation period.
 
     Parameters
     ----------
@@ -219,7 +430,8 @@ def quantile_delta_mapping(
     hst_src: list
         List of paths to files of historical datasets
     sim_src: list
-        List of paths to files of simulation/projected datasets
+        List of paths to files of simulation/projected datasets, or list of
+        such lists for several simulation periods
     min_thresh: float
         Minimum threshold below which all values are assumed equal to zero
     return_hst: bool
@@ -228,65 +440,102 @@ def quantile_delta_mapping(
         Should the dataset be read in using dask in parallel
     dask_return: bool
         Should a dask array be returned
+    dtype: str
+        Floating point type of the data and results. Defaults to 'CLIMATE: 
+        dtype' in config.yaml. Quantiles are computed by xclim, which uses
+        float64 internally where needed.
+    train_cache_dir: str or pathlib.Path
+        Directory to save/load trained quantiles and adjustment factors. Files
+        are named by a hash of ref_src, hst_src and the QDM parameters (see 
+        qdm_cache_key), so training is only done once for the same inputs.
+    engine: str
+        'xclim' (xclim.sdba.QuantileDeltaMapping) or 'numpy' 
+        (qdm_numpy.NumpyQDM), which sorts the values of each cell and month 
+        once and computes each spatial chunk with numpy
+    workers: int
+        Number of worker processes to compute spatial chunks in parallel 
+        (see helpers.process_scheduler) for training, and for the results if
+        dask_return=False. Only used if dask_load=True. Chunk sizes are 
+        planned for this number of workers and the 'memory_budget' keyword
+        argument (bytes per worker, see chunk_data_arrays). The older 'frac'
+        keyword argument is deprecated and converted to a memory_budget.
+    cells: bool
+        If True, only the cells with values in the masked reference data (the
+        active domain) are kept, along a 1-D 'cell' dimension (see 
+        helpers.stack_cells), so masked or ocean cells are not read into 
+        chunks, trained or adjusted
+    cell_index_fn: str or pathlib.Path
+        Netcdf file to save/load the index of active cells (see 
+        helpers.cell_index). Only used if cells=True.
+    return_cells: bool
+        If True (and cells=True), results are returned along the 'cell' 
+        dimension, otherwise they are put back on the grid with NaN outside 
+        the active domain
     **kwargs: additional keyword arguments to be passed on to various functions
 
     Returns
     -------
-    tuple of xarray.DataArrays containing resulsts from bias correcting
+    tuple of xarray.DataArrays containing resulsts from bias correcting, hst 
+    first (if return_hst=True) followed by each simulation period
                         
     """
 
     if dask_load is False:
         dask_return = False
 
-    # Read in datasets for reference time period (ref), historical overlap of 
-    # gcm (hst), and future simulation/projection period (sim)
-    ref = xr.open_mfdataset(
-        ref_src,
-        engine='h5netcdf',
-        parallel=dask_load,
-        chunks={'time':365,'lon':-1,'lat':-1}
-        )
+    if dtype is None:
+        dtype = h.get_config('CLIMATE')['dtype']
 
-    hst = xr.open_mfdataset(
-        hst_src,
-        engine='h5netcdf',
-        parallel=dask_load,
-        chunks={'time':365,'lon':-1,'lat':-1}
-        )
+    # A single simulation period can be given as a list of files
+    if isinstance(sim_src[0],(str,pathlib.Path)):
+        sim_src = [sim_src]
 
-    sim = xr.open_mfdataset(
-        sim_src,
+    # Read in datasets for reference time period (ref), historical overlap of 
+    # gcm (hst), and future simulation/projection periods (sim)
+    ref, hst, *sim = [xr.open_mfdataset(
+        src,
         engine='h5netcdf',
         parallel=dask_load,
         chunks={'time':365,'lon':-1,'lat':-1}
-        )
+        ) for src in [ref_src,hst_src] + sim_src]
 
     # Check to make sure the variable (e.g. precip) is the same for each dataset
-    var = check_var_names(ref,hst,sim)
+    var = check_var_names(ref,hst,*sim)
 
     # Convert from dataset to dataarray
     ref = ref[var]
     hst = hst[var]
-    sim = sim[var]
+    sim = [x[var] for x in sim]
 
     # Will raise Exception if not all the same.
-    same_units(ref,hst,sim)
+    same_units(ref,hst,*sim)
     
     # Do regridding so all data arrays are aligned and have the same shape and
-    # dimensions
-    ref, hst, sim = dimcheck_and_regrid(ref,hst,sim,
-        **h.get_kwargs(('regrid',),kwargs))
+    # dimensions. Interpolation can return float64, so cast to dtype after.
+    ref, hst, *sim = dimcheck_and_regrid(ref,hst,*sim,
+        **h.get_kwargs(('regrid','regrid_method','regrid_cache_dir'),kwargs))
+
+    ref, hst, *sim = [h.set_float_dtype(x,dtype) for x in [ref,hst] + sim]
 
     # Apply spatial mask, does nothing if 'mask=None'
-    ref, hst, sim = mask_arrays(ref,hst,sim,
-        **h.get_kwargs(('mask',),kwargs))
+    ref, hst, *sim = mask_arrays(ref,hst,*sim,
+        **h.get_kwargs(('mask','mask_cache_dir'),kwargs))
+
+    # Keep only the active cells along a 1-D 'cell' dimension
+    index = None
+    if cells:
+
+        domain = ref.isel(time=0).notnull().values
+        index = h.cell_index(domain,ref,index_fn=cell_index_fn)
+
+        ref, hst, *sim = [h.stack_cells(x,index) for x in [ref,hst] + sim]
 
     # If working with dask arrays, set chunks so time dimension is not broken up
     # This is a requirement for using sdba.QuantileDeltaMapping
     if dask_load:
-        ref, hst, sim = chunk_data_arrays(ref,hst,sim,
-            **h.get_kwargs(('frac',),kwargs))
+        ref, hst, *sim = chunk_data_arrays(ref,hst,*sim,
+            workers=workers if workers > 1 else None,
+            **h.get_kwargs(('memory_budget','frac'),kwargs))
 
     # Apply uniform random variable if value is less then preset amount. Mainly
     # used for precip (e.g., 0.5 mm/day)
@@ -294,58 +543,38 @@ def quantile_delta_mapping(
 
         thresh_str = "%0.3f %s" % (min_thresh,ref.attrs['units'])
 
-        ref = jitter_under_thresh(ref,thresh_str)
-        hst = jitter_under_thresh(hst,thresh_str)
-        sim = jitter_under_thresh(sim,thresh_str)    
+        ref, hst, *sim = [h.set_float_dtype(
+            jitter_under_thresh(x,thresh_str),dtype).rename(var) 
+            for x in [ref,hst] + sim]
 
-    # Training step in Quantile delta mapping
-    QDM = QuantileDeltaMapping.train(ref,hst,
-        **h.get_kwargs(('group','nquantiles','kind'),kwargs))        
+    # Training step in Quantile delta mapping, or trained values from an
+    # earlier run with the same inputs
+    cache_fn = None
+    if train_cache_dir is not None:
+        key = qdm_cache_key(ref_src,hst_src,min_thresh=min_thresh,dtype=dtype,
+                            engine=engine,cells=cells,**kwargs)
+        cache_fn = pathlib.Path(train_cache_dir) / ('qdm_%s_%s.nc' % (var,key))
 
-    # Declare empty tuple to store output
-    return_ds = ()
+    with dask.config.set(h.process_scheduler(workers)):
+        QDM = train_qdm(ref,hst,cache_fn=cache_fn,engine=engine,**kwargs)
 
-    # Only do historical bias corrections if return_hist=True
-    if return_hst:
+    adjust_kwargs = h.get_kwargs(('interp','extrapolation'),kwargs)
 
-        # Bias correcting step for hst time period
-        hst_ba = QDM.adjust(hst,
-            **h.get_kwargs(('interp','extrapolation'),kwargs))
-
-        # Set all jittered values back to 0
-        if min_thresh is not None:
-
-            hst_ba = xr.where(hst_ba > min_thresh,hst_ba,0.0)
-
-        hst_ba = hst_ba.rename(var)
-        hst_ba = hst_ba.assign_attrs(hst.attrs)
-
-        return_ds = return_ds + tuple([hst_ba])
-
-    # Bias correcting step for projected/simulated time period
-    sim_ba = QDM.adjust(sim,
-        **h.get_kwargs(('interp','extrapolation'),kwargs))
-
-    # Set all jittered values back to 0
-    if min_thresh is not None:
-
-        sim_ba = xr.where(sim_ba > min_thresh,sim_ba,0.0)
-
-    # The xclim function renames the variable, this is just setting it back to
-    # the original name.
-    sim_ba = sim_ba.rename(var)
+    # Only do historical bias corrections if return_hist=True
+    return_ds = [hst] + sim if return_hst else sim
 
-    # Makes sure the proper attributes remain witht the data array after 
-    # using the xclim function
-    sim_ba = sim_ba.assign_attrs(sim.attrs)
+    return_ds = tuple([adjust_qdm(QDM,x,min_thresh=min_thresh,dtype=dtype,
+                                  **adjust_kwargs) for x in return_ds])
 
-    # Add bias adjusted data array to the export tuple
-    return_ds = return_ds + tuple([sim_ba])
+    # Put the active cells back on the grid
+    if (index is not None) and (not return_cells):
+        return_ds = tuple([h.unstack_cells(x,index) for x in return_ds])
 
     # Export results
     if (not dask_return) & (dask.is_dask_collection(return_ds[0])):
 
-        return tuple([x.compute() for x in return_ds])
+        with dask.config.set(h.process_scheduler(workers)):
+            return dask.compute(*return_ds)
 
     else:
 
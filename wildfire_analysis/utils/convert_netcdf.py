@@ -0,0 +1,181 @@
+"""
+Description
+-----------
+Functions to convert downloaded ERA5 files from NetCDF3 to NetCDF4 (HDF5)
+with compression, and with chunks that hold whole days of hourly data for a
+block of rows, which is how the data are read for the daily summaries in
+'process_era5'. Conversions can be run in a pool of worker processes while
+other files are still downloading (see 'download_era5.py').
+"""
+
+import concurrent.futures
+import os
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+from wildfire_analysis.utils import helpers as h
+
+def era5_chunksizes(shape: tuple,
+                    itemsize: int,
+                    ndays: int=30,
+                    chunk_bytes: int=4*2**20) -> tuple:
+
+    """
+    Description
+    -----------
+    Chunk sizes for an hourly (time, lat, lon) variable. Chunks hold ndays
+    whole days along time and full rows along lon, with the number of rows
+    set so that a chunk is about chunk_bytes in size.
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of variable (time, lat, lon)
+    itemsize: int
+        Size of each value in bytes
+    ndays: int
+        Number of days of hourly data in each chunk
+    chunk_bytes: int
+        Target size of each chunk in bytes
+
+    Returns
+    -------
+    tuple
+        Chunk sizes (time, lat, lon)
+    """
+
+    nt, ny, nx = shape
+
+    nt_chunk = min(nt,24*ndays)
+    ny_chunk = chunk_bytes // (nt_chunk * nx * itemsize)
+    ny_chunk = int(np.clip(ny_chunk,1,ny))
+
+    return (max(nt_chunk,1),ny_chunk,nx)
+
+def convert_netcdf4(src,
+                    dest,
+                    ndays: int=30,
+                    complevel: int=4,
+                    remove_src: bool=False) -> Path:
+
+    """
+    Description
+    -----------
+    Convert a netcdf file to NetCDF4 with zlib compression and chunking from
+    'era5_chunksizes' for variables with a time dimension. Values are copied
+    without decoding, so packed (scale_factor/add_offset) variables stay
+    packed. The file is written to a temporary file and renamed once
+    complete.
+
+    Parameters
+    ----------
+    src: str, pathlib.Path
+        File to convert
+    dest: str, pathlib.Path
+        Output file
+    ndays: int
+        Number of days of hourly data in each chunk
+    complevel: int
+        zlib compression level (1-9)
+    remove_src: bool
+        If True, remove src once it is converted
+
+    Returns
+    -------
+    pathlib.Path
+        Output file
+    """
+
+    src, dest = Path(src), Path(dest)
+    tmp = dest.with_name(dest.name + '.tmp')
+
+    with xr.open_dataset(src,decode_cf=False) as ds:
+
+        encoding = {}
+
+        for var in ds.data_vars:
+
+            da = ds[var]
+            encoding[var] = {'zlib': True,
+                             'complevel': complevel,
+                             'shuffle': True}
+
+            if (da.ndim == 3) and ('time' in da.dims[0]):
+                encoding[var]['chunksizes'] = era5_chunksizes(
+                    da.shape,da.dtype.itemsize,ndays=ndays)
+
+        ds.to_netcdf(tmp,engine='h5netcdf',encoding=encoding)
+
+    os.replace(tmp,dest)
+
+    if remove_src:
+        src.unlink()
+
+    return dest
+
+def conversion_pool(workers: int=1) -> concurrent.futures.Executor:
+
+    """
+    Description
+    -----------
+    Pool of worker processes for 'convert_netcdf4'. Processes are forked 
+    (see 'helpers.fork_context'), and threads are used if forking is not
+    available.
+
+    Parameters
+    ----------
+    workers: int
+        Number of worker processes
+
+    Returns
+    -------
+    concurrent.futures.Executor
+        Pool to submit conversions to
+    """
+
+    mp_context = h.fork_context()
+
+    if mp_context is not None:
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,mp_context=mp_context)
+
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+def convert_netcdf4_files(files,
+                          dest_dir,
+                          workers: int=1,
+                          **kwargs) -> list:
+
+    """
+    Description
+    -----------
+    Convert several files with 'convert_netcdf4' in a pool of worker
+    processes. Output files have the same name as the input files.
+
+    Parameters
+    ----------
+    files: list
+        Files to convert
+    dest_dir: str, pathlib.Path
+        Directory to write output files to
+    workers: int
+        Number of worker processes
+    **kwargs
+        Passed to 'convert_netcdf4'
+
+    Returns
+    -------
+    list
+        Output files
+    """
+
+    dest_dir = Path(dest_dir)
+
+    with conversion_pool(workers) as pool:
+
+        futures = [pool.submit(convert_netcdf4,fn,dest_dir / Path(fn).name,
+                               **kwargs) for fn in files]
+
+        return [f.result() for f in futures]
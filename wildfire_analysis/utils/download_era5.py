@@ -4,6 +4,8 @@ import yaml
 import cdsapi
 
 from wildfire_analysis.utils import helpers as h
+from wildfire_analysis.utils.convert_netcdf import convert_netcdf4, \
+    conversion_pool
 
 root_dir = Path(h.get_root_dir())
 
@@ -12,8 +14,13 @@ config_fn = root_dir / 'config.yaml'
 with open(config_fn,'r') as config_file:
     config_params = yaml.safe_load(config_file)
 
+    raw_data_dir = root_dir / config_params['PATHS']['raw_data_dir']
     era5_yr = config_params['TIME']['era5_yr']
     geolims = config_params['EXTENT']['geog_lims']
+    workers = config_params['ERA5']['workers']
+
+dest = raw_data_dir / 'climate/era5'
+dest.mkdir(parents=True,exist_ok=True)
 
 vars = [
     '2m_dewpoint_temperature',
@@ -26,13 +33,23 @@ vars = [
 yr = range(era5_yr[0],era5_yr[1]+1)
 mon = range(1,12+1)
 
-for v in range(0,len(vars)):
+# Each downloaded file is converted to NetCDF4 in a pool of worker processes
+# while the next files are downloading. Years are downloaded in order, so all
+# files of a year are ready for processing as soon as possible.
+pool = conversion_pool(workers)
+conversions = []
+
+for y in range(0,len(yr)):
     
-    for y in range(0,len(yr)):
+    for v in range(0,len(vars)):
                             
         fn = '%d_era5_reanalysis_%s.nc' % (yr[y],vars[v])
         fn = root_dir.joinpath('../tmp',fn)
 
+        # Skip files that are already downloaded and converted
+        if (dest / fn.name).exists():
+            continue
+
         c = cdsapi.Client()
         
         c.retrieve(
@@ -63,3 +80,12 @@ for v in range(0,len(vars)):
                 'area': [geolims[3],geolims[0],geolims[1],geolims[2]],
             },
             fn)
+
+        conversions.append(pool.submit(convert_netcdf4,fn,dest / fn.name,
+                                       remove_src=True))
+
+# Wait for remaining conversions, raising any errors
+for future in conversions:
+    future.result()
+
+pool.shutdown()
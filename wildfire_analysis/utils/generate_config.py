@@ -13,10 +13,20 @@ paths = dict(
     model_results_data_dir='../data/model_results',
     )
 
+# dtype is the floating point type of climate data from reading through to
+# export. float32 halves memory use compared to float64, see
+# test/test_dtype/test_dtype_accuracy.py for a comparison of the two. If
+# ecoregion_bbox is True, ERA5 and CMIP6 data are only read within the 
+# bounding box of the ecoregions shapefile (buffered by the grid resolution)
+# instead of the full extent in EXTENT: geog_lims. The shapefile is made by
+# scripts/03_modify_ecoregion_shapefile.py, which needs to run first (see
+# run_analysis.sh).
 climate_params = dict(
     geo_lims=[-177.1875,35.0,-35.0,79.375],
     gcm_list=['EC-Earth3-Veg','MPI-ESM1-2-HR','MRI-ESM2-0','CNRM-CM6-1-HR'],
     metvars=['tasmax','pr','sfcWind','hursmin'],
+    dtype='float32',
+    ecoregion_bbox=False,
     )
 
 # Time spans for different variables/datasets, needed for processing
@@ -29,11 +39,35 @@ time_spans = dict(
     sim_periods=[[2010,2039],[2040,2069],[2070,2099]],
     )
 
-# Values needed for quantile delta mapping
+# Values needed for quantile delta mapping. engine is 'xclim' 
+# (xclim.sdba.QuantileDeltaMapping) or 'numpy' (data_processing/qdm_numpy.py),
+# and workers the number of processes used to compute spatial chunks in 
+# parallel.
 qdm_params = dict(
     oper={'tasmax': '+','pr': '*','sfcWind': '*','hursmin': '*'},
     min_thresh={'tasmax': None,'pr': 0.5,'sfcWind': None,'hursmin': None},
     quantile_vals=[0.005] + [x/100 for x in range(1,100)] + [0.995],
+    engine='xclim',
+    workers=1,
+    )
+
+# Settings for processing ERA5 data. workers is the number of processes used 
+# to convert downloaded files and to process years in parallel, and 
+# memory_limit the maximum memory of each process in bytes (null for none).
+era5_params = dict(
+    workers=1,
+    memory_limit=None,
+    )
+
+# Settings for CFFDRS calculations. If continuous_run is True, moisture codes
+# are carried over from the end of one year to the start of the next instead
+# of being reset on January 1st. workers is the number of processes used to 
+# compute years (or sources if continuous_run is True) in parallel, and 
+# memory_limit the maximum memory of each process in bytes (null for none).
+cffdrs_params = dict(
+    continuous_run=False,
+    workers=1,
+    memory_limit=None,
     )
 
 config_dict = dict(
@@ -41,6 +75,8 @@ config_dict = dict(
     CLIMATE=climate_params,
     TIME=time_spans,
     QDM=qdm_params,
+    ERA5=era5_params,
+    CFFDRS=cffdrs_params,
     )
 
 config_filename = root_dir / 'config.yaml'
@@ -4,19 +4,26 @@ Description
 This is set of utility and helper functions to accompany this analysis. Most of
 these functions are shortcuts to extracting and processing relevant data from 
 xarray objects.
+
+The GIS libraries (geopandas, rasterio, shapely) and xarray are imported in the
+functions that use them, so that this module can be imported quickly (e.g., 
+in worker processes) without loading them.
 """
 
+from __future__ import annotations
+
+import collections
+import copy
 import datetime as dt
+import functools
+import hashlib
 import os
 import pathlib
 from typing import Iterable
 # from keyword import kwlist 
 
-import geopandas as gpd
 import numpy as np
-import shapely.vectorized
-import rasterio as rio
-import xarray as xr
+import yaml
 
 def get_root_dir() -> str:
 
@@ -37,6 +44,39 @@ def get_root_dir() -> str:
 
     return str((pathlib.Path(__file__).parent / '../').resolve())
 
+@functools.lru_cache(maxsize=None)
+def _read_config(config_fn: str) -> dict:
+
+    with open(config_fn,'r') as config_file:
+        return yaml.safe_load(config_file)
+
+def get_config(section: str=None) -> dict:
+
+    """
+    Description
+    -----------
+    Get parameters from the configuration file ('config.yaml' in the root 
+    directory). The file is only read and parsed on the first call.
+
+    Parameters
+    ----------
+    section: str
+        If supplied, only return this section (e.g., 'PATHS')
+
+    Returns
+    -------
+    dict
+        Copy of the configuration parameters
+    """
+
+    config_params = _read_config(str(pathlib.Path(get_root_dir()) / 
+                                     'config.yaml'))
+
+    if section is not None:
+        config_params = config_params[section]
+
+    return copy.deepcopy(config_params)
+
 def get_kwargs(x: dict,kwargs: Iterable) -> dict:
 
     """
@@ -72,6 +112,480 @@ def get_var_names(ds: xr.Dataset) -> list:
     # Return list of all variable names in netcdf dataset
     return list(ds.keys())
 
+# Month of each day of year (index 0 is January 1st) for 365 day calendars
+_NOLEAP_MONTH = np.repeat(np.arange(1,13,dtype=np.int16),
+                          [31,28,31,30,31,30,31,31,30,31,30,31])
+
+def time_index(time) -> dict:
+
+    """
+    Description
+    -----------
+    Integer year, month and day of year of each time value. For 'noleap'
+    (365_day) cftime values these are calculated from the number of days
+    since 0001-01-01, which avoids the slow per-element access of cftime
+    objects by xarray's .dt accessor.
+
+    Parameters
+    ----------
+    time: xarray.DataArray, numpy.ndarray
+        Time values (numpy.datetime64 or cftime objects)
+
+    Returns
+    -------
+    dict
+        Dictionary of numpy.ndarrays with keys 'year', 'month' and 'doy'
+    """
+
+    import xarray as xr
+
+    time = xr.DataArray(np.asarray(time).ravel(),dims='time')
+    values = time.values
+
+    calendar = getattr(values[0],'calendar',None) if values.size > 0 else None
+
+    if calendar in ('noleap','365_day'):
+
+        days, _, _ = xr.coding.times.encode_cf_datetime(
+            values,'days since 0001-01-01',calendar)
+        days = np.floor(np.asarray(days,dtype=np.float64)).astype(np.int64)
+
+        doy = days % 365
+        index = {'year': (days // 365 + 1).astype(np.int16),
+                 'month': _NOLEAP_MONTH[doy],
+                 'doy': (doy + 1).astype(np.int16)}
+
+    else:
+
+        index = {'year': time.dt.year.values.astype(np.int16),
+                 'month': time.dt.month.values.astype(np.int16),
+                 'doy': time.dt.dayofyear.values.astype(np.int16)}
+
+    return index
+
+def add_time_coords(ds,time_name: str='time'):
+
+    """
+    Description
+    -----------
+    Attach integer 'year', 'month' and 'doy' coordinates along the time
+    dimension (see time_index), to use for grouping (e.g.,
+    ds.groupby('year')) and selecting years (see sel_years) instead of
+    cftime objects. Does nothing if the coordinates already exist.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset or xarray.DataArray
+        Data with time dimension
+    time_name: str
+        Name of time dimension
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        Data with year, month and doy coordinates
+    """
+
+    if all(k in ds.coords for k in ('year','month','doy')):
+        return ds
+
+    index = time_index(ds[time_name])
+
+    return ds.assign_coords({k: (time_name,v) for k, v in index.items()})
+
+def sel_years(ds,first_yr: int,last_yr: int=None,time_name: str='time'):
+
+    """
+    Description
+    -----------
+    Select time steps from first_yr to last_yr (inclusive) by position,
+    using the integer 'year' coordinate (see add_time_coords).
+
+    Parameters
+    ----------
+    ds: xarray.Dataset or xarray.DataArray
+        Data with time dimension
+    first_yr: int
+        First year to select
+    last_yr: int
+        Last year to select. Defaults to first_yr.
+    time_name: str
+        Name of time dimension
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        Data for selected years
+    """
+
+    if last_yr is None:
+        last_yr = first_yr
+
+    ds = add_time_coords(ds,time_name)
+    year = ds['year'].values
+
+    return ds.isel({time_name: np.flatnonzero((year >= first_yr) &
+                                              (year <= last_yr))})
+
+def set_float_dtype(ds,dtype):
+
+    """
+    Description
+    -----------
+    Cast floating point data variables of an xarray object to dtype (e.g., 
+    'CLIMATE: dtype' in config.yaml). Coordinates and non-float variables
+    are unchanged, and casting is lazy for dask arrays.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset or xarray.DataArray
+        Data to cast
+    dtype: str or numpy.dtype
+        Floating point data type, e.g. 'float32'
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        Data with floating point variables of type dtype
+    """
+
+    import xarray as xr
+
+    if isinstance(ds,xr.DataArray):
+        if np.issubdtype(ds.dtype,np.floating) and (ds.dtype != dtype):
+            ds = ds.astype(dtype)
+        return ds
+
+    cast_vars = {k: v.astype(dtype) for k, v in ds.data_vars.items()
+                 if np.issubdtype(v.dtype,np.floating) and (v.dtype != dtype)}
+
+    return ds.assign(cast_vars)
+
+def fork_context():
+
+    """
+    Description
+    -----------
+    multiprocessing context for pools of worker processes. Processes are 
+    forked where possible, since the analysis scripts that start a pool would
+    otherwise be re-run by each new process.
+
+    Returns
+    -------
+    multiprocessing.context.BaseContext or None
+        'fork' context, or None if forking is not available on this system
+    """
+
+    import multiprocessing
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+
+    return None
+
+def worker_init(memory_limit: int=None,nthreads: int=None) -> None:
+
+    """
+    Description
+    -----------
+    Set up a worker process of 'run_tasks': limit numba threads, compute 
+    dask chunks in the worker's own thread and limit the address space of 
+    the process (on systems with the 'resource' module).
+
+    Parameters
+    ----------
+    memory_limit: int
+        Maximum address space of the process in bytes. Default is no limit.
+    nthreads: int
+        Number of numba threads, if numba is installed. Default is numba's
+        own default.
+
+    Returns
+    -------
+    None
+    """
+
+    import warnings
+
+    import dask
+
+    # Numba threads are started before the memory limit is set, as they 
+    # reserve a large amount of address space
+    if nthreads is not None:
+        try:
+            import numba
+            numba.set_num_threads(nthreads)
+        except ImportError:
+            pass
+
+    dask.config.set(scheduler='synchronous')
+
+    if memory_limit is not None:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS,(memory_limit,memory_limit))
+        except (ImportError,ValueError):
+            warnings.warn('Memory limit could not be set for worker process')
+
+    return None
+
+def _task_label(info: dict) -> str:
+
+    # e.g. {'sources': ['era5','CanESM5'],'years': [1980,...,2100]} gives 
+    # 'era5,CanESM5 1980-2100'
+    parts = []
+    for v in info.values():
+        if isinstance(v,(list,tuple)) and (len(v) > 1) and \
+           all(isinstance(x,(int,np.integer)) for x in v):
+            parts.append('%d-%d' % (v[0],v[-1]))
+        elif isinstance(v,(list,tuple)):
+            parts.append(','.join(str(x) for x in v))
+        else:
+            parts.append(str(v))
+
+    return ' '.join(parts)
+
+def _run_task(func,info: dict,args: tuple) -> dict:
+
+    # Run one task and return its record. Errors are recorded, not raised, so
+    # that one failed task does not stop the others.
+    import time
+
+    t0 = time.perf_counter()
+    outputs = []
+
+    try:
+        outputs = list(func(*args))
+        status = 'done' if len(outputs) > 0 else 'skipped'
+    except Exception as e:
+        status = 'failed: %s' % repr(e)
+
+    return dict(info,outputs=outputs,status=status,
+                seconds=time.perf_counter()-t0)
+
+def run_tasks(func,
+              tasks: Iterable,
+              workers: int=1,
+              memory_limit: int=None,
+              nthreads: int=None,
+              desc: str=None,
+              verbose: bool=False) -> list:
+
+    """
+    Description
+    -----------
+    Run independent tasks in a pool of worker processes (see 'fork_context'
+    and 'worker_init') and record the outcome of each task. Tasks that raise
+    an error, or that were running in a worker process that was terminated 
+    (e.g., by the operating system when out of memory), fail without 
+    stopping the other tasks.
+
+    Parameters
+    ----------
+    func: function
+        Function run for each task. Returns the list of outputs it computed,
+        which is empty if there was nothing to compute.
+    tasks: Iterable
+        (info, args) pair for each task, where info is a dictionary that 
+        describes the task (e.g. {'year': 1980}) and args are the arguments
+        passed to func
+    workers: int
+        Number of worker processes. Default is 1, which runs all tasks in 
+        the current process.
+    memory_limit: int
+        Maximum address space of each worker process in bytes. Only used 
+        with workers > 1.
+    nthreads: int
+        Number of numba threads in each worker process. Only used with 
+        workers > 1.
+    desc: str
+        Description shown in the progress bar
+    verbose: bool
+        If True, show a progress bar with the outcome of the last task, and
+        print tasks that fail
+
+    Returns
+    -------
+    list of dict
+        Record for each task, in the order tasks finished, with the items of
+        info, the outputs of the task, the task status ('done', 'skipped', or
+        'failed: <error>') and the elapsed time in seconds.
+    """
+
+    import concurrent.futures
+
+    from tqdm import tqdm
+
+    tasks = list(tasks)
+    records = []
+
+    with tqdm(total=len(tasks),desc=desc,disable=not verbose) as pbar:
+
+        def report(record,info):
+            records.append(record)
+            msg = '%s: %s (%.1f s)' % (_task_label(info),record['status'],
+                                       record['seconds'])
+            pbar.set_postfix_str(msg)
+            if verbose and record['status'].startswith('failed'):
+                pbar.write(msg)
+            pbar.update(1)
+
+        if workers == 1:
+            for info, args in tasks:
+                report(_run_task(func,info,args),info)
+            return records
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=fork_context(),
+                initializer=worker_init,
+                initargs=(memory_limit,nthreads)) as pool:
+
+            futures = {pool.submit(_run_task,func,info,args): info
+                       for info, args in tasks}
+
+            for future in concurrent.futures.as_completed(futures):
+                info = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = dict(info,outputs=[],
+                                  status='failed: %s' % repr(e),
+                                  seconds=float('nan'))
+                report(record,info)
+
+    return records
+
+def process_scheduler(workers: int=1) -> dict:
+
+    """
+    Description
+    -----------
+    dask configuration to compute the chunks of dask arrays in a pool of 
+    worker processes, e.g. 'with dask.config.set(process_scheduler(4)):'.
+    Processes are forked where possible (see 'fork_context'). With one 
+    worker, the default dask scheduler (threads in the current process) is 
+    kept.
+
+    Parameters
+    ----------
+    workers: int
+        Number of worker processes
+
+    Returns
+    -------
+    dict
+        Settings to pass to dask.config.set
+    """
+
+    if workers == 1:
+        return {}
+
+    context = 'fork' if fork_context() is not None else 'spawn'
+
+    return {'scheduler': 'processes',
+            'num_workers': workers,
+            'multiprocessing.context': context}
+
+def available_memory():
+
+    """
+    Available physical memory in bytes, or None if it cannot be determined.
+    """
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError,ValueError,OSError):
+        return None
+
+def plan_chunks(sizes: dict,
+                dtype,
+                whole_dims: Iterable=(),
+                workers: int=None,
+                memory_budget: int=None,
+                copies: int=8,
+                memory_frac: float=0.5) -> dict:
+
+    """
+    Description
+    -----------
+    Choose dask chunk sizes so that each worker stays within a memory budget.
+    Dimensions in whole_dims are kept in a single chunk, and the other 
+    dimensions are split in proportion to their sizes until copies times 
+    the chunk size fits in the budget. If there are fewer chunks than 
+    workers, the largest chunks are split further so that all workers are 
+    used. Chunks are then evened out along each dimension.
+
+    Parameters
+    ----------
+    sizes: dict
+        Size of each dimension, e.g. ds.sizes. To fix the chunk size of a 
+        dimension (e.g., 365 days of time), give that size and include the 
+        dimension in whole_dims.
+    dtype: str or numpy.dtype
+        Data type of the array
+    whole_dims: Iterable
+        Dimensions that need to stay in a single chunk, e.g. ('time',) for 
+        quantile mapping or statistics over time
+    workers: int
+        Number of workers computing chunks at the same time. Defaults to the
+        number of CPUs.
+    memory_budget: int
+        Memory in bytes that each worker can use. Defaults to memory_frac of 
+        the available memory divided by workers.
+    copies: int
+        Number of chunk-sized arrays held by a worker at once (inputs, 
+        results and temporary arrays of the computation)
+    memory_frac: float
+        Fraction of available memory used if memory_budget is None
+
+    Returns
+    -------
+    dict
+        Chunk size for each dimension
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if memory_budget is None:
+        available = available_memory()
+        if available is None:
+            available = 4 * 2**30
+        memory_budget = memory_frac * available / workers
+
+    chunks = {d: int(n) for d, n in sizes.items()}
+    split = [d for d in chunks if (d not in whole_dims) and (chunks[d] > 1)]
+
+    if len(split) == 0:
+        return chunks
+
+    # Number of values along the split dimensions that fit in the budget
+    whole_bytes = np.dtype(dtype).itemsize * copies * np.prod(
+        [chunks[d] for d in chunks if d not in split])
+    max_values = max(int(memory_budget // whole_bytes),1)
+    total_values = np.prod([chunks[d] for d in split])
+
+    if max_values < total_values:
+        scale = (max_values / total_values) ** (1 / len(split))
+        for d in split:
+            chunks[d] = max(int(sizes[d] * scale),1)
+
+    def nchunks():
+        return np.prod([-(-sizes[d] // chunks[d]) for d in split])
+
+    while nchunks() < workers:
+        d = max(split,key=lambda x: chunks[x])
+        if chunks[d] == 1:
+            break
+        chunks[d] = -(-chunks[d] // 2)
+
+    # Same number of chunks, with sizes as even as possible
+    for d in split:
+        chunks[d] = -(-sizes[d] // -(-sizes[d] // chunks[d]))
+
+    return chunks
+
 def trim_geolims(ds: xr.Dataset,geolims: Iterable) -> xr.Dataset:
 
     """
@@ -108,6 +622,136 @@ def trim_geolims(ds: xr.Dataset,geolims: Iterable) -> xr.Dataset:
 
     return ds
 
+def _index_in_range(vals: np.ndarray,lim: Iterable) -> object:
+
+    # Indices of coordinate values within lim, ordered by increasing value.
+    # Returns a slice if indices are contiguous so lazily loaded arrays only
+    # read a single block from disk.
+    in_range = (vals >= lim[0]) & (vals <= lim[1])
+    idx = np.flatnonzero(in_range)
+    idx = idx[np.argsort(vals[idx],kind='stable')]
+
+    if (idx.size > 0) and np.all(np.diff(idx) == 1):
+        return slice(int(idx[0]),int(idx[-1])+1)
+
+    return idx
+
+def subset_geolims(ds: xr.Dataset,
+                   geolims: Iterable,
+                   wrap_lon=False) -> xr.Dataset:
+
+    """
+    Description
+    -----------
+    Clip geographic extent of xarray dataset by position, so that data
+    variables that are not yet loaded (e.g., from xarray.open_dataset or as a
+    'preprocess' function in xarray.open_mfdataset) are only read within the
+    new extent. Same result as trim_geolims, with latitude in increasing
+    order.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+        Dataset to clip
+    geolims: Iterable
+        Iterable to coordinates to define new extent of geographic limits: \
+        (left, bottom, right, top)
+    wrap_lon: bool
+        If True, convert longitudes from 0 thru 360 to -180 thru 180 (sorted
+        in increasing order) before clipping.
+
+    Returns
+    -------
+    ds: xarray.Dataset
+        Dataset with new geographic extent
+    """
+
+    coord_names = get_coord_names(ds)
+    lat_name, lon_name = (coord_names['lat'],coord_names['lon'])
+
+    lon = ds[lon_name].values
+    if wrap_lon:
+        lon = ((lon + 180.0) % 360.0) - 180.0
+
+    lon_idx = _index_in_range(lon,(geolims[0],geolims[2]))
+    lat_idx = _index_in_range(ds[lat_name].values,(geolims[1],geolims[3]))
+
+    lon_attrs = ds[lon_name].attrs
+
+    ds = ds.assign_coords({lon_name: (lon_name,lon)})
+    ds = ds.isel({lat_name: lat_idx,lon_name: lon_idx})
+    ds[lon_name].attrs = lon_attrs
+
+    return ds
+
+def drop_leap_days(ds: xr.Dataset) -> xr.Dataset:
+
+    """
+    Description
+    -----------
+    Remove February 29th from dataset by position, which only selects the
+    remaining time steps so that data not yet loaded are not read for leap
+    days. Calendar conversion to 'noleap' (xarray.Dataset.convert_calendar)
+    is then only a relabeling of the time coordinate.
+    """
+
+    time_name = get_coord_names(ds)['time']
+
+    month = ds[time_name].dt.month.values
+    day = ds[time_name].dt.day.values
+
+    leap_day = (month == 2) & (day == 29)
+
+    if np.any(leap_day):
+        ds = ds.isel({time_name: np.flatnonzero(~leap_day)})
+
+    return ds
+
+def geolims_from_shp(shpfile,
+                     buffer=0.0,
+                     geolims=None) -> tuple:
+
+    """
+    Description
+    -----------
+    Geographic limits (left, bottom, right, top) of the bounding box of a
+    shapefile, in degrees longitude and latitude.
+
+    Parameters
+    ----------
+    shpfile: str, pathlib.Path, geopandas.GeoDataFrame
+        File location of ESRI Shapefile or geopandas.GeoDataFrame
+    buffer: float
+        Distance in degrees to expand bounding box on all sides, e.g. the
+        grid resolution so that all grid cells overlapping shapefile are kept.
+    geolims: Iterable
+        If supplied, limits are clipped to these geographic limits.
+
+    Returns
+    -------
+    tuple
+        (left, bottom, right, top) of bounding box
+    """
+
+    import geopandas as gpd
+
+    if isinstance(shpfile,pathlib.Path) or isinstance(shpfile,str):
+        shpfile = gpd.read_file(shpfile)
+
+    if shpfile.crs is not None:
+        shpfile = shpfile.to_crs('EPSG:4326')
+
+    bounds = shpfile.total_bounds
+
+    bounds = [bounds[0]-buffer,bounds[1]-buffer,
+              bounds[2]+buffer,bounds[3]+buffer]
+
+    if geolims is not None:
+        bounds = [max(bounds[0],geolims[0]),max(bounds[1],geolims[1]),
+                  min(bounds[2],geolims[2]),min(bounds[3],geolims[3])]
+
+    return tuple(float(x) for x in bounds)
+
 def get_coord_names(ds) -> dict:
 
     """
@@ -208,6 +852,10 @@ def get_geoaxes(ds: xr.Dataset,coord_axes=None) -> dict:
         except:
             axes = {'X': 'lon','Y': 'lat'}
 
+    else:
+
+        axes = coord_axes
+
     return axes
 
 def get_geocoords(coords,**kwargs) -> tuple:
@@ -238,6 +886,8 @@ def get_geocoords(coords,**kwargs) -> tuple:
         x,y coordinates of dataset
     """ 
 
+    import xarray as xr
+
     if not isinstance(coords,tuple):
 
         if isinstance(coords,pathlib.Path) or isinstance(coords,str):
@@ -290,26 +940,291 @@ def coords_to_mesh(coords,flatten=False,**kwargs):
 
     return (X,Y)    
 
+def _linear_weights(src: np.ndarray,dst: np.ndarray) -> np.ndarray:
+
+    # Weights (len(dst), len(src)) of linear interpolation along one axis.
+    # Each row has (at most) two non-zero values. Rows for dst values outside
+    # the range of src are all zero.
+    order = np.argsort(src,kind='stable')
+    src_sorted = src[order]
+
+    W = np.zeros((dst.size,src.size))
+
+    if src.size < 2:
+        W[dst == src_sorted[0],order[0]] = 1.0
+        return W
+
+    i = np.searchsorted(src_sorted,dst,side='right') - 1
+    i = np.clip(i,0,src.size-2)
+
+    w1 = (dst - src_sorted[i]) / (src_sorted[i+1] - src_sorted[i])
+    inside = (dst >= src_sorted[0]) & (dst <= src_sorted[-1])
+
+    rows = np.flatnonzero(inside)
+    W[rows,order[i[rows]]] = 1.0 - w1[rows]
+    W[rows,order[i[rows]+1]] += w1[rows]
+
+    return W
+
+def _cell_edges(x: np.ndarray) -> np.ndarray:
+
+    # Cell edges of (sorted) cell centers, half way between centers
+    mid = (x[1:] + x[:-1]) / 2
+    first = x[0] - (mid[0] - x[0]) if x.size > 1 else x[0] - 0.5
+    last = x[-1] + (x[-1] - mid[-1]) if x.size > 1 else x[-1] + 0.5
+
+    return np.concatenate([[first],mid,[last]])
+
+def _conservative_weights(src: np.ndarray,dst: np.ndarray,
+                          lat: bool=False) -> np.ndarray:
+
+    # Weights (len(dst), len(src)) of the overlap of each dst cell with each
+    # src cell along one axis, as a fraction of the dst cell. For latitude,
+    # overlap is measured in sin(lat) so weights are proportional to area.
+    src_order = np.argsort(src,kind='stable')
+    dst_order = np.argsort(dst,kind='stable')
+
+    src_edges = _cell_edges(src[src_order])
+    dst_edges = _cell_edges(dst[dst_order])
+
+    if lat:
+        src_edges = np.sin(np.deg2rad(np.clip(src_edges,-90.0,90.0)))
+        dst_edges = np.sin(np.deg2rad(np.clip(dst_edges,-90.0,90.0)))
+
+    lower = np.maximum(dst_edges[:-1,None],src_edges[None,:-1])
+    upper = np.minimum(dst_edges[1:,None],src_edges[None,1:])
+    overlap = np.clip(upper - lower,0.0,None)
+
+    overlap = overlap / (dst_edges[1:] - dst_edges[:-1])[:,None]
+
+    W = np.zeros((dst.size,src.size))
+    W[np.ix_(dst_order,src_order)] = overlap
+
+    return W
+
+def _regrid_block(a: np.ndarray,Wy: np.ndarray,Wx: np.ndarray,
+                  method: str) -> np.ndarray:
+
+    # Apply weights to the last two axes (y, x) of a, i.e. Wy @ a @ Wx.T.
+    # NaN values in a are set to zero and accounted for separately.
+    Wy = Wy.astype(a.dtype,copy=False)
+    Wx = Wx.astype(a.dtype,copy=False)
+
+    invalid = np.isnan(a)
+    out = np.matmul(np.matmul(Wy,np.where(invalid,0,a)),Wx.T)
+
+    if method == 'linear':
+        # NaN if any source value used for a target value is NaN, or if the 
+        # target is outside the source grid (as for xarray.interp)
+        Ny = (Wy != 0).astype(a.dtype)
+        Nx = (Wx != 0).astype(a.dtype)
+        n_invalid = np.matmul(np.matmul(Ny,invalid.astype(a.dtype)),Nx.T)
+        outside = np.outer(Ny.sum(axis=1) == 0,np.ones(Wx.shape[0],bool)) | \
+                  np.outer(np.ones(Wy.shape[0],bool),Nx.sum(axis=1) == 0)
+        out = np.where((n_invalid > 0) | outside,np.nan,out)
+    else:
+        # Renormalize by the fraction of each target cell covered by valid
+        # source cells
+        covered = np.matmul(np.matmul(Wy,(~invalid).astype(a.dtype)),Wx.T)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            out = np.where(covered > 0,out / covered,np.nan)
+
+    return out.astype(a.dtype,copy=False)
+
+def _coords_hash(*arrays) -> str:
+
+    # Hash of coordinate values, used to identify a pair of grids
+    sha = hashlib.sha1()
+    for x in arrays:
+        x = np.ascontiguousarray(x,dtype=np.float64)
+        sha.update(str(x.shape).encode())
+        sha.update(x.tobytes())
+
+    return sha.hexdigest()[:16]
+
+class Regridder:
+
+    """
+    Description
+    -----------
+    Regrid data between two rectilinear (lat/lon) grids. Weights are computed
+    once for a pair of source and target grids and stored as one matrix for 
+    each axis (target size x source size), i.e. a separable sparse form of the
+    full 2-d weight matrix, which are applied to all time steps with two 
+    matrix multiplications per block. Weights can be saved to and loaded 
+    from cache_dir so they are only computed once across runs.
+
+    Parameters
+    ----------
+    src_coords
+        x,y coordinates of source grid, or xarray object with these 
+        coordinates (see get_geocoords)
+    target_coords
+        x,y coordinates of target grid, or xarray object or file with these
+        coordinates (see get_geocoords)
+    method: str
+        'linear' for bilinear interpolation (same as xarray.interp) or 
+        'conservative' for area-weighted averages of overlapping cells
+    cache_dir: str, pathlib.Path
+        If supplied, directory to save/load weights
+    """
+
+    def __init__(self,src_coords,target_coords,method: str='linear',
+                 cache_dir=None):
+
+        if method not in ('linear','conservative'):
+            raise Exception("method needs to be 'linear' or 'conservative'")
+
+        self.method = method
+        self.src_x, self.src_y = [np.asarray(v,dtype=np.float64) for v in 
+                                  get_geocoords(src_coords)]
+        self.x, self.y = [np.asarray(v,dtype=np.float64) for v in 
+                          get_geocoords(target_coords)]
+
+        self.key = '%s_%s' % (method,_coords_hash(self.src_x,self.src_y,
+                                                   self.x,self.y))
+
+        cache_fn = None
+        if cache_dir is not None:
+            cache_fn = pathlib.Path(cache_dir) / ('regrid_%s.npz' % self.key)
+
+        if (cache_fn is not None) and cache_fn.exists():
+            with np.load(cache_fn) as weights:
+                self.Wx, self.Wy = (weights['Wx'],weights['Wy'])
+            return
+
+        if method == 'linear':
+            self.Wx = _linear_weights(self.src_x,self.x)
+            self.Wy = _linear_weights(self.src_y,self.y)
+        else:
+            self.Wx = _conservative_weights(self.src_x,self.x)
+            self.Wy = _conservative_weights(self.src_y,self.y,lat=True)
+
+        if cache_fn is not None:
+            cache_fn.parent.mkdir(parents=True,exist_ok=True)
+            tmp_fn = cache_fn.with_name(cache_fn.stem + '.tmp.npz')
+            np.savez(tmp_fn,Wx=self.Wx,Wy=self.Wy)
+            os.replace(tmp_fn,cache_fn)
+
+    def __call__(self,ds,coord_axes=None):
+
+        """
+        Regrid an xarray.Dataset or xarray.DataArray. Works lazily on dask 
+        arrays, with each block regridded over the whole grid, so dask arrays
+        that are chunked along the x or y dimension are rechunked to a 
+        single chunk along these dimensions first.
+        """
+
+        import xarray as xr
+
+        axes = get_geoaxes(ds,coord_axes)
+        xdim, ydim = (axes['X'],axes['Y'])
+
+        def regrid_da(da):
+
+            if (xdim not in da.dims) or (ydim not in da.dims):
+                return da
+
+            if da.chunks is not None:
+                da = da.chunk({ydim: -1,xdim: -1})
+
+            out = xr.apply_ufunc(
+                _regrid_block,da,
+                input_core_dims=[[ydim,xdim]],
+                output_core_dims=[['__y','__x']],
+                dask='parallelized',
+                output_dtypes=[da.dtype],
+                dask_gufunc_kwargs={'output_sizes': 
+                                    {'__y': self.y.size,'__x': self.x.size}},
+                kwargs={'Wy': self.Wy,'Wx': self.Wx,'method': self.method},
+                keep_attrs=True)
+
+            out = out.rename({'__y': ydim,'__x': xdim})
+            out = out.assign_coords({ydim: self.y,xdim: self.x})
+            out[ydim].attrs = ds[ydim].attrs
+            out[xdim].attrs = ds[xdim].attrs
+
+            return out.transpose(*da.dims)
+
+        if isinstance(ds,xr.DataArray):
+            return regrid_da(ds)
+
+        out = ds.drop_vars([xdim,ydim]).map(regrid_da,keep_attrs=True)
+
+        return out.assign_coords({ydim: self.y,xdim: self.x})
+
+# Regridders computed in the current process, by method and grid hash
+_REGRIDDERS = {}
+
+def get_regridder(src_coords,target_coords,method: str='linear',
+                  cache_dir=None) -> Regridder:
+
+    """
+    Description
+    -----------
+    Get Regridder for a pair of grids, reusing one that was already created 
+    in the current process for the same grids and method.
+    """
+
+    src_x, src_y = get_geocoords(src_coords)
+    x, y = get_geocoords(target_coords)
+
+    key = '%s_%s' % (method,_coords_hash(src_x,src_y,x,y))
+
+    if key not in _REGRIDDERS:
+        _REGRIDDERS[key] = Regridder((src_x,src_y),(x,y),method=method,
+                                     cache_dir=cache_dir)
+
+    return _REGRIDDERS[key]
+
 def regrid_geodata(ds: xr.Dataset,
                    target_coords,
                    method='linear',
+                   cache_dir=None,
                    **kwargs) -> xr.Dataset:
 
     """
-    Shortcut to using xarrays built in interpolation function.
+    Description
+    -----------
+    Regrid dataset to the coordinates of target_coords. 'linear' and 
+    'conservative' use precomputed weights (see Regridder), which are reused
+    for all calls with the same grids. Other methods use xarray's built in 
+    interpolation function.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset or xarray.DataArray
+        Data to regrid
+    target_coords
+        x,y coordinates, or xarray object or file with the target coordinates
+    method: str
+        'linear', 'conservative', or another method of xarray.Dataset.interp
+    cache_dir: str, pathlib.Path
+        If supplied, directory to save/load regridding weights
+    
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        Regridded data
     """
 
     # Get axes for current xarray dataset. Will return empty dict if not 
     # available
-    axes = get_geoaxes(ds)
+    axes = get_geoaxes(ds,**get_kwargs(('coord_axes',),kwargs))
+
+    if method in ('linear','conservative'):
+        regridder = get_regridder((ds[axes['X']].values,ds[axes['Y']].values),
+                                  target_coords,method=method,
+                                  cache_dir=cache_dir)
+        return regridder(ds,coord_axes=axes)
 
     # Get x and y coordinate values
     x,y = get_geocoords(target_coords,**kwargs)
 
     # Use built in xarray interp function to do interpolation
     ds_interp = ds.interp({
-        axes['X'][0]: x,
-        axes['Y'][0]: y
+        axes['X']: x,
+        axes['Y']: y
         },
         method=method)
 
@@ -333,6 +1248,8 @@ def raster_transform_to_coords(rst_file) -> tuple:
         Tuple of geographic coordinates for raster dataset
     """
 
+    import rasterio as rio
+
     with rio.open(rst_file) as ds:
         transform = ds.get_transform()
         height, width = ds.shape
@@ -355,12 +1272,65 @@ def raster_transform_to_coords(rst_file) -> tuple:
 
     return coords
 
-def mask_from_shp(shpfile: gpd.GeoDataFrame,grd_coords,**kwargs) -> np.ndarray:
+# Masks computed in the current process, in order of last use (see 
+# mask_from_shp). The least recently used mask is removed once there are more
+# than _MASK_CACHE_SIZE masks.
+_MASK_CACHE = collections.OrderedDict()
+_MASK_CACHE_SIZE = 256
+
+def _shp_hash(shpfile) -> str:
+
+    # Hash of a shapefile (file name, size and modification time) or of the 
+    # geometries and crs of a geopandas.GeoDataFrame
+    sha = hashlib.sha1()
+
+    if isinstance(shpfile,pathlib.Path) or isinstance(shpfile,str):
+        fn = pathlib.Path(shpfile).resolve()
+        stat = fn.stat()
+        sha.update(('%s %d %d' % (fn,stat.st_size,stat.st_mtime_ns)).encode())
+    else:
+        sha.update(str(shpfile.crs).encode())
+        for geom in shpfile.geometry.to_wkb():
+            sha.update(geom)
+
+    return sha.hexdigest()[:16]
+
+def _cell_fraction(mask_geom,x: np.ndarray,y: np.ndarray,
+                   supersample: int) -> np.ndarray:
+
+    # Fraction of each grid cell covered by mask_geom, from a regular 
+    # supersample x supersample set of points in each cell
+    import shapely.vectorized
+
+    dx = np.gradient(x) if x.size > 1 else np.ones(1)
+    dy = np.gradient(y) if y.size > 1 else np.ones(1)
+
+    offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+
+    fraction = np.zeros((y.size,x.size))
+
+    for oy in offsets:
+        for ox in offsets:
+            X, Y = np.meshgrid(x + ox*dx,y + oy*dy,indexing='xy')
+            fraction += shapely.vectorized.contains(mask_geom,X,Y)
+
+    return fraction / supersample**2
+
+def mask_from_shp(shpfile: gpd.GeoDataFrame,
+                  grd_coords,
+                  fraction: bool=False,
+                  supersample: int=5,
+                  cache_dir=None,
+                  **kwargs) -> np.ndarray:
 
     """
     Description
     -----------
-    Use rasterio library to get x and y coordinate values for a raster dataset
+    Get gridded geospatial mask for a region covered by an ESRI shapefile. 
+    Masks are cached by a hash of the shapefile geometry and the grid 
+    coordinates, in memory (least recently used masks are removed first) and
+    optionally on disk in cache_dir, so repeated calls do not re-read the 
+    shapefile or test each grid point again. Returned masks are read-only.
 
     Parameters
     ----------
@@ -369,27 +1339,319 @@ def mask_from_shp(shpfile: gpd.GeoDataFrame,grd_coords,**kwargs) -> np.ndarray:
     grd_coords: 
         File, xarray.Dataset, or tuple(x,y) containing coordinates to mask with
         shpfile
+    fraction: bool
+        If True, return the fraction of each grid cell covered by shpfile 
+        (estimated from supersample x supersample points in each cell) 
+        instead of whether the cell center is inside shpfile
+    supersample: int
+        Number of points along each axis of a cell if fraction is True
+    cache_dir: str, pathlib.Path
+        If supplied, directory to save/load masks
 
     Returns
     -------
     numpy.ndarray
-        numpy array of dtype=bool of spatial mask defined by shpfile
+        numpy array of dtype=bool (or float if fraction is True) of spatial 
+        mask defined by shpfile
     """    
 
-    # Get gridded geospatial mask for a region covered by an ESRI shapefile
+    import geopandas as gpd
+    import shapely.vectorized
 
-    if isinstance(shpfile,pathlib.Path) or isinstance(shpfile,str):
+    x, y = [np.asarray(v) for v in get_geocoords(grd_coords,**kwargs)]
+
+    key = '%s_%s' % (_shp_hash(shpfile),_coords_hash(x,y))
+    if fraction:
+        key = key + '_f%d' % supersample
+
+    if key in _MASK_CACHE:
+        _MASK_CACHE.move_to_end(key)
+        return _MASK_CACHE[key]
+
+    cache_fn = None
+    if cache_dir is not None:
+        cache_fn = pathlib.Path(cache_dir) / ('mask_%s.npy' % key)
+
+    if (cache_fn is not None) and cache_fn.exists():
+
+        mask_grd = np.load(cache_fn)
+
+    else:
+
+        if isinstance(shpfile,pathlib.Path) or isinstance(shpfile,str):
+
+            mask_vct = gpd.read_file(shpfile)
+
+        else: 
+
+            mask_vct = shpfile
+
+        mask_geom = mask_vct.dissolve().geometry.item()
+
+        if fraction:
+            mask_grd = _cell_fraction(mask_geom,x,y,supersample)
+        else:
+            X, Y = np.meshgrid(x,y,indexing='xy')
+            mask_grd = shapely.vectorized.contains(mask_geom,X,Y)
+
+        if cache_fn is not None:
+            cache_fn.parent.mkdir(parents=True,exist_ok=True)
+            tmp_fn = cache_fn.with_name(cache_fn.stem + '.tmp.npy')
+            np.save(tmp_fn,mask_grd)
+            os.replace(tmp_fn,cache_fn)
+
+    mask_grd.setflags(write=False)
+
+    _MASK_CACHE[key] = mask_grd
+    while len(_MASK_CACHE) > _MASK_CACHE_SIZE:
+        _MASK_CACHE.popitem(last=False)
+
+    return mask_grd
+
+def mask_to_dataarray(mask: np.ndarray,ds,coord_axes=None) -> xr.DataArray:
+
+    """
+    Description
+    -----------
+    2-D spatial mask as an xarray.DataArray with the y and x dimensions and
+    coordinates of ds, so it broadcasts against the other dimensions of ds 
+    (e.g. time) by name without a full-size mask being created.
+
+    Parameters
+    ----------
+    mask: numpy.ndarray or xarray.DataArray
+        2-D array (y, x) on the grid of ds, e.g. from mask_from_shp
+    ds: xarray.Dataset or xarray.DataArray
+        Data with the grid of mask
+    coord_axes: dict
+        If supplied, dict mapping the coordinate names to the 'X' and 'Y' 
+        axes (see get_geoaxes)
+
+    Returns
+    -------
+    xarray.DataArray
+        Mask with dimensions (y, x)
+    """
+
+    import xarray as xr
+
+    if isinstance(mask,xr.DataArray):
+        return mask
+
+    axes = get_geoaxes(ds,coord_axes=coord_axes)
+    x_dim, y_dim = axes['X'], axes['Y']
+
+    return xr.DataArray(np.asarray(mask),dims=(y_dim,x_dim),
+                        coords={y_dim: ds[y_dim],x_dim: ds[x_dim]})
+
+def apply_mask(ds,mask: np.ndarray,other=np.nan,coord_axes=None):
+
+    """
+    Description
+    -----------
+    Apply a 2-D spatial mask to data with any other dimensions, keeping 
+    values where mask is True and setting others to other. The mask is 
+    broadcast against the spatial dimensions only, so no mask with the 
+    shape of the data is created, and dask arrays stay lazy.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset, xarray.DataArray or numpy.ndarray
+        Data to mask. The last two axes of numpy arrays are (y, x).
+    mask: numpy.ndarray or xarray.DataArray
+        2-D array (y, x) on the grid of ds, e.g. from mask_from_shp
+    other: scalar
+        Value for cells outside the mask
+    coord_axes: dict
+        If supplied, dict mapping the coordinate names to the 'X' and 'Y' 
+        axes (see get_geoaxes)
+
+    Returns
+    -------
+    Masked data of the same type as ds
+    """
+
+    import xarray as xr
+
+    if isinstance(ds,(xr.Dataset,xr.DataArray)):
+        return ds.where(mask_to_dataarray(mask,ds,coord_axes=coord_axes),
+                        other)
+
+    return np.where(np.asarray(mask,dtype=bool),ds,other)
+
+def cell_index(mask: np.ndarray,
+               grd_coords,
+               index_fn=None,
+               **kwargs) -> xr.Dataset:
+
+    """
+    Description
+    -----------
+    Index of the grid cells in a spatial mask (the active domain), used to 
+    keep only these cells along a 1-D 'cell' dimension (see stack_cells) and
+    to put them back on the grid (see unstack_cells). Cells are in row-major
+    order of the grid.
+
+    Parameters
+    ----------
+    mask: numpy.ndarray
+        2-D boolean array (y, x), True for cells in the domain
+    grd_coords: 
+        File, xarray.Dataset, or tuple(x,y) containing coordinates of the grid
+        of mask
+    index_fn: str or pathlib.Path
+        If supplied, netcdf file to save the index to, or to load it from if
+        it already exists. A saved index is only used if it was made for the
+        same mask and grid coordinates (attribute domain_hash), otherwise it
+        is rebuilt and the file overwritten.
+
+    Returns
+    -------
+    xarray.Dataset
+        Row (iy) and column (ix) of each cell along 'cell', with the grid 
+        coordinates and names of the y and x dimensions (attributes y_dim and
+        x_dim)
+    """
+
+    import xarray as xr
+
+    x, y = [np.asarray(v) for v in get_geocoords(grd_coords,**kwargs)]
+    mask = np.asarray(mask,dtype=bool)
+
+    # Hash of the mask and grid, to check a saved index
+    sha = hashlib.sha1()
+    sha.update(str(mask.shape).encode())
+    sha.update(np.ascontiguousarray(mask).tobytes())
+    sha.update(_coords_hash(x,y).encode())
+    domain_hash = sha.hexdigest()[:16]
+
+    if (index_fn is not None) and pathlib.Path(index_fn).exists():
+        index = load_cell_index(index_fn)
+        if index.attrs.get('domain_hash') == domain_hash:
+            return index
+
+    if isinstance(grd_coords,(xr.Dataset,xr.DataArray)):
+        axes = get_geoaxes(grd_coords,**kwargs)
+        x_dim, y_dim = axes['X'], axes['Y']
+    else:
+        x_dim, y_dim = 'lon', 'lat'
+
+    iy, ix = np.nonzero(mask)
+
+    index = xr.Dataset(
+        {'iy': ('cell',iy.astype(np.int32)),
+         'ix': ('cell',ix.astype(np.int32))},
+        coords={y_dim: y,x_dim: x},
+        attrs={'y_dim': y_dim,'x_dim': x_dim,'domain_hash': domain_hash})
+
+    if index_fn is not None:
+        index_fn = pathlib.Path(index_fn)
+        index_fn.parent.mkdir(parents=True,exist_ok=True)
+        tmp_fn = index_fn.with_name(index_fn.name + '.tmp')
+        index.to_netcdf(tmp_fn,engine='h5netcdf')
+        os.replace(tmp_fn,index_fn)
+
+    return index
+
+def load_cell_index(index_fn) -> xr.Dataset:
+
+    """
+    Load a cell index saved by cell_index.
+    """
+
+    import xarray as xr
+
+    with xr.open_dataset(index_fn,engine='h5netcdf') as index:
+        return index.load()
+
+def stack_cells(ds,index: xr.Dataset):
+
+    """
+    Description
+    -----------
+    Keep only the cells of index, replacing the y and x dimensions of ds with
+    a 1-D 'cell' dimension (with y and x coordinates of each cell). Lazy for
+    dask arrays. Raises an Exception if the grid coordinates of ds are not 
+    those of index.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset or xarray.DataArray
+        Data on the grid of index
+    index: xarray.Dataset
+        Cell index (see cell_index)
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        Data of the cells in index
+    """
+
+    import xarray as xr
+
+    y_dim, x_dim = index.attrs['y_dim'], index.attrs['x_dim']
+
+    for d in (y_dim,x_dim):
+        if (d not in ds.coords) or not np.array_equal(ds[d].values,
+                                                      index[d].values):
+            raise Exception("Grid of data does not match the grid of the "
+                            "cell index ('%s' coordinates differ)" % d)
+
+    return ds.isel({y_dim: xr.DataArray(index['iy'].values,dims='cell'),
+                    x_dim: xr.DataArray(index['ix'].values,dims='cell')})
+
+def unstack_cells(ds,index: xr.Dataset):
+
+    """
+    Description
+    -----------
+    Put data along the 'cell' dimension (see stack_cells) back on the grid of 
+    index, with NaN for cells that are not in index. The y and x dimensions 
+    replace 'cell' as the last two dimensions. Lazy for dask arrays.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset or xarray.DataArray
+        Data with a 'cell' dimension
+    index: xarray.Dataset
+        Cell index (see cell_index)
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        Data on the grid
+    """
+
+    import xarray as xr
+
+    y_dim, x_dim = index.attrs['y_dim'], index.attrs['x_dim']
+    ny, nx = index.sizes[y_dim], index.sizes[x_dim]
+
+    flat = index['iy'].values.astype(np.int64) * nx + index['ix'].values
+
+    def unstack(da):
+
+        if 'cell' not in da.dims:
+            return da
 
-        mask_vct = gpd.read_file(shpfile)
+        dims = [d for d in da.dims if d != 'cell']
+        da = da.drop_vars([k for k in da.coords if 'cell' in da[k].dims])
+        da = da.transpose(*dims,'cell')
 
-    else: 
+        # Fill cells not in index with NaN, then reshape cells to (y, x)
+        da = da.assign_coords(cell=flat).reindex(cell=np.arange(ny*nx))
+        data = da.data.reshape(da.shape[:-1] + (ny,nx))
 
-        mask_vct = shpfile
+        coords = {k: v for k, v in da.coords.items() if k != 'cell'}
+        coords.update({y_dim: index[y_dim],x_dim: index[x_dim]})
 
-    x,y = coords_to_mesh(grd_coords,**kwargs)
+        return xr.DataArray(data,dims=dims + [y_dim,x_dim],coords=coords,
+                            attrs=da.attrs,name=da.name)
 
-    mask_geom = mask_vct.dissolve().geometry.item()
+    if isinstance(ds,xr.DataArray):
+        return unstack(ds)
 
-    mask_grd = shapely.vectorized.contains(mask_geom,x,y)
+    out = xr.Dataset({k: unstack(v) for k, v in ds.data_vars.items()},
+                     attrs=ds.attrs)
 
-    return mask_grd
\ No newline at end of file
+    return out